@@ -5,102 +5,86 @@
 from __future__ import print_function, unicode_literals
 
 import argparse
+import fcntl
+import hashlib
+import io
+import json
 import os
 import os.path
+import shlex
 import shutil
 import subprocess
 import sys
+import threading
+import time
 
 COMMAND_DESCRIPTION = """
 boostrap-repository.py checkout and install a clickable repository.
 """
+#: default count of repositories running git steps at once (--manifest)
+DEFAULT_JOBS = 4
+#: default count of repositories running env phase at once (--manifest)
+DEFAULT_ENV_JOBS = 2
+#: default count of submodules updated at once
+DEFAULT_SUBMODULE_JOBS = 4
+#: pipenv and hatch env dependency inputs
+ENV_INPUT_FILES = ('Pipfile', 'Pipfile.lock', 'pyproject.toml', 'hatch.toml')
+#: last successful pipenv/hatch env install, in working copy .git folder
+ENV_STATE_FILE = 'bootstrap-env.json'
+
+#: per-thread repository label, prefixing messages in manifest mode
+_log_context = threading.local()
+_log_lock = threading.Lock()
+
+
+def _log(message, level='INFO'):
+    """Print a message on stderr."""
+    label = getattr(_log_context, 'label', None)
+    if label is not None:
+        message = '[{0}] {1}'.format(label, message)
+    with _log_lock:
+        print('[{0}] {1}'.format(level, message), file=sys.stderr)
+
+
+def _target_path(repository_path, git_url):
+    """Working copy path: folder named from `git_url` in `repository_path`."""
+    return os.path.join(os.path.expanduser(repository_path),
+        os.path.splitext(os.path.basename(git_url.rstrip('/')))[0])
 
 
 def _bootstrap(git_command, git_url, repository_path, ref, args,
                reset_git=False, reset_env=False, reset_conda=False,
-               reset_pipenv=False, reset_hatch=False):
+               reset_pipenv=False, reset_hatch=False,
+               git_lock=None, env_lock=None, output=None,
+               depth=None, clone_filter=None, reference_cache=None,
+               submodule_jobs=DEFAULT_SUBMODULE_JOBS):
     """Checkout `git_url` with provided `git_command`. Working copy *parent* path
     is `repository_path` . Folder name is built from `git_url`.
 
-    If reset_git is true, target path is
+    If reset_git is true, existing working copy is deleted and cloned again.
+    Clone is shallow if `depth` is set, partial if `clone_filter` is set
+    (ex: blob:none), and borrows objects from a mirror kept in
+    `reference_cache` if set (see _reference_mirror). Submodules are
+    updated `submodule_jobs` at a time (see _submodule_phase).
+
+    git steps are run while holding `git_lock` and env phase while holding
+    `env_lock` (semaphores shared by repositories bootstrapped in parallel).
+    Output of commands goes to `output` file if provided.
     """
     reset_env = reset_pipenv or reset_hatch
     repository_path = os.path.expanduser(repository_path)
-    target_path = os.path.join(repository_path,
-        os.path.splitext(os.path.basename(git_url))[0])
-    # protect some commons path
-    if os.path.realpath(target_path) == os.path.realpath(repository_path) \
-            or os.path.realpath(target_path) == '/' \
-            or os.path.realpath(target_path) == os.path.realpath(os.path.expanduser('~')):
-        print('[FATAL] Target path {0} is protected; aborted.'.format(target_path))
-    print('[INFO] Using {0} as target repository.'.format(target_path), file=sys.stderr)
+    target_path = _target_path(repository_path, git_url)
     if not os.path.exists(git_command):
-        print('[FATAL] Missing command {0}; aborted.'.format(git_command), file=sys.stderr)
-        os.exit(1)
+        raise Exception('[FATAL] Missing command {0}; aborted.'.format(git_command))
     try:
-        if not os.path.exists(repository_path):
-            print('[INFO] Creating {0}.'.format(repository_path), file=sys.stderr)
-            os.makedirs(repository_path)
-        if reset_git and os.path.exists(target_path) and target_path:
-            print('[WARN ] Deleting existing clone: {0}.'.format(target_path))
-            shutil.rmtree(target_path)
-        if not os.path.exists(target_path):
-            print('[INFO] Cloning {0} in {1}.'.format(git_url, target_path), file=sys.stderr)
-            subprocess.check_call(_command(git_command, 'clone', git_url, target_path))
-        subprocess.check_call(_command(git_command, 'fetch'), cwd=target_path)
-        if ref is None:
-            subprocess.check_call(_command(git_command, 'remote', 'set-head', 'origin', '--auto'),
-                                  cwd=target_path)
-            ref = subprocess.check_output(_command(git_command, 'rev-parse', '--abbrev-ref', 'origin/HEAD'),
-                                          encoding="UTF-8",
-                                          cwd=target_path).split("/")[1].strip()
-            print('[INFO] Using default branch {0}.'.format(ref), file=sys.stderr)
-        print('[INFO] Switching/refreshing reference {0}.'.format(ref), file=sys.stderr)
-        subprocess.check_call(_command(git_command, 'switch', '--force', ref), cwd=target_path)
-        # -ff: also remove untracked submodules
-        subprocess.check_call(_command(git_command, 'clean', '-dff'), cwd=target_path)
-        subprocess.check_call(_command(git_command, 'pull'), cwd=target_path)
-        subprocess.check_call(_command(git_command, 'submodule', 'update', '--init'),
-                              cwd=target_path)
-        if os.path.exists(os.path.join(target_path, 'Pipfile')):
-            # pipenv mode
-            print('[INFO] Running pipenv phase', file=sys.stderr)
-            try:
-                subprocess.check_call(['pipenv', '--version'])
-            except Exception as pipenv_not_found:
-                raise Exception("[FATAL] pipenv not installed; install pipenv with 'pipx install pipenv': {0}"
-                                .format(pipenv_not_found))
-            if reset_env:
-                print('[INFO] Cleaning pipenv', file=sys.stderr)
-                if subprocess.call(['pipenv', '--venv'], cwd=target_path) == 0:
-                    subprocess.check_call(['pipenv', '--rm'], cwd=target_path)
-                if os.path.exists(os.path.join(target_path, 'Pipfile.lock')):
-                    os.remove(os.path.join(target_path, 'Pipfile.lock'))
-            subprocess.check_call(['pipenv', 'install'], cwd=target_path)
-            subprocess.check_call(['pipenv', 'run'] + args, cwd=target_path)
-        elif os.path.exists(os.path.join(target_path, 'pyproject.toml')):
-            # hatch mode
-            print('[INFO] Running hatch phase', file=sys.stderr)
-            try:
-                subprocess.check_call(['hatch', '--version'])
-            except Exception as hatch_not_found:
-                raise Exception("[FATAL] hatch not installed; install hatch with 'pipx install hatch': {0}"
-                                .format(hatch_not_found))
-            if reset_env:
-                print('[INFO] Cleaning hatch', file=sys.stderr)
-                subprocess.call(['hatch', 'env', 'remove'], cwd=target_path)
-            subprocess.check_call(['hatch', 'run'] + args, cwd=target_path)
-        else:
-            print('[INFO] Running bootstrap phase', file=sys.stderr)
-            bootstrap_path = os.path.join(target_path, './bootstrap/bootstrap.sh')
-            bootstrap_arguments = []
-            if reset_env:
-                bootstrap_arguments.append('--reset-env')
-            if reset_conda:
-                bootstrap_arguments.append('--reset-conda')
-            bootstrap_arguments.append('--')
-            bootstrap_arguments.extend(args)
-            subprocess.check_call(_command(bootstrap_path, *bootstrap_arguments), cwd=target_path)
+        with git_lock or threading.Semaphore():
+            _git_phase(git_command, git_url, repository_path, target_path,
+                       ref, reset_git, output, depth=depth,
+                       clone_filter=clone_filter,
+                       reference_cache=reference_cache,
+                       submodule_jobs=submodule_jobs)
+        with env_lock or threading.Semaphore():
+            _env_phase(target_path, args, reset_env, reset_conda, output)
     except subprocess.CalledProcessError as e:
         # python2.6: index is mandatory
         raise Exception("[FATAL] Error running {0}: {1}"
@@ -110,6 +94,531 @@ def _bootstrap(git_command, git_url, repository_path, ref, args,
         raise Exception("[FATAL] Error: {0}".format(e1))
 
 
+def _redirect(output):
+    """subprocess arguments sending output to `output` file (if any)."""
+    if output is None:
+        return {}
+    return {'stdout': output, 'stderr': subprocess.STDOUT}
+
+
+def _reference_mirror(git_command, git_url, reference_cache, output=None):
+    """Create or update a mirror of `git_url` in `reference_cache` and return
+    its path. Mirrors are shared by clones through git alternates, so
+    automatic gc is disabled in them (it could prune objects clones
+    rely on)."""
+    reference_cache = os.path.expanduser(reference_cache)
+    if not os.path.isdir(reference_cache):
+        try:
+            os.makedirs(reference_cache)
+        except OSError:
+            # created by a parallel bootstrap
+            if not os.path.isdir(reference_cache):
+                raise
+    name = os.path.splitext(os.path.basename(git_url.rstrip('/')))[0]
+    mirror = os.path.join(reference_cache, '{0}-{1}.git'.format(
+        name, hashlib.sha1(git_url.encode('utf-8')).hexdigest()[:12]))
+    redirect = _redirect(output)
+    # concurrent bootstraps (threads or processes) of the same url
+    with io.open(mirror + '.lock', 'ab') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(mirror):
+                _log('Creating reference mirror {0}.'.format(mirror))
+                subprocess.check_call(_command(git_command, 'clone', '--mirror',
+                                               git_url, mirror), **redirect)
+                subprocess.check_call(_command(git_command, 'config',
+                                               'gc.auto', '0'),
+                                      cwd=mirror, **redirect)
+            else:
+                _log('Updating reference mirror {0}.'.format(mirror))
+                subprocess.check_call(_command(git_command, 'fetch', '--prune'),
+                                      cwd=mirror, **redirect)
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+    return mirror
+
+
+def _clone_options(git_command, git_url, depth=None, clone_filter=None,
+                   reference_cache=None, output=None):
+    """git clone options for shallow, partial and reference clones."""
+    options = []
+    if depth:
+        # all branches, so that --ref can switch to any of them
+        options.extend(['--depth', str(depth), '--no-single-branch'])
+    if clone_filter:
+        options.append('--filter={0}'.format(clone_filter))
+    if reference_cache:
+        options.extend(['--reference', _reference_mirror(
+            git_command, git_url, reference_cache, output)])
+    return options
+
+
+def _git_phase(git_command, git_url, repository_path, target_path, ref,
+               reset_git, output=None, depth=None, clone_filter=None,
+               reference_cache=None, submodule_jobs=DEFAULT_SUBMODULE_JOBS):
+    """Clone or update working copy `target_path` and checkout `ref` (remote
+    default branch if None). See _bootstrap for clone options."""
+    redirect = _redirect(output)
+    # protect some commons path
+    if os.path.realpath(target_path) == os.path.realpath(repository_path) \
+            or os.path.realpath(target_path) == '/' \
+            or os.path.realpath(target_path) == os.path.realpath(os.path.expanduser('~')):
+        raise Exception('[FATAL] Target path {0} is protected; aborted.'.format(target_path))
+    _log('Using {0} as target repository.'.format(target_path))
+    if not os.path.exists(repository_path):
+        _log('Creating {0}.'.format(repository_path))
+        try:
+            os.makedirs(repository_path)
+        except OSError:
+            # created by a parallel bootstrap
+            if not os.path.isdir(repository_path):
+                raise
+    if reset_git and os.path.exists(target_path) and target_path:
+        _log('Deleting existing clone: {0}.'.format(target_path), level='WARN ')
+        shutil.rmtree(target_path)
+    if not os.path.exists(target_path):
+        options = _clone_options(git_command, git_url, depth=depth,
+                                 clone_filter=clone_filter,
+                                 reference_cache=reference_cache,
+                                 output=output)
+        _log('Cloning {0} in {1}.'.format(git_url, target_path))
+        subprocess.check_call(_command(git_command, 'clone', *(
+            options + [git_url, target_path])), **redirect)
+        _log('Skipping fetch: just cloned.')
+    else:
+        # the only network round trip of an update
+        subprocess.check_call(_command(git_command, 'fetch'),
+                              cwd=target_path, **redirect)
+    if ref is None:
+        # origin/HEAD is set by clone; only ask remote when it is missing
+        if _git_output(git_command, target_path, 'symbolic-ref', '-q',
+                       'refs/remotes/origin/HEAD') is None:
+            subprocess.check_call(_command(git_command, 'remote', 'set-head', 'origin', '--auto'),
+                                  cwd=target_path, **redirect)
+        ref = subprocess.check_output(_command(git_command, 'rev-parse', '--abbrev-ref', 'origin/HEAD'),
+                                      encoding="UTF-8",
+                                      cwd=target_path).split("/")[1].strip()
+        _log('Using default branch {0}.'.format(ref))
+    upstream = 'origin/{0}'.format(ref)
+    target = _git_output(git_command, target_path, 'rev-parse', '--verify',
+                         '-q', upstream + '^{commit}')
+    reason = _not_up_to_date(git_command, target_path, ref, target)
+    if reason is None:
+        _log('Skipping switch, clean, pull and submodule update: {0} is at '
+             '{1} ({2}) and working copy is clean.'.format(
+                 ref, upstream, target[:12]))
+        return
+    _log('Switching/refreshing reference {0} ({1}).'.format(ref, reason))
+    subprocess.check_call(_command(git_command, 'switch', '--force', ref),
+                          cwd=target_path, **redirect)
+    # -ff: also remove untracked submodules
+    subprocess.check_call(_command(git_command, 'clean', '-dff'),
+                          cwd=target_path, **redirect)
+    if target is None:
+        _log('Skipping pull: no remote branch {0}.'.format(upstream))
+    else:
+        # commits are already fetched: pull would fetch again
+        subprocess.check_call(_command(git_command, 'merge', '--ff-only',
+                                       upstream),
+                              cwd=target_path, **redirect)
+    if not os.path.exists(os.path.join(target_path, '.gitmodules')):
+        _log('Skipping submodule update: no submodules.')
+    else:
+        _submodule_phase(git_command, target_path, jobs=submodule_jobs,
+                         reference_cache=reference_cache, output=output)
+
+
+def _submodule_status(git_command, target_path):
+    """Return [(flag, path)] from git submodule status. flag is ' ' when
+    the checked out commit is the recorded one, '-' when not initialized,
+    '+' when it differs and 'U' on merge conflicts."""
+    status = subprocess.check_output(_command(git_command, 'submodule',
+                                              'status'),
+                                     encoding="UTF-8", cwd=target_path)
+    result = []
+    for line in status.splitlines():
+        if not line:
+            continue
+        # FLAG SHA1 PATH[ (DESCRIBE)]
+        path = line[1:].split(' ', 1)[1]
+        if path.endswith(')') and ' (' in path:
+            path = path.rsplit(' (', 1)[0]
+        result.append((line[0], path))
+    return result
+
+
+def _submodule_urls(git_command, target_path, paths):
+    """Return {path: url} for initialized submodules `paths` (urls resolved
+    by git submodule init)."""
+    names = {}
+    output = _git_output(git_command, target_path, 'config', '-f',
+                         '.gitmodules', '--get-regexp',
+                         r'^submodule\..*\.path$') or ''
+    for line in output.splitlines():
+        key, path = line.split(' ', 1)
+        names[path] = key[len('submodule.'):-len('.path')]
+    return dict((path, _git_output(git_command, target_path, 'config',
+                                   '--get', 'submodule.{0}.url'
+                                   .format(names[path])))
+                for path in paths)
+
+
+def _submodule_phase(git_command, target_path, jobs=DEFAULT_SUBMODULE_JOBS,
+                     reference_cache=None, output=None):
+    """Initialize and update submodules of `target_path`. Submodules whose
+    checked out commit is the recorded one are skipped. `jobs` submodules
+    are fetched at once; with `reference_cache`, each submodule borrows
+    objects from its own mirror (see _reference_mirror)."""
+    redirect = _redirect(output)
+    status = _submodule_status(git_command, target_path)
+    paths = [path for flag, path in status if flag != ' ']
+    if not paths:
+        _log('Skipping submodule update: {0} submodules up to date.'
+             .format(len(status)))
+        return
+    _log('Updating {0} submodules ({1} up to date, skipped).'.format(
+        len(paths), len(status) - len(paths)))
+    jobs = max(1, jobs)
+    if not reference_cache:
+        subprocess.check_call(_command(git_command, 'submodule', 'update',
+                                       '--init', '--jobs', str(jobs), '--',
+                                       *paths),
+                              cwd=target_path, **redirect)
+        return
+    # --reference applies to all updated submodules: one update by submodule
+    subprocess.check_call(_command(git_command, 'submodule', 'init', '--',
+                                   *paths),
+                          cwd=target_path, **redirect)
+    urls = _submodule_urls(git_command, target_path, paths)
+    pending = list(paths)
+    errors = []
+    pending_lock = threading.Lock()
+    label = getattr(_log_context, 'label', None)
+
+    def worker():
+        _log_context.label = label
+        while True:
+            with pending_lock:
+                if not pending or errors:
+                    return
+                path = pending.pop(0)
+            try:
+                mirror = _reference_mirror(git_command, urls[path],
+                                           reference_cache, output)
+                subprocess.check_call(_command(git_command, 'submodule',
+                                               'update', '--init',
+                                               '--reference', mirror, '--',
+                                               path),
+                                      cwd=target_path, **redirect)
+            except Exception as e:
+                with pending_lock:
+                    errors.append(e)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(jobs, len(paths)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def _git_output(git_command, cwd, *args):
+    """Stripped output of a git command, None if it fails."""
+    with io.open(os.devnull, 'wb') as devnull:
+        try:
+            return subprocess.check_output(_command(git_command, *args),
+                                           encoding="UTF-8", cwd=cwd,
+                                           stderr=devnull).strip()
+        except subprocess.CalledProcessError:
+            return None
+
+
+def _not_up_to_date(git_command, target_path, ref, target):
+    """Return why working copy `target_path` is not a clean checkout of
+    branch `ref` at commit `target` (None if it is)."""
+    if target is None:
+        return 'no remote branch'
+    if _git_output(git_command, target_path, 'symbolic-ref', '-q', '--short',
+                   'HEAD') != ref:
+        return 'other branch checked out'
+    if _git_output(git_command, target_path, 'rev-parse', 'HEAD') != target:
+        return 'remote branch changed'
+    # also lists untracked files (removed by clean) and moved submodules
+    if _git_output(git_command, target_path, 'status', '--porcelain') != '':
+        return 'working copy modified'
+    if os.path.exists(os.path.join(target_path, '.gitmodules')):
+        status = _git_output(git_command, target_path, 'submodule', 'status')
+        if status is None or [i for i in status.splitlines()
+                              if i[:1] in ('-', '+', 'U')]:
+            return 'submodules not up to date'
+    return None
+
+
+def _env_phase(target_path, args, reset_env, reset_conda, output=None):
+    """Install environment of working copy `target_path` (pipenv, hatch or
+    bootstrap/bootstrap.sh) and run `args` in it."""
+    redirect = _redirect(output)
+    if os.path.exists(os.path.join(target_path, 'Pipfile')):
+        # pipenv mode
+        _log('Running pipenv phase')
+        venv = None if reset_env else _env_state_venv(target_path, 'pipenv')
+        if venv is not None:
+            # pipenv run still resolves Pipfile scripts and loads .env
+            _log('Skipping pipenv install: Pipfile and Pipfile.lock '
+                 'unchanged.')
+            subprocess.check_call(['pipenv', 'run'] + args, cwd=target_path,
+                                  **redirect)
+            return
+        _env_state_clear(target_path)
+        try:
+            subprocess.check_call(['pipenv', '--version'], **redirect)
+        except Exception as pipenv_not_found:
+            raise Exception("[FATAL] pipenv not installed; install pipenv with 'pipx install pipenv': {0}"
+                            .format(pipenv_not_found))
+        if reset_env:
+            _log('Cleaning pipenv')
+            if subprocess.call(['pipenv', '--venv'], cwd=target_path,
+                               **redirect) == 0:
+                subprocess.check_call(['pipenv', '--rm'], cwd=target_path,
+                                      **redirect)
+            if os.path.exists(os.path.join(target_path, 'Pipfile.lock')):
+                os.remove(os.path.join(target_path, 'Pipfile.lock'))
+        subprocess.check_call(['pipenv', 'install'], cwd=target_path,
+                              **redirect)
+        _env_state_write(target_path, 'pipenv', subprocess.check_output(
+            ['pipenv', '--venv'], encoding="UTF-8", cwd=target_path))
+        subprocess.check_call(['pipenv', 'run'] + args, cwd=target_path,
+                              **redirect)
+    elif os.path.exists(os.path.join(target_path, 'pyproject.toml')):
+        # hatch mode
+        _log('Running hatch phase')
+        venv = None if reset_env else _env_state_venv(target_path, 'hatch')
+        if venv is not None and _hatch_run_needed(target_path, args):
+            # hatch run syncs env: scripts and env-vars disable the fast path
+            _log('Not skipping hatch env sync: {0} may be a hatch script or '
+                 'need hatch env-vars.'.format(args[0]))
+        elif venv is not None:
+            _log('Skipping hatch env sync: pyproject.toml unchanged.')
+            _venv_run(venv, args, target_path, output)
+            return
+        _env_state_clear(target_path)
+        try:
+            subprocess.check_call(['hatch', '--version'], **redirect)
+        except Exception as hatch_not_found:
+            raise Exception("[FATAL] hatch not installed; install hatch with 'pipx install hatch': {0}"
+                            .format(hatch_not_found))
+        if reset_env:
+            _log('Cleaning hatch')
+            subprocess.call(['hatch', 'env', 'remove'], cwd=target_path,
+                            **redirect)
+        # hatch run creates and syncs env
+        subprocess.check_call(['hatch', 'run'] + args, cwd=target_path,
+                              **redirect)
+        _env_state_write(target_path, 'hatch', subprocess.check_output(
+            ['hatch', 'env', 'find'], encoding="UTF-8", cwd=target_path))
+    else:
+        _log('Running bootstrap phase')
+        bootstrap_path = os.path.join(target_path, './bootstrap/bootstrap.sh')
+        bootstrap_arguments = []
+        if reset_env:
+            bootstrap_arguments.append('--reset-env')
+        if reset_conda:
+            bootstrap_arguments.append('--reset-conda')
+        bootstrap_arguments.append('--')
+        bootstrap_arguments.extend(args)
+        subprocess.check_call(_command(bootstrap_path, *bootstrap_arguments),
+                              cwd=target_path, **redirect)
+
+
+def _env_inputs_hash(target_path, mode):
+    """Hash of `mode` (pipenv or hatch) env dependency inputs."""
+    digest = hashlib.sha256(mode.encode('utf-8'))
+    for name in ENV_INPUT_FILES:
+        path = os.path.join(target_path, name)
+        digest.update(b'\0' + name.encode('utf-8') + b'\0')
+        if os.path.exists(path):
+            with io.open(path, 'rb') as f:
+                digest.update(f.read())
+        else:
+            digest.update(b'-')
+    return digest.hexdigest()
+
+
+def _env_state_path(target_path):
+    """State file path; None if working copy has no .git folder."""
+    git_dir = os.path.join(target_path, '.git')
+    if not os.path.isdir(git_dir):
+        return None
+    return os.path.join(git_dir, ENV_STATE_FILE)
+
+
+def _env_state_venv(target_path, mode):
+    """Virtualenv path of the last `mode` env install if its inputs did not
+    change since, None otherwise."""
+    path = _env_state_path(target_path)
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with io.open(path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except ValueError:
+        return None
+    if state.get('mode') != mode \
+            or state.get('inputs') != _env_inputs_hash(target_path, mode) \
+            or not os.path.isdir(os.path.join(state.get('venv', ''), 'bin')):
+        return None
+    return state['venv']
+
+
+def _env_state_write(target_path, mode, venv):
+    """Record a successful `mode` env install in virtualenv `venv`. Inputs
+    are hashed after install, as pipenv may write Pipfile.lock."""
+    path = _env_state_path(target_path)
+    if path is None:
+        return
+    state = {'mode': mode, 'inputs': _env_inputs_hash(target_path, mode),
+             'venv': venv.strip()}
+    with io.open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(json.dumps(state, indent=2, sort_keys=True))
+    os.rename(path + '.tmp', path)
+
+
+def _env_state_clear(target_path):
+    """Forget last env install (env is about to be reset or rebuilt)."""
+    path = _env_state_path(target_path)
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+
+
+def _hatch_run_needed(target_path, args):
+    """Return True if hatch run would not run `args` as a plain command in
+    the env virtualenv: `args` is a hatch script (pyproject.toml or
+    hatch.toml), an ENV:SCRIPT, an env sets env-vars or config cannot be
+    read (no tomllib)."""
+    if not args:
+        return False
+    if ':' in args[0]:
+        return True
+    try:
+        import tomllib
+    except ImportError:
+        return True
+    scripts = set()
+    for name, keys in (('pyproject.toml', ('tool', 'hatch', 'envs')),
+                       ('hatch.toml', ('envs',))):
+        path = os.path.join(target_path, name)
+        if not os.path.exists(path):
+            continue
+        with io.open(path, 'rb') as f:
+            try:
+                envs = tomllib.load(f)
+            except ValueError:
+                return True
+        for key in keys:
+            envs = envs.get(key, {})
+        for env in envs.values():
+            if env.get('env-vars'):
+                return True
+            scripts.update(env.get('scripts', {}))
+    return args[0] in scripts
+
+
+def _venv_run(venv, args, target_path, output=None):
+    """Run plain command `args` in virtualenv `venv`, as hatch run would,
+    without hatch startup and env sync."""
+    if not args:
+        _log('No command to run.')
+        return
+    env = dict(os.environ)
+    env.pop('PYTHONHOME', None)
+    env['VIRTUAL_ENV'] = venv
+    env['PATH'] = os.pathsep.join([os.path.join(venv, 'bin'),
+                                   env.get('PATH', os.defpath)])
+    _log('Running {0} in {1}.'.format(' '.join(args), venv))
+    subprocess.check_call(args, cwd=target_path, env=env,
+                          **_redirect(output))
+
+
+def _read_manifest(path):
+    """Read a manifest file: one repository per line, 'GIT_URL [REF [ARGS]]'
+    ('-' as REF for remote default branch); empty lines and # comments
+    are ignored. Return a list of (git_url, ref, args)."""
+    repositories = []
+    with io.open(os.path.expanduser(path), 'r', encoding='utf-8') as f:
+        for line in f:
+            items = shlex.split(line, comments=True)
+            if not items:
+                continue
+            ref = items[1] if len(items) > 1 and items[1] != '-' else None
+            repositories.append((items[0], ref, items[2:]))
+    return repositories
+
+
+def _bootstrap_manifest(manifest, repository_path, jobs=DEFAULT_JOBS,
+                        env_jobs=DEFAULT_ENV_JOBS, log_dir=None, **kwargs):
+    """Bootstrap repositories listed in `manifest` file (see _read_manifest).
+    At most `jobs` repositories run git steps and `env_jobs` run env phase
+    at once, so that clones and fetches overlap env builds. Output of each
+    repository commands is written in `log_dir`/NAME.log (default:
+    `repository_path`/.bootstrap-logs). Other arguments are passed to
+    _bootstrap. Print a summary and return a list of (git_url, error),
+    error being None on success."""
+    repositories = _read_manifest(manifest)
+    if log_dir is None:
+        log_dir = os.path.join(repository_path, '.bootstrap-logs')
+    log_dir = os.path.expanduser(log_dir)
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    git_lock = threading.Semaphore(max(1, jobs))
+    env_lock = threading.Semaphore(max(1, env_jobs))
+    pending = list(enumerate(repositories))
+    results = [None] * len(repositories)
+    pending_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with pending_lock:
+                if not pending:
+                    return
+                index, (git_url, ref, args) = pending.pop(0)
+            name = os.path.basename(_target_path(repository_path, git_url))
+            _log_context.label = name
+            log_path = os.path.join(log_dir, '{0}.log'.format(name))
+            start = time.time()
+            error = None
+            try:
+                with io.open(log_path, 'wb') as output:
+                    _bootstrap(git_url=git_url, repository_path=repository_path,
+                               ref=ref, args=args, git_lock=git_lock,
+                               env_lock=env_lock, output=output, **kwargs)
+            except Exception as e:
+                error = e
+                _log('{0} (see {1})'.format(e, log_path), level='ERROR')
+            results[index] = (name, git_url, error, time.time() - start,
+                              log_path)
+
+    # workers beyond git slots start env phases while others fetch
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(jobs + env_jobs, len(repositories))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    failures = [i for i in results if i[2] is not None]
+    _log('Manifest done: {0} succeeded, {1} failed.'.format(
+        len(results) - len(failures), len(failures)))
+    for name, git_url, error, duration, log_path in results:
+        if error is None:
+            _log('  {0}: ok ({1:.1f}s)'.format(name, duration))
+        else:
+            _log('  {0}: failed ({1:.1f}s, {2})'.format(name, duration,
+                                                        log_path),
+                 level='ERROR')
+    return [(git_url, error) for _, git_url, error, _, _ in results]
+
+
 def _command(command, *args):
     """Build command path (prefix + /bin/ + command) and return a command
     list [command, *args] that can be used by subprocess API."""
@@ -128,9 +637,29 @@ def _parser():
     default_git_url = os.getenv('BOOTSTRAP_GIT_URL', None)
     # git checkout ref
     default_ref = os.getenv('BOOTSTRAP_REF', None)
+    # host level mirrors cache
+    default_reference_cache = os.getenv('BOOTSTRAP_REFERENCE_CACHE', None)
     cmd = argparse.ArgumentParser(description=COMMAND_DESCRIPTION)
-    cmd.add_argument('git_url', default=default_git_url,
+    cmd.add_argument('git_url', nargs='?', default=default_git_url,
                      help='Repository git url.')
+    cmd.add_argument('--manifest',
+                     dest='manifest', default=None,
+                     help='File listing GIT_URL [REF [ARGS...]] repositories '
+                          'to bootstrap (git_url, --ref and args are '
+                          'ignored).')
+    cmd.add_argument('--jobs', dest='jobs', type=int, default=DEFAULT_JOBS,
+                     help='Count of repositories running git steps at once '
+                          '(--manifest).')
+    cmd.add_argument('--env-jobs', dest='env_jobs', type=int,
+                     default=DEFAULT_ENV_JOBS,
+                     help='Count of repositories installing their env at '
+                          'once (--manifest); env installs sharing a conda '
+                          'package cache (--pkgs-dir) with other conda '
+                          'installations run one at a time.')
+    cmd.add_argument('--log-dir', dest='log_dir', default=None,
+                     help='Folder for commands output of each repository '
+                          '(--manifest; default: '
+                          'REPOSITORY_PATH/.bootstrap-logs).')
     cmd.add_argument('--repository-path',
                      dest='repository_path',
                      default=default_repository_path,
@@ -153,6 +682,18 @@ def _parser():
     cmd.add_argument('--reset-hatch',
                      dest='reset_hatch', action='store_true', default=False,
                      help='Remove hatch installation.')
+    cmd.add_argument('--depth', dest='depth', type=int, default=None,
+                     help='Shallow clone with this history depth.')
+    cmd.add_argument('--filter', dest='clone_filter', default=None,
+                     help='Partial clone filter (blob:none for blobless, '
+                          'tree:0 for treeless clones).')
+    cmd.add_argument('--reference-cache', dest='reference_cache',
+                     default=default_reference_cache,
+                     help='Folder of repository mirrors shared by clones '
+                          '(ex: ~/.cache/clickable_bootstrap/git).')
+    cmd.add_argument('--submodule-jobs', dest='submodule_jobs', type=int,
+                     default=DEFAULT_SUBMODULE_JOBS,
+                     help='Count of submodules updated at once.')
     cmd.add_argument('--git-command',
                      dest='git_command', default=default_git_command,
                      help='Path for git command.')
@@ -160,6 +701,24 @@ def _parser():
     return cmd
 
 
+def _main(argv=None):
+    parser = _parser()
+    args = vars(parser.parse_args(argv))
+    manifest = args.pop('manifest')
+    jobs = args.pop('jobs')
+    env_jobs = args.pop('env_jobs')
+    log_dir = args.pop('log_dir')
+    if manifest is None:
+        if args['git_url'] is None:
+            parser.error('git_url or --manifest is required')
+        _bootstrap(**args)
+        return 0
+    for key in ('git_url', 'ref', 'args'):
+        del args[key]
+    results = _bootstrap_manifest(manifest, jobs=jobs, env_jobs=env_jobs,
+                                  log_dir=log_dir, **args)
+    return 1 if [i for i in results if i[1] is not None] else 0
+
+
 if __name__ == '__main__':
-    args = _parser().parse_args()
-    _bootstrap(**vars(args))
+    sys.exit(_main())
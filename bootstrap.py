@@ -5,18 +5,22 @@
 from __future__ import print_function, unicode_literals
 
 import argparse
+import collections
+import contextlib
+import fcntl
+import hashlib
 import io
+import json
 import logging
 import os
 import os.path
 import shlex
 import re
-import shutil
 import stat
 import subprocess
 import sys
-import tempfile
-import traceback
+import threading
+import time
 
 
 COMMAND_DESCRIPTION = """
@@ -30,6 +34,39 @@ ENV_BOOTSTRAP_CONDA_PREFIX = 'BOOTSTRAP_CONDA_PREFIX'
 ENV_BOOTSTRAP_PROFILE_DIR = 'BOOTSTRAP_PROFILE_DIR'
 ENV_BOOTSTRAP_COMMAND = 'BOOTSTRAP_COMMAND'
 ENV_BOOTSTRAP_PATH = 'BOOTSTRAP_PATH'
+ENV_BOOTSTRAP_CACHE_DIR = 'BOOTSTRAP_CACHE_DIR'
+ENV_BOOTSTRAP_CACHE_SIZE = 'BOOTSTRAP_CACHE_SIZE'
+#: default location for downloaded files cache
+DEFAULT_CACHE_DIR = '~/.cache/clickable_bootstrap'
+#: default size budget (MiB) for downloaded files cache
+DEFAULT_CACHE_SIZE = 1024
+ENV_BOOTSTRAP_DOWNLOADER = 'BOOTSTRAP_DOWNLOADER'
+ENV_BOOTSTRAP_DOWNLOAD_JOBS = 'BOOTSTRAP_DOWNLOAD_JOBS'
+ENV_BOOTSTRAP_JOBS = 'BOOTSTRAP_JOBS'
+ENV_BOOTSTRAP_BACKEND = 'BOOTSTRAP_BACKEND'
+ENV_BOOTSTRAP_PKGS_DIR = 'BOOTSTRAP_PKGS_DIR'
+ENV_BOOTSTRAP_LOG_FILE = 'BOOTSTRAP_LOG_FILE'
+ENV_BOOTSTRAP_LOG_FORMAT = 'BOOTSTRAP_LOG_FORMAT'
+ENV_BOOTSTRAP_REGISTRY = 'BOOTSTRAP_REGISTRY'
+ENV_BOOTSTRAP_OFFLINE = 'BOOTSTRAP_OFFLINE'
+ENV_BOOTSTRAP_INSTALLER = 'BOOTSTRAP_INSTALLER'
+ENV_BOOTSTRAP_WHEEL_DIR = 'BOOTSTRAP_WHEEL_DIR'
+ENV_BOOTSTRAP_CHANNEL_MIRROR = 'BOOTSTRAP_CHANNEL_MIRROR'
+#: default location of envs registry (empty BOOTSTRAP_REGISTRY disables it)
+DEFAULT_REGISTRY = '~/.cache/clickable_bootstrap/registry.json'
+#: default count of envs bootstrapped in parallel in batch mode
+DEFAULT_JOBS = 4
+#: default count of parallel ranges for downloads
+DEFAULT_DOWNLOAD_JOBS = 4
+#: files are not split in ranges smaller than this size
+DOWNLOAD_MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+#: retries for each range before download is aborted
+DOWNLOAD_RETRIES = 3
+#: socket timeout (seconds) for downloads
+DOWNLOAD_TIMEOUT = 60
+#: lines of captured command output kept for error messages
+OUTPUT_TAIL_LINES = 50
 
 
 # from https://stackoverflow.com/questions/384076/how-can-i-color-python-logging-output
@@ -95,25 +132,187 @@ def _initLogger():
     logging.getLogger('stdout').propagate = False
 
 
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, for log shippers."""
+
+    def format(self, record):
+        data = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, sort_keys=True)
+
+
+def _json_logs():
+    """Switch terminal log output to JSON lines."""
+    for handler in logging.root.handlers:
+        if isinstance(handler, CustomStreamHandler):
+            handler.setFormatter(JsonFormatter())
+
+
 class Logger(object):
     def __init__(self):
-        pass
+        # caller name -> logger; avoids logging module lock on each call
+        self._loggers = {}
 
     def __getattr__(self, name):
         try:
-            # extract caller method name
-            logger_name = traceback.extract_stack()[-2][2]
+            # extract caller method name; only caller frame is inspected
+            logger_name = sys._getframe(1).f_code.co_name
         except:
             logger_name = "none"
-        return getattr(logging.getLogger(logger_name), name)
+        try:
+            caller_logger = self._loggers[logger_name]
+        except KeyError:
+            caller_logger = self._loggers.setdefault(
+                logger_name, logging.getLogger(logger_name))
+        return getattr(caller_logger, name)
 
 
 stdout = logging.getLogger('stdout')
 logger = Logger()
 
+#: file (opened by _open_log_file) receiving whole output of commands
+_log_file = None
+_log_file_lock = threading.Lock()
+
+
+def _open_log_file(path):
+    """Append whole output of commands to 'path' (None to stop)."""
+    global _log_file
+    if _log_file is not None:
+        _log_file.close()
+    _log_file = None
+    if path:
+        _log_file = io.open(os.path.expanduser(path), 'ab')
+
+
+def _tee(line):
+    """Append 'line' (bytes) to log file if any."""
+    if _log_file is not None:
+        with _log_file_lock:
+            _log_file.write(line)
+            _log_file.flush()
+
+
+#: timing report (see _report_start); None when disabled
+_report = None
+_report_lock = threading.Lock()
+#: per-thread report context: env name and stack of running phases
+_report_context = threading.local()
+
+
+def _report_start():
+    """Start recording phases and commands timings."""
+    global _report
+    _report = {'version': 1, 'argv': sys.argv[1:], 'start': time.time(),
+               'phases': [], 'commands': []}
+
+
+def _report_write(path):
+    """Write recorded timings as JSON in 'path' and stop recording."""
+    global _report
+    report, _report = _report, None
+    report['duration'] = time.time() - report['start']
+    failed = [i for i in report['phases'] if i['status'] == 'failed']
+    report['status'] = 'failed' if failed else 'ok'
+    _write_json(os.path.abspath(os.path.expanduser(path)), report)
+
+
+def _report_add(kind, entry):
+    if _report is not None:
+        with _report_lock:
+            _report[kind].append(entry)
+
+
+def _current_phase():
+    phases = getattr(_report_context, 'phases', None)
+    return phases[-1] if phases else None
+
+
+@contextlib.contextmanager
+def _phase(name):
+    """Time enclosed block as phase 'name' (nested in current phase). The
+    block may call _skip to record why its work is not needed."""
+    parent = _current_phase()
+    entry = {'name': name, 'env': getattr(_report_context, 'env', None),
+             'parent': parent['name'] if parent else None,
+             'status': 'ok', 'reason': None}
+    if parent is None:
+        _report_context.phases = []
+    _report_context.phases.append(entry)
+    start = time.time()
+    try:
+        yield entry
+    except Exception:
+        entry['status'] = 'failed'
+        raise
+    finally:
+        entry['start'] = start
+        entry['duration'] = time.time() - start
+        _report_context.phases.pop()
+        _report_add('phases', entry)
+
+
+def _skip(reason):
+    """Record that work of current phase is skipped because of 'reason'."""
+    entry = _current_phase()
+    if entry is not None:
+        entry['status'] = 'skipped'
+        entry['reason'] = reason
+
+
+@contextlib.contextmanager
+def _command_timing(args):
+    """Time command 'args' run in enclosed block; the block sets
+    'returncode' of yielded entry, or raises CalledProcessError."""
+    phase = _current_phase()
+    entry = {'command': _command_line(args),
+             'env': getattr(_report_context, 'env', None),
+             'phase': phase['name'] if phase else None, 'returncode': None}
+    start = time.time()
+    try:
+        yield entry
+    except subprocess.CalledProcessError as e:
+        entry['returncode'] = e.returncode
+        raise
+    finally:
+        entry['start'] = start
+        entry['duration'] = time.time() - start
+        _report_add('commands', entry)
+
+
+def _command_line(args):
+    if isinstance(args, (list, tuple)):
+        return ' '.join([shlex.quote(i) for i in args])
+    return args
+
+
+def _pump_output(process, forward, tail=None):
+    """Read merged output of 'process' line by line, pass each line (bytes)
+    to 'forward' and to log file; wait for process end and return
+    (returncode, output) where output holds the last 'tail' lines
+    (all lines if tail is None)."""
+    lines = collections.deque(maxlen=tail)
+    for line in iter(process.stdout.readline, b''):
+        _tee(line)
+        forward(line)
+        lines.append(line)
+    process.stdout.close()
+    process.wait()
+    output = b''.join(lines).decode('utf-8', 'replace')
+    if tail is not None and len(lines) == tail:
+        output = '[...]\n' + output
+    return (process.returncode, output)
+
 
 def _run(args, **subprocess_args):
     """Run a command, with stdout and stderr connected to the current terminal.
+    When output is logged to a file, stderr is merged in stdout.
     """
     # python2.6: isEnabledFor not available
     debug = logging.root.getEffectiveLevel() == logging.DEBUG
@@ -127,39 +326,464 @@ def _run(args, **subprocess_args):
                                 for k, v in env.items()])
             logger.debug('env:%s', env_str)
     # call command
-    subprocess.check_call(args, **subprocess_args)
+    with _command_timing(args) as timing:
+        if _log_file is None:
+            subprocess.check_call(args, **subprocess_args)
+            timing['returncode'] = 0
+            return
+        _tee('$ {0}\n'.format(_command_line(args)).encode('utf-8'))
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+
+        def forward(line):
+            out.write(line)
+            out.flush()
+        process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, **subprocess_args)
+        (returncode, output) = _pump_output(process, forward, tail=0)
+        timing['returncode'] = returncode
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args)
+
+
+def _http_open(url, start=None, end=None):
+    """Open 'url' (any scheme handled by urllib), optionally restricted to
+    the [start, end] bytes range."""
+    # urllib pulls http/ssl modules; only import them when downloading
+    try:
+        from urllib.request import Request, urlopen
+    except ImportError:
+        # python2
+        from urllib2 import Request, urlopen
+    request = Request(url)
+    if start is not None:
+        request.add_header('Range', 'bytes={0}-{1}'.format(start, end))
+    return urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+
+
+def _range_info(response):
+    """Return (size, validator) if 'response' is a partial content response,
+    (None, None) otherwise."""
+    content_range = response.info().get('Content-Range')
+    if response.getcode() != 206 or not content_range:
+        return (None, None)
+    # bytes 0-0/12345
+    size = content_range.rpartition('/')[2]
+    if not size.isdigit():
+        return (None, None)
+    validator = response.info().get('ETag') or \
+        response.info().get('Last-Modified')
+    return (int(size), validator)
+
+
+class _RangeProgress(object):
+    """Track progress of a ranged download.
+
+    Segments are [start, end, done] lists shared with worker threads.
+    Progress is saved in a state file so that an interrupted download can
+    be resumed, and digest is fed with the contiguous downloaded prefix of
+    the file while other segments are still downloading."""
+
+    def __init__(self, path, state, digest):
+        self.path = path
+        self.state_path = path + '.state'
+        self.state = state
+        self.digest = digest
+        self.lock = threading.Lock()
+        self.received = 0
+        self.hashed = 0
+        self.saved = time.time()
+
+    def update(self, segment, count):
+        with self.lock:
+            segment[2] += count
+            self.received += count
+            if self.digest is not None:
+                self._hash()
+            if time.time() - self.saved > 1:
+                self.save()
+
+    def finish(self):
+        with self.lock:
+            if self.digest is not None:
+                self._hash()
+
+    def save(self):
+        _write_json(self.state_path, self.state)
+        self.saved = time.time()
+
+    def _hash(self):
+        frontier = self.state['size']
+        for start, end, done in self.state['segments']:
+            if done < end - start + 1:
+                frontier = start + done
+                break
+        if frontier <= self.hashed:
+            return
+        # bytes were just written; they are read back from page cache
+        with io.open(self.path, 'rb') as f:
+            f.seek(self.hashed)
+            remaining = frontier - self.hashed
+            while remaining > 0:
+                chunk = f.read(min(remaining, DOWNLOAD_CHUNK_SIZE))
+                self.digest.update(chunk)
+                remaining -= len(chunk)
+        self.hashed = frontier
+
+
+def _fetch_segment(url, path, segment, progress, retries):
+    """Download segment [start, end, done] of 'url' in 'path', resuming
+    from 'done' and retrying up to 'retries' times."""
+    start, end = segment[0], segment[1]
+    failures = 0
+    with io.open(path, 'r+b') as f:
+        while segment[2] < end - start + 1:
+            try:
+                response = _http_open(url, start + segment[2], end)
+                if response.getcode() != 206:
+                    raise Exception('Range request not honored')
+                f.seek(start + segment[2])
+                for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    f.write(chunk)
+                    f.flush()
+                    progress.update(segment, len(chunk))
+                response.close()
+                if segment[2] < end - start + 1:
+                    raise Exception('Connection closed before end of range')
+            except Exception as e:
+                failures += 1
+                if failures > retries:
+                    raise
+                logger.warning('Retrying range %d-%d of %s: %s',
+                               start + segment[2], end, url, e)
+
+
+def _stream(response, path, digest):
+    """Copy the whole 'response' body in 'path'; return copied bytes count."""
+    received = 0
+    with io.open(path, 'wb') as f:
+        for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b''):
+            f.write(chunk)
+            if digest is not None:
+                digest.update(chunk)
+            received += len(chunk)
+    response.close()
+    # urllib does not report connections closed before the announced length
+    length = response.info().get('Content-Length') \
+        if hasattr(response, 'info') else None
+    if length is not None and int(length) != received:
+        raise Exception('Received {0} bytes out of {1}'.format(received, length))
+    return received
+
+
+def _fetch(url, path, jobs, digest=None, retries=None):
+    """Download 'url' in 'path' with up to 'jobs' parallel byte ranges and
+    return the count of bytes received.
+
+    Progress is kept in 'path'.state: if a previous download of the same
+    content was interrupted, only missing ranges are fetched. Servers
+    without range support are read with a single request."""
+    state_path = path + '.state'
+    if retries is None:
+        retries = DOWNLOAD_RETRIES
+    try:
+        response = _http_open(url, 0, 0)
+    except Exception as e:
+        # 416: empty file
+        if getattr(e, 'code', None) != 416:
+            raise
+        response = _http_open(url)
+    (size, validator) = _range_info(response)
+    if size is None:
+        return _stream(response, path, digest)
+    response.close()
+    state = _read_json(state_path, None)
+    if not state or not os.path.exists(path) or state.get('url') != url \
+            or state.get('size') != size \
+            or state.get('validator') != validator:
+        count = max(1, min(jobs, size // DOWNLOAD_MIN_SEGMENT_SIZE))
+        length = size // count
+        segments = [[i * length, (i + 1) * length - 1, 0]
+                    for i in range(count)]
+        segments[-1][1] = size - 1
+        state = {'url': url, 'size': size, 'validator': validator,
+                 'segments': segments}
+        with io.open(path, 'wb') as f:
+            f.truncate(size)
+    else:
+        logger.info('Resuming download of %s', url)
+    progress = _RangeProgress(path, state, digest)
+    errors = []
+
+    def worker(segment):
+        try:
+            _fetch_segment(url, path, segment, progress, retries)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(segment,))
+               for segment in state['segments']]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        progress.save()
+        raise errors[0]
+    progress.finish()
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    return progress.received
+
+
+def _curl_fetch(url, path, digest=None):
+    """Download 'url' in 'path' with curl; return copied bytes count."""
+    # python2.6: isEnabledFor not available
+    debug = logger.getEffectiveLevel() == logging.DEBUG
+    # -L follow redirect; content is streamed on stdout
+    args = ['curl', '-L', '-v' if debug else None, url]
+    args = [i for i in args if i]
+    if debug:
+        logger.debug(' '.join([shlex.quote(i) for i in args]))
+    p = subprocess.Popen(args, stdout=subprocess.PIPE)
+    received = _stream(p.stdout, path, digest)
+    if p.wait() != 0:
+        raise subprocess.CalledProcessError(p.returncode, args)
+    return received
 
 
-def _download(url, _tmpdir=None):
+def _download(url, _tmpdir=None, digest=None, jobs=None, partial_path=None,
+              stats=None):
     """Download a file and return tuple of (fd, abspath).
     Caller is responsible for deleting file.
     Exception if download cannot be performed.
 
+    File is fetched with 'jobs' parallel ranges when server allows it
+    (BOOTSTRAP_DOWNLOAD_JOBS by default). If partial_path is provided,
+    download is done in this file that is kept on failure, so that a
+    later call resumes the transfer. If BOOTSTRAP_DOWNLOADER is 'curl',
+    curl command is used instead.
+
+    If digest (a hashlib object) is provided, it is updated with the
+    content while it is downloaded. If stats (a dict) is provided, it is
+    filled with 'bytes' and 'seconds' of the transfer.
+
     _tmpdir argument is intended for testing purpose.
     """
+    import tempfile
     # Miniconda script raise an error if script is not called something.sh
     (handle, abspath) = tempfile.mkstemp(prefix='bootstrap', suffix='.sh',
                                          dir=_tmpdir)
     os.close(handle)
+    if jobs is None:
+        jobs = int(os.getenv(ENV_BOOTSTRAP_DOWNLOAD_JOBS,
+                             DEFAULT_DOWNLOAD_JOBS))
     # python2.6: isEnabledFor not available
     debug = logger.getEffectiveLevel() == logging.DEBUG
+    started = time.time()
     try:
-        # -L follow redirect
-        args = ['curl', '-L', '-v' if debug else None, '-o', abspath, url]
-        args = [i for i in args if i]
-        _run(args)
+        if os.getenv(ENV_BOOTSTRAP_DOWNLOADER, None) == 'curl':
+            received = _curl_fetch(url, abspath, digest)
+        elif partial_path is None:
+            received = _fetch(url, abspath, jobs, digest)
+        else:
+            if not os.path.isdir(os.path.dirname(partial_path)):
+                os.makedirs(os.path.dirname(partial_path))
+            with _file_lock(partial_path + '.lock'):
+                received = _fetch(url, partial_path, jobs, digest)
+                os.rename(partial_path, abspath)
     except Exception as e:
         if not debug:
-            try:
-                os.remove(abspath)
-            except Exception:
-                logger.error('Failing to delete %s', abspath)
+            for path in (abspath, abspath + '.state'):
+                if not os.path.exists(path):
+                    continue
+                try:
+                    os.remove(path)
+                except Exception:
+                    logger.error('Failing to delete %s', path)
         else:
             logger.debug('Keeping file %s', abspath)
         raise Exception('Failed to download {0}. {1}'.format(url, str(e)))
+    seconds = max(time.time() - started, 1e-6)
+    logger.debug('Downloaded %d bytes from %s in %.2fs', received, url,
+                 seconds)
+    if stats is not None:
+        stats.update({'bytes': received, 'seconds': seconds})
     return (handle, abspath)
 
 
+def _log_throughput(url, stats):
+    """Log achieved throughput of a download made with _download."""
+    logger.info('Downloaded %s: %.1f MiB in %.1fs (%.1f MiB/s)', url,
+                stats['bytes'] / 1048576.0, stats['seconds'],
+                stats['bytes'] / 1048576.0 / stats['seconds'])
+
+
+@contextlib.contextmanager
+def _file_lock(path, wait_message=None, shared=False):
+    """Hold an exclusive (or shared if shared=True) lock on 'path' (created
+    if missing) while the context is active. 'wait_message' is logged if
+    lock is already held."""
+    mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    with io.open(path, 'ab') as f:
+        try:
+            fcntl.flock(f.fileno(), mode | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            if wait_message is not None:
+                logger.info(wait_message)
+            fcntl.flock(f.fileno(), mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _write_json(path, data):
+    """Atomically replace 'path' with 'data' serialized as JSON."""
+    # tempfile pulls random and shutil; only import it when writing
+    import tempfile
+    (handle, tmp_path) = tempfile.mkstemp(prefix='.bootstrap',
+                                          dir=os.path.dirname(path))
+    try:
+        with io.open(handle, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(data, indent=2, sort_keys=True))
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _write_if_changed(path, content):
+    """Atomically replace 'path' with 'content' (text) unless it already
+    holds it, so that unchanged files keep their mtime. Return True if
+    'path' was written."""
+    try:
+        with io.open(path, 'r', encoding='utf-8') as f:
+            if f.read() == content:
+                return False
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except (IOError, OSError):
+        mode = 0o644
+    import tempfile
+    (handle, tmp_path) = tempfile.mkstemp(
+        prefix='.bootstrap', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with io.open(handle, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return True
+
+
+def _read_json(path, default):
+    """Load JSON content of 'path'; return 'default' if file is missing or
+    unreadable."""
+    try:
+        with io.open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def _cache_object_path(cache_dir, sha256, url):
+    """Path of a cached file; the url extension is kept (Miniconda script
+    must be called something.sh)."""
+    extension = os.path.splitext(url.rstrip('/'))[1]
+    return os.path.join(cache_dir, 'objects', sha256 + extension)
+
+
+def _cache_evict(cache_dir, index, max_size, keep=None):
+    """Remove least recently used objects from 'index' until cache size
+    fits in 'max_size' bytes. 'keep' object is never removed."""
+    objects = index['objects']
+    total = sum([i['size'] for i in objects.values()])
+    for sha256 in sorted(objects, key=lambda k: objects[k]['atime']):
+        if total <= max_size:
+            break
+        if sha256 == keep:
+            continue
+        entry = objects.pop(sha256)
+        total -= entry['size']
+        logger.info("Evicting %s from cache", entry['url'])
+        try:
+            os.remove(_cache_object_path(cache_dir, sha256, entry['url']))
+        except OSError:
+            logger.warning("Failing to delete cached %s", sha256)
+        for url in [u for u, s in index['urls'].items() if s == sha256]:
+            del index['urls'][url]
+
+
+def _cache_lookup(url, cache_dir, sha256=None):
+    """Return path of the cached copy of 'url' (or of content 'sha256' if
+    provided) and refresh its access time; None on cache miss."""
+    cache_dir = os.path.expanduser(cache_dir)
+    index_path = os.path.join(cache_dir, 'index.json')
+    if not os.path.isfile(index_path):
+        return None
+    with _file_lock(os.path.join(cache_dir, '.lock')):
+        index = _read_json(index_path, {'urls': {}, 'objects': {}})
+        key = sha256 or index['urls'].get(url)
+        entry = index['objects'].get(key)
+        if entry is None:
+            return None
+        path = _cache_object_path(cache_dir, key, entry['url'])
+        if not os.path.isfile(path) or \
+                os.path.getsize(path) != entry['size']:
+            return None
+        entry['atime'] = time.time()
+        index['urls'][url] = key
+        _write_json(index_path, index)
+        return path
+
+
+def _cached_download(url, cache_dir, max_size, sha256=None):
+    """Return path of a cached copy of 'url', downloading it on cache miss.
+
+    Cache content is addressed by sha256 of files; an index maps urls to
+    their last known content and keeps access times for LRU eviction
+    once 'max_size' bytes are exceeded. When 'sha256' is provided, the
+    downloaded content must match it.
+    Returned file belongs to the cache and must not be deleted by caller.
+    """
+    cache_dir = os.path.expanduser(cache_dir)
+    objects_dir = os.path.join(cache_dir, 'objects')
+    if not os.path.isdir(objects_dir):
+        os.makedirs(objects_dir)
+    index_path = os.path.join(cache_dir, 'index.json')
+    lock_path = os.path.join(cache_dir, '.lock')
+    empty_index = {'urls': {}, 'objects': {}}
+    path = _cache_lookup(url, cache_dir, sha256=sha256)
+    if path is not None:
+        logger.info("Using cached %s", url)
+        return path
+    # cache miss: download is done without holding the lock
+    digest = hashlib.sha256()
+    stats = {}
+    partial_path = os.path.join(
+        cache_dir, 'partial',
+        hashlib.sha1(url.encode('utf-8')).hexdigest())
+    (_, tmp_path) = _download(url, _tmpdir=objects_dir, digest=digest,
+                              partial_path=partial_path, stats=stats)
+    _log_throughput(url, stats)
+    key = digest.hexdigest()
+    if sha256 is not None and key != sha256:
+        os.remove(tmp_path)
+        raise Exception('Checksum mismatch for {0}: expected {1}, got {2}'
+                        .format(url, sha256, key))
+    path = _cache_object_path(cache_dir, key, url)
+    os.rename(tmp_path, path)
+    with _file_lock(lock_path):
+        index = _read_json(index_path, empty_index)
+        index['urls'][url] = key
+        index['objects'][key] = {'url': url, 'size': os.path.getsize(path),
+                                 'atime': time.time()}
+        _cache_evict(cache_dir, index, max_size, keep=key)
+        _write_json(index_path, index)
+    return path
+
+
 def _command(conda_prefix, command, *args):
     """Build command path (conda_prefix + /bin/ + command) and return a command
     list [command, *args] that can be used by subprocess API."""
@@ -168,10 +792,294 @@ def _command(conda_prefix, command, *args):
     return result
 
 
-def _prepare_conda(prefix, reset_conda):
-    """Prepare 'prefix' parent directories. Remove any existing installation
-    if reset_conda=True.
-    """
+#: conda compatible tools, in auto-detection preference order
+BACKENDS = ('mamba', 'micromamba', 'conda')
+_CONDA_COMMANDS = {
+    'list': ['list', '-n', '{name}'],
+    'create': ['create', '-n', '{name}', '-y'],
+    'install': ['env', 'update', '-n', '{name}', '--file', '{file}'],
+    'install_explicit': ['install', '-n', '{name}', '--file', '{file}', '-y'],
+    'lock': ['list', '--explicit', '--md5', '-n', '{name}'],
+    'remove': ['env', 'remove', '-n', '{name}', '-y'],
+    'clone': ['create', '-n', '{name}', '--clone', '{source}', '-y'],
+}
+#: backend -> operation -> command arguments
+BACKEND_COMMANDS = {
+    'conda': _CONDA_COMMANDS,
+    # mamba is a drop-in replacement of conda command line
+    'mamba': _CONDA_COMMANDS,
+    'micromamba': {
+        'list': ['list', '-r', '{prefix}', '-n', '{name}'],
+        'create': ['create', '-r', '{prefix}', '-n', '{name}', '-y'],
+        'install': ['install', '-r', '{prefix}', '-n', '{name}',
+                    '-f', '{file}', '-y'],
+        'install_explicit': ['install', '-r', '{prefix}', '-n', '{name}',
+                             '-f', '{file}', '-y'],
+        'lock': ['env', 'export', '-r', '{prefix}', '-n', '{name}',
+                 '--explicit', '--md5'],
+        'remove': ['env', 'remove', '-r', '{prefix}', '-n', '{name}', '-y'],
+    },
+}
+
+
+def _detect_backend(prefix, backend=None):
+    """Return backend to use for 'prefix': 'backend' if it is one of
+    BACKENDS, else the first one of BACKENDS installed in prefix (conda if
+    none is found)."""
+    if backend in BACKENDS:
+        if not os.path.exists(os.path.join(prefix, 'bin', backend)):
+            raise Exception("Backend {0} not found in {1}"
+                            .format(backend, prefix))
+        return backend
+    for candidate in BACKENDS:
+        if os.access(os.path.join(prefix, 'bin', candidate), os.X_OK):
+            return candidate
+    return 'conda'
+
+
+#: backend operations that may write in package cache
+PKGS_WRITE_OPERATIONS = ('create', 'install', 'install_explicit', 'clone')
+#: backend operations whose stdout is parsed
+FULL_OUTPUT_OPERATIONS = ('lock',)
+
+
+def _shared_pkgs_dir(prefix):
+    """Return first pkgs_dirs entry of prefix .condarc if it is a package
+    cache outside 'prefix' (see _configure_pkgs_dir), None otherwise."""
+    try:
+        with io.open(os.path.join(prefix, '.condarc'), 'r',
+                     encoding='utf-8') as f:
+            content = f.read()
+    except (IOError, OSError):
+        return None
+    match = re.search(r'^pkgs_dirs\s*:\s*\n\s+-\s*(\S+)', content, re.M)
+    if match is None:
+        return None
+    pkgs_dir = match.group(1).strip('"\'')
+    if os.path.join(pkgs_dir, '').startswith(os.path.join(prefix, '')):
+        return None
+    return pkgs_dir
+
+
+#: conda installations using a shared package cache, one per line; file
+#: kept in the package cache (see _pkgs_dir_prefixes)
+PKGS_PREFIXES_FILE = '.bootstrap-prefixes'
+
+
+def _pkgs_dir_prefixes(pkgs_dir):
+    """Return existing conda installations registered as users of shared
+    package cache 'pkgs_dir' (see _configure_pkgs_dir)."""
+    try:
+        with io.open(os.path.join(pkgs_dir, PKGS_PREFIXES_FILE), 'r',
+                     encoding='utf-8') as f:
+            return [i.strip() for i in f
+                    if i.strip() and os.path.isdir(i.strip())]
+    except (IOError, OSError):
+        return []
+
+
+def _register_pkgs_dir_prefix(pkgs_dir, prefix):
+    """Record conda installation 'prefix' as a user of 'pkgs_dir'."""
+    prefix = os.path.abspath(os.path.expanduser(prefix))
+    with _file_lock(os.path.join(pkgs_dir, PKGS_PREFIXES_FILE + '.lock')):
+        prefixes = _pkgs_dir_prefixes(pkgs_dir)
+        if prefix not in prefixes:
+            _write_if_changed(os.path.join(pkgs_dir, PKGS_PREFIXES_FILE),
+                              ''.join(i + '\n' for i in prefixes + [prefix]))
+
+
+def _configure_pkgs_dir(prefix, pkgs_dir):
+    """Make conda installation 'prefix' use the shared 'pkgs_dir' package
+    cache: it is set as pkgs_dirs in prefix .condarc, so that conda, mamba
+    and micromamba use it, including when run outside of bootstrap.
+    'prefix' is registered as a user of 'pkgs_dir' (see _backend_run)."""
+    pkgs_dir = os.path.abspath(os.path.expanduser(pkgs_dir))
+    if not os.path.isdir(pkgs_dir):
+        os.makedirs(pkgs_dir)
+    if _shared_pkgs_dir(prefix) == pkgs_dir:
+        _register_pkgs_dir_prefix(pkgs_dir, prefix)
+        return
+    condarc = os.path.join(prefix, '.condarc')
+    content = ''
+    if os.path.exists(condarc):
+        with io.open(condarc, 'r', encoding='utf-8') as f:
+            content = f.read()
+    if re.search(r'^pkgs_dirs\s*:', content, re.M):
+        logger.warning("%s already defines pkgs_dirs; shared package cache "
+                       "%s is not used", condarc, pkgs_dir)
+        return
+    logger.info("Using %s as shared package cache", pkgs_dir)
+    if content and not content.endswith('\n'):
+        content += '\n'
+    content += 'pkgs_dirs:\n  - {0}\n'.format(pkgs_dir)
+    _write_if_changed(condarc, content)
+    _register_pkgs_dir_prefix(pkgs_dir, prefix)
+
+
+#: channels of 'defaults', as mirrored by _mirror_main
+DEFAULT_CHANNELS = ('pkgs/main', 'pkgs/r')
+#: 'defaults' channels when default_channels is not configured
+ANACONDA_DEFAULT_CHANNELS = tuple('https://repo.anaconda.com/' + i
+                                  for i in DEFAULT_CHANNELS)
+
+
+def _configure_channel_mirror(prefix, url):
+    """Make channel names (ex: conda-forge) of conda installation 'prefix'
+    resolve to 'url'/NAME, a channel mirror (see _mirror_main): 'url' is
+    set as channel_alias in prefix .condarc, and 'defaults' channel is
+    set to mirrored DEFAULT_CHANNELS (channel_alias does not apply to
+    it)."""
+    if os.path.isabs(os.path.expanduser(url)):
+        url = 'file://' + os.path.abspath(os.path.expanduser(url))
+    condarc = os.path.join(prefix, '.condarc')
+    content = ''
+    if os.path.exists(condarc):
+        with io.open(condarc, 'r', encoding='utf-8') as f:
+            content = f.read()
+    line = 'channel_alias: {0}'.format(url)
+    if re.search(r'^channel_alias\s*:', content, re.M):
+        content = re.sub(r'^channel_alias\s*:.*$', line, content,
+                         flags=re.M)
+    else:
+        if content and not content.endswith('\n'):
+            content += '\n'
+        content += line + '\n'
+    block = 'default_channels:\n' + ''.join(
+        '  - {0}/{1}\n'.format(url.rstrip('/'), i) for i in DEFAULT_CHANNELS)
+    (content, count) = re.subn(
+        r'^default_channels\s*:.*\n(?:[ \t]+-.*(?:\n|$))*', block, content,
+        flags=re.M)
+    if count == 0:
+        content += block
+    if _write_if_changed(condarc, content):
+        logger.info("Using %s as channel mirror", url)
+
+
+def _channel_mirror(prefix):
+    """channel_alias of prefix .condarc, None if not set."""
+    try:
+        with io.open(os.path.join(prefix, '.condarc'), 'r',
+                     encoding='utf-8') as f:
+            content = f.read()
+    except (IOError, OSError):
+        return None
+    match = re.search(r'^channel_alias\s*:\s*(\S+)', content, re.M)
+    return match and match.group(1).strip('"\'')
+
+
+def _default_channels(prefix):
+    """Channels of 'defaults' for conda installation 'prefix': its .condarc
+    default_channels if set, ANACONDA_DEFAULT_CHANNELS otherwise."""
+    try:
+        with io.open(os.path.join(prefix, '.condarc'), 'r',
+                     encoding='utf-8') as f:
+            content = f.read()
+    except (IOError, OSError):
+        content = ''
+    match = re.search(r'^default_channels\s*:\s*\n((?:[ \t]+-.*(?:\n|$))+)',
+                      content, re.M)
+    if match is None:
+        return list(ANACONDA_DEFAULT_CHANNELS)
+    return [i.strip().lstrip('-').strip().strip('"\'')
+            for i in match.group(1).splitlines() if i.strip()]
+
+
+def _backend_command(prefix, backend, operation, **values):
+    """Build command list of 'operation' for 'backend' installed in
+    'prefix'; 'values' fill command arguments placeholders."""
+    values['prefix'] = prefix
+    args = [i.format(**values) for i in BACKEND_COMMANDS[backend][operation]]
+    return _command(prefix, backend, *args)
+
+
+#: environment variables set for backend commands only (ex: offline mode,
+#: see _offline_environ), not for BOOTSTRAP_COMMAND and user command
+_backend_environ = {}
+
+
+def _backend_run(prefix, backend, operation, **values):
+    """Run 'operation' of 'backend' (see _backend_command) and return
+    (returncode, output); output is stdout for FULL_OUTPUT_OPERATIONS, as
+    callers parse it (stderr is appended on failure), merged stdout and
+    stderr truncated to their last lines otherwise.
+
+    When 'prefix' uses a shared package cache, operations writing in it
+    lock the cache for their whole run, as conda offers no hook around its
+    download and extract steps. The lock is shared when 'prefix' is the
+    only registered user of the cache: parallel bootstraps of one prefix
+    run concurrently, as they do with prefix/pkgs. It is exclusive
+    otherwise, so that conda installations do not extract the same
+    packages concurrently: installs of several prefixes sharing a cache
+    run one at a time (trade-off of one download per package per host)."""
+    command = _backend_command(prefix, backend, operation, **values)
+    env = None
+    if _backend_environ:
+        env = dict(os.environ)
+        env.update(_backend_environ)
+    if operation in FULL_OUTPUT_OPERATIONS:
+        returncode, output, errors = _subprocess_stdout(command, env=env)
+        return (returncode, output if returncode == 0 else output + errors)
+    pkgs_dir = _shared_pkgs_dir(prefix)
+    if pkgs_dir is None or operation not in PKGS_WRITE_OPERATIONS:
+        return _subprocess_capture(command, env=env)
+    if not os.path.isdir(pkgs_dir):
+        os.makedirs(pkgs_dir)
+    shared = _pkgs_dir_prefixes(pkgs_dir) == \
+        [os.path.abspath(os.path.expanduser(prefix))]
+    with _file_lock(os.path.join(pkgs_dir, '.bootstrap.lock'),
+                    wait_message='Waiting for shared package cache lock',
+                    shared=shared):
+        return _subprocess_capture(command, env=env)
+
+
+#: folder (created in parent of deleted trees) receiving trees to delete
+TRASH_DIR = '.bootstrap-trash'
+#: delete trashed trees from a background process; synchronously if False
+REAP_IN_BACKGROUND = True
+
+
+def _reap(path):
+    """Delete 'path' tree from a detached process that outlives bootstrap;
+    return the process (None if REAP_IN_BACKGROUND is False)."""
+    if not REAP_IN_BACKGROUND:
+        import shutil
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+    with io.open(os.devnull, 'r+b') as devnull:
+        return subprocess.Popen(['rm', '-rf', '--', path], stdin=devnull,
+                                stdout=devnull, stderr=devnull,
+                                close_fds=True, preexec_fn=os.setsid)
+
+
+def _trash(path):
+    """Delete 'path' tree without waiting: it is atomically renamed in the
+    trash folder of its parent, then deleted in background, so that
+    'path' can be recreated at once. Return the reaper process."""
+    import tempfile
+    trash_dir = os.path.join(os.path.dirname(path), TRASH_DIR)
+    if not os.path.isdir(trash_dir):
+        os.makedirs(trash_dir)
+    trash_path = tempfile.mkdtemp(prefix=os.path.basename(path) + '.',
+                                  dir=trash_dir)
+    os.rename(path, os.path.join(trash_path, os.path.basename(path)))
+    return _reap(trash_path)
+
+
+def _reap_trash(parent):
+    """Delete in background trees left in trash folder of 'parent' by
+    interrupted reapers."""
+    trash_dir = os.path.join(parent, TRASH_DIR)
+    try:
+        names = os.listdir(trash_dir)
+    except OSError:
+        return
+    for name in names:
+        logger.debug("Deleting leftover %s", os.path.join(trash_dir, name))
+        _reap(os.path.join(trash_dir, name))
+
+
+def _prepare_parent(prefix):
+    """Create 'prefix' parent directories; return parent path."""
     prefix_parent = os.path.dirname(prefix)
     if not os.path.exists(prefix_parent):
         try:
@@ -179,10 +1087,34 @@ def _prepare_conda(prefix, reset_conda):
             os.makedirs(prefix_parent)
         except Exception:
             raise Exception("Error creating %s" % (prefix_parent,))
+    return prefix_parent
+
+
+def _prefix_lock(prefix):
+    """Return a lock to hold while 'prefix' is reset, installed and
+    configured, so that concurrent bootstraps of the same prefix (ex:
+    bootstrap-repository.py manifest mode) install it once. Lock file is
+    kept next to 'prefix' as it must outlive a reset."""
+    prefix = os.path.normpath(prefix)
+    lock_path = os.path.join(_prepare_parent(prefix),
+                             '.{0}.bootstrap.lock'.format(
+                                 os.path.basename(prefix)))
+    return _file_lock(lock_path, wait_message='Waiting for another '
+                      'bootstrap to prepare {0}'.format(prefix))
+
+
+def _prepare_conda(prefix, reset_conda):
+    """Prepare 'prefix' parent directories. Remove any existing installation
+    if reset_conda=True; removal is done in background.
+    """
+    prefix_parent = _prepare_parent(prefix)
+    # leftovers of previous resets
+    _reap_trash(prefix_parent)
+    _reap_trash(os.path.join(prefix, 'envs'))
     if reset_conda:
         if os.path.exists(prefix):
             logger.info("Destroying existing env %s", prefix)
-            shutil.rmtree(prefix)
+            _trash(prefix)
 
 
 def _skip_env_install(environment):
@@ -204,24 +1136,128 @@ def _skip_miniconda(prefix):
 
 
 def _subprocess_capture(*args, **kwargs):
-    try:
+    """Run a command and return (returncode, output), output being the last
+    'tail' lines (default OUTPUT_TAIL_LINES, None for whole output) of
+    merged stdout and stderr. Output lines are logged as they come in debug
+    mode, and appended to log file if any."""
+    tail = kwargs.pop('tail', OUTPUT_TAIL_LINES)
+    with _command_timing(args[0]) as timing:
+        try:
+            updated_kwargs = dict(kwargs.items())
+            updated_kwargs['stderr'] = subprocess.STDOUT
+            updated_kwargs['stdout'] = subprocess.PIPE
+            p = subprocess.Popen(*args, **updated_kwargs)
+        except OSError:
+            return
+        _tee('$ {0}\n'.format(_command_line(args[0])).encode('utf-8'))
+        # python2.6: isEnabledFor not available
+        debug = logger.getEffectiveLevel() == logging.DEBUG
+
+        def forward(line):
+            if debug:
+                logger.debug('%s',
+                             line.decode('utf-8', 'replace').rstrip('\n'))
+        result = _pump_output(p, forward, tail=tail)
+        timing['returncode'] = result[0]
+        return result
+
+
+def _subprocess_stdout(*args, **kwargs):
+    """Run a command whose output is parsed and return (returncode, stdout,
+    stderr): stderr (warnings...) is kept apart from stdout. Both are
+    logged like _subprocess_capture output."""
+    import tempfile
+    with _command_timing(args[0]) as timing, \
+            tempfile.TemporaryFile() as errors:
         updated_kwargs = dict(kwargs.items())
-        updated_kwargs['stderr'] = subprocess.STDOUT
+        updated_kwargs['stderr'] = errors
         updated_kwargs['stdout'] = subprocess.PIPE
         p = subprocess.Popen(*args, **updated_kwargs)
-        out = p.communicate()[0]
-        return (p.returncode, out)
-    except OSError:
-        pass
+        _tee('$ {0}\n'.format(_command_line(args[0])).encode('utf-8'))
+        # python2.6: isEnabledFor not available
+        debug = logger.getEffectiveLevel() == logging.DEBUG
 
+        def forward(line):
+            if debug:
+                logger.debug('%s',
+                             line.decode('utf-8', 'replace').rstrip('\n'))
+        (returncode, output) = _pump_output(p, forward, tail=None)
+        errors.seek(0)
+        stderr = errors.read()
+        for line in stderr.splitlines(True):
+            _tee(line)
+            forward(line)
+        timing['returncode'] = returncode
+        return (returncode, output, stderr.decode('utf-8', 'replace'))
+
+
+def _envs_registry():
+    """Return env paths listed in conda registry (~/.conda/environments.txt)."""
+    try:
+        with io.open(os.path.expanduser('~/.conda/environments.txt'), 'r',
+                     encoding='utf-8') as f:
+            return [i.strip() for i in f if i.strip()]
+    except (IOError, OSError):
+        return []
+
+
+#: user and system .condarc files read by conda (besides prefix one)
+CONDARC_FILES = ('/etc/conda/.condarc', '/etc/conda/condarc',
+                 '~/.config/conda/.condarc', '~/.config/conda/condarc',
+                 '~/.conda/.condarc', '~/.conda/condarc', '~/.condarc')
+
+
+def _custom_envs_dirs(prefix):
+    """Return True if envs of conda installation 'prefix' may be looked up
+    out of default envs dirs: envs_dirs set in a .condarc, or
+    CONDA_ENVS_PATH / CONDA_ENVS_DIRS set."""
+    if os.getenv('CONDA_ENVS_PATH') or os.getenv('CONDA_ENVS_DIRS'):
+        return True
+    condarcs = [os.path.join(prefix, '.condarc'),
+                os.path.join(prefix, 'condarc')] + \
+        [os.path.expanduser(i) for i in CONDARC_FILES]
+    if os.getenv('CONDARC'):
+        condarcs.append(os.path.expanduser(os.getenv('CONDARC')))
+    for condarc in condarcs:
+        try:
+            with io.open(condarc, 'r', encoding='utf-8') as f:
+                if re.search(r'^envs_dirs\s*:', f.read(), re.M):
+                    return True
+        except (IOError, OSError):
+            continue
+    return False
 
-def _env_exists(prefix, name):
-    """Check if environment named 'name' exists."""
+
+def _env_exists_fs(prefix, name):
+    """Check if environment named 'name' exists by inspecting the files of
+    conda installation 'prefix': prefix/envs/NAME and envs registered in
+    user envs dir. Return None if it cannot be told from files: 'prefix'
+    layout is not recognized, envs dirs are customized (see
+    _custom_envs_dirs) or env is not found."""
+    if not os.path.isdir(os.path.join(prefix, 'conda-meta')) \
+            or _custom_envs_dirs(prefix):
+        return None
+    if os.path.isdir(os.path.join(prefix, 'envs', name, 'conda-meta')):
+        return True
+    user_envs_dir = os.path.expanduser('~/.conda/envs')
+    for path in _envs_registry():
+        if os.path.basename(path) == name \
+                and os.path.dirname(path) == user_envs_dir \
+                and os.path.isdir(os.path.join(path, 'conda-meta')):
+            return True
+    return None
+
+
+def _env_exists(prefix, name, backend='conda'):
+    """Check if environment named 'name' exists. conda is only called if
+    files do not tell (see _env_exists_fs)."""
+    env_exists = _env_exists_fs(prefix, name)
+    if env_exists is not None:
+        return env_exists
     env_exists = False
     output = None
     # TODO: check env is deactivated before removal
-    returncode, output = _subprocess_capture(
-        _command(prefix, 'conda', 'list', '-n', name))
+    returncode, output = _backend_run(prefix, backend, 'list', name=name)
     if returncode != 0:
         # python2.6: isEnabledFor not available
         debug = logger.getEffectiveLevel() == logging.DEBUG
@@ -233,59 +1269,392 @@ def _env_exists(prefix, name):
     return env_exists
 
 
-def _env_remove(prefix, name):
+def _env_remove(prefix, name, backend='conda'):
     """Remove an existing conda environment named 'name'."""
     logger.info("Removing %s", name)
-    returncode, output = _subprocess_capture(
-        _command(prefix, 'conda',
-                 'env', 'remove', '-n', name, '-y'))
+    returncode, output = _backend_run(prefix, backend, 'remove', name=name)
     if returncode != 0:
         raise Exception("[FATAL] Error removing %s: %s" %
                         (name, output))
 
 
-def _env_create(prefix, name):
+def _env_create(prefix, name, backend='conda'):
     """Create a new Conda environment named 'name'."""
     logger.info("Creating %s", name)
-    returncode, output = _subprocess_capture(
-        _command(prefix, 'conda', 'create', '-n', name, '-y'))
+    returncode, output = _backend_run(prefix, backend, 'create', name=name)
     if returncode != 0:
         raise Exception("[FATAL] Error creating %s: %s" %
                         (name, output))
 
 
-def _env_install(prefix, name, environment):
+def _env_install(prefix, name, environment, backend='conda'):
     """Use a environment.yml file to initialize 'name' environment."""
     logger.info("Installing %s", name)
-    returncode, output = _subprocess_capture(
-        _command(prefix, 'conda', 'env', 'update', '-n', name,
-                 '--file', environment))
+    returncode, output = _backend_run(prefix, backend, 'install', name=name,
+                                      file=environment)
     if returncode != 0:
         raise Exception("[FATAL] Error installing %s: %s" %
                         (name, output))
 
 
-def _handle_env(prefix, name, environment, reset_env):
-    """Reset env if needed, then create and initialize environment."""
-    env_exists = _env_exists(prefix, name)
-    if reset_env and env_exists:
-        _env_remove(prefix, name)
-        env_exists = False
-    elif env_exists:
-        logger.info("Env %s already exists; use --reset-env to " +
-               "destroy and recreate it.", name)
+def _parse_environment(path):
+    """Read name, channels, dependencies and pip dependencies of a conda
+    environment file. Only the YAML subset used by environment files is
+    supported (no PyYAML in a fresh system python)."""
+    result = {'name': None, 'channels': [], 'dependencies': [], 'pip': []}
+    section = None
+    pip_indent = None
+    with io.open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = re.sub(r'(^|\s)#.*', '', line).rstrip()
+            if not line.strip():
+                continue
+            indent = len(line) - len(line.lstrip())
+            content = line.strip()
+            if indent == 0 and not content.startswith('-'):
+                (section, _, value) = content.partition(':')
+                value = value.strip()
+                if section == 'name':
+                    result['name'] = value.strip('"\'')
+                elif value.startswith('[') and section in result:
+                    result[section] = [i.strip().strip('"\'')
+                                       for i in value.strip('[]').split(',')
+                                       if i.strip()]
+                pip_indent = None
+                continue
+            if not content.startswith('-'):
+                continue
+            item = content[1:].strip().strip('"\'')
+            if section == 'channels':
+                result['channels'].append(item)
+            elif section == 'dependencies':
+                if pip_indent is not None and indent > pip_indent:
+                    result['pip'].append(item)
+                elif item == 'pip:':
+                    pip_indent = indent
+                else:
+                    pip_indent = None
+                    result['dependencies'].append(item)
+    return result
+
+
+def _lockfile_path(environment):
+    """Explicit lockfile path of 'environment' (environment.yml ->
+    environment.lock)."""
+    return os.path.splitext(environment)[0] + '.lock'
+
+
+#: first line of lockfiles: sha256 of the environment file they lock
+LOCKFILE_HEADER = '# environment-sha256: {0}\n'
+
+
+def _usable_lockfile(environment, require=False):
+    """Return lockfile path of 'environment' if it exists and can replace
+    a solve of 'environment', None otherwise (exception if require=True).
+    A lockfile written from another version of 'environment' is stale."""
+    lockfile = _lockfile_path(environment)
+    reason = None
+    if not os.path.isfile(lockfile):
+        reason = 'missing'
+    elif _parse_environment(environment)['pip']:
+        reason = 'pip dependencies of {0} are not locked'.format(environment)
+    else:
+        with io.open(lockfile, 'r', encoding='utf-8') as f:
+            match = re.match(r'# environment-sha256: (\w+)$',
+                             f.readline().strip())
+        if match is None:
+            logger.warning("%s does not record the environment it locks; "
+                           "use --write-lockfile to update it", lockfile)
+        elif match.group(1) != _file_hash(environment):
+            reason = '{0} changed since it was locked; use ' \
+                     '--write-lockfile to update it'.format(environment)
+    if reason is None:
+        return lockfile
+    if require:
+        raise Exception("[FATAL] Lockfile {0} required: {1}".format(
+            lockfile, reason))
+    if reason != 'missing':
+        logger.warning("%s ignored: %s", lockfile, reason)
+    return None
+
+
+def _env_lock(prefix, name, environment, lockfile, backend='conda'):
+    """Write explicit lockfile (package urls and md5) of 'name' env, with
+    the sha256 of 'environment' as header."""
+    logger.info("Writing lockfile %s", lockfile)
+    returncode, output = _backend_run(prefix, backend, 'lock', name=name)
+    if returncode != 0:
+        raise Exception("[FATAL] Error locking %s: %s" % (name, output))
+    match = re.search(r'^@EXPLICIT$', output, re.M)
+    if match is None:
+        raise Exception("[FATAL] Error locking %s: no @EXPLICIT line in "
+                        "%s list output: %s" % (name, backend, output))
+    _write_if_changed(lockfile,
+                      LOCKFILE_HEADER.format(_file_hash(environment)) +
+                      output[match.start():])
+
+
+def _env_install_locked(prefix, name, lockfile, backend='conda'):
+    """Install packages listed in explicit 'lockfile' in 'name' env; conda
+    solver is not run."""
+    logger.info("Installing %s from %s", name, lockfile)
+    returncode, output = _backend_run(prefix, backend, 'install_explicit',
+                                      name=name, file=lockfile)
+    if returncode != 0:
+        raise Exception("[FATAL] Error installing %s: %s" %
+                        (name, output))
 
-    if not env_exists:
-        _env_create(prefix, name)
 
-    if environment is not None:
-        _env_install(prefix, name, environment)
+#: file (in env conda-meta folder) storing the inputs fingerprint of the last
+#: successful install
+FINGERPRINT_FILE = 'bootstrap-fingerprint'
+
+
+def _conda_version(prefix):
+    """Return conda version installed in 'prefix', read from conda-meta
+    (conda is not run); None if not found."""
+    try:
+        names = os.listdir(os.path.join(prefix, 'conda-meta'))
+    except OSError:
+        return None
+    for name in names:
+        match = re.match(r'conda-([0-9][^-]*)-[^-]+\.json$', name)
+        if match:
+            return match.group(1)
+    return None
+
+
+def _condarc_paths(prefix):
+    """Configuration files that may define channels for 'prefix'."""
+    paths = [os.path.join(prefix, '.condarc'),
+             os.path.expanduser('~/.condarc'),
+             os.path.expanduser('~/.config/conda/.condarc')]
+    if os.getenv('CONDARC', None):
+        paths.append(os.getenv('CONDARC'))
+    return paths
+
+
+def _env_fingerprint(prefix, environment, lockfile=None, backend='conda'):
+    """Hash inputs of an environment install: 'environment' and 'lockfile'
+    files content, channels configuration, backend and conda version. None
+    if 'environment' cannot be read."""
+    digest = hashlib.sha256()
+    try:
+        for path in (environment, lockfile):
+            if path is not None:
+                with io.open(path, 'rb') as f:
+                    digest.update(f.read())
+    except (IOError, OSError):
+        return None
+    for path in _condarc_paths(prefix):
+        digest.update(path.encode('utf-8'))
+        if os.path.isfile(path):
+            with io.open(path, 'rb') as f:
+                digest.update(f.read())
+    digest.update(os.getenv('CONDA_CHANNELS', '').encode('utf-8'))
+    digest.update((_conda_version(prefix) or '').encode('utf-8'))
+    # conda result is kept as is for compatibility with existing envs
+    if backend != 'conda':
+        digest.update(backend.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _fingerprint_path(prefix, name):
+    return os.path.join(prefix, 'envs', name, 'conda-meta', FINGERPRINT_FILE)
+
+
+def _read_fingerprint(prefix, name):
+    """Return fingerprint of last install of env 'name', None if unknown."""
+    try:
+        with io.open(_fingerprint_path(prefix, name), 'r',
+                     encoding='utf-8') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _write_fingerprint(prefix, name, fingerprint):
+    """Store 'fingerprint' in env 'name'; ignored if env layout is not the
+    expected one."""
+    path = _fingerprint_path(prefix, name)
+    if not os.path.isdir(os.path.dirname(path)):
+        logger.debug("Fingerprint of %s not stored: %s missing", name,
+                     os.path.dirname(path))
+        return
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(fingerprint)
+
+
+#: template envs name prefix
+TEMPLATE_PREFIX = 'bootstrap-template-'
+#: file (in template env conda-meta folder) storing the template spec
+TEMPLATE_FILE = 'bootstrap-template.json'
+
+
+def _template_spec(environment):
+    """Return the part of 'environment' file defining installed packages."""
+    spec = _parse_environment(environment)
+    return {'channels': spec['channels'],
+            'dependencies': sorted(set(spec['dependencies'])),
+            'pip': sorted(set(spec['pip']))}
+
+
+def _template_name(spec):
+    """Template env name of 'spec', built from its hash."""
+    digest = hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf-8'))
+    return TEMPLATE_PREFIX + digest.hexdigest()[:12]
+
+
+def _find_template(prefix, spec):
+    """Return (name, exact) of the template env of 'prefix' closest to
+    'spec': same channels, and the largest packages set included in
+    'spec' packages (so that installing 'spec' in a clone only adds
+    packages). exact is True if template packages are 'spec' packages.
+    Return (None, False) if no template fits."""
+    envs_dir = os.path.join(prefix, 'envs')
+    best, best_size = None, -1
+    try:
+        names = os.listdir(envs_dir)
+    except OSError:
+        names = []
+    for name in names:
+        if not name.startswith(TEMPLATE_PREFIX):
+            continue
+        candidate = _read_json(
+            os.path.join(envs_dir, name, 'conda-meta', TEMPLATE_FILE), None)
+        if candidate is None or candidate['channels'] != spec['channels'] \
+                or not set(candidate['dependencies']) <= set(spec['dependencies']) \
+                or not set(candidate['pip']) <= set(spec['pip']):
+            continue
+        size = len(candidate['dependencies']) + len(candidate['pip'])
+        if size > best_size:
+            best, best_size = name, size
+    exact = best_size == len(spec['dependencies']) + len(spec['pip'])
+    return (best, best is not None and exact)
+
+
+def _env_clone(prefix, name, source, backend='conda'):
+    """Create env 'name' as a clone (hardlinked packages) of env 'source'."""
+    logger.info("Creating %s from %s", name, source)
+    returncode, output = _backend_run(prefix, backend, 'clone', name=name,
+                                      source=source)
+    if returncode != 0:
+        raise Exception("[FATAL] Error cloning %s: %s" %
+                        (source, output))
+
+
+def _save_template(prefix, name, spec, backend='conda'):
+    """Keep a clone of freshly installed env 'name' as template of 'spec',
+    unless one already exists. Failures are not fatal."""
+    template = _template_name(spec)
+    template_meta = os.path.join(prefix, 'envs', template, 'conda-meta')
+    if not os.path.isdir(os.path.join(prefix, 'envs')):
+        os.makedirs(os.path.join(prefix, 'envs'))
+    with _file_lock(os.path.join(prefix, 'envs', '.bootstrap-templates.lock')):
+        if os.path.exists(os.path.join(template_meta, TEMPLATE_FILE)):
+            return
+        try:
+            if os.path.exists(template_meta):
+                _env_remove(prefix, template, backend=backend)
+            _env_clone(prefix, template, name, backend=backend)
+            _write_json(os.path.join(template_meta, TEMPLATE_FILE), spec)
+        except Exception as e:
+            logger.warning("Template %s not saved: %s", template, e)
+
+
+def _handle_env(prefix, name, environment, reset_env, force_install=False,
+                use_lockfile=True, write_lockfile=False, backend='conda',
+                templates=False, require_lockfile=False):
+    """Reset env if needed, then create and initialize environment.
+
+    Install is skipped if env inputs fingerprint did not change since last
+    install, unless force_install=True.
+    If use_lockfile=True and environment has an explicit lockfile, it is
+    installed without solving environment, unless environment changed
+    since it was locked (an exception is raised if require_lockfile=True).
+    If write_lockfile=True, environment is solved and lockfile is
+    (re)generated.
+    Env operations are run with 'backend' tool (see BACKENDS); env reset
+    deletes env folder in background when prefix layout is recognized.
+    If templates=True, a new env is cloned from the closest template env
+    so that only missing packages are installed; installed envs are kept
+    as templates."""
+    with _phase('env_reset'):
+        env_exists = _env_exists(prefix, name, backend=backend)
+        if reset_env and env_exists:
+            # envs of user envs dir (~/.conda/envs) are removed by conda
+            if os.path.isdir(os.path.join(prefix, 'envs', name)):
+                logger.info("Removing %s", name)
+                _trash(os.path.join(prefix, 'envs', name))
+            else:
+                _env_remove(prefix, name, backend=backend)
+            env_exists = False
+        elif env_exists:
+            logger.info("Env %s already exists; use --reset-env to " +
+                   "destroy and recreate it.", name)
+            _skip('env exists')
+        else:
+            _skip('env does not exist')
+
+    spec, template, exact = None, None, False
+    if templates and environment is not None \
+            and 'clone' in BACKEND_COMMANDS[backend]:
+        spec = _template_spec(environment)
+    with _phase('env_create'):
+        if env_exists:
+            _skip('env exists')
+        else:
+            if spec is not None:
+                (template, exact) = _find_template(prefix, spec)
+            if template is not None:
+                _env_clone(prefix, name, template, backend=backend)
+            else:
+                _env_create(prefix, name, backend=backend)
+
+    with _phase('env_install'):
+        if environment is None:
+            _skip('no environment file')
+        else:
+            lockfile = None
+            if use_lockfile and not write_lockfile:
+                lockfile = _usable_lockfile(environment,
+                                            require=require_lockfile)
+            fingerprint = _env_fingerprint(prefix, environment, lockfile,
+                                           backend=backend)
+            if env_exists and not force_install and not write_lockfile \
+                    and fingerprint is not None \
+                    and fingerprint == _read_fingerprint(prefix, name):
+                logger.info("Env %s is up to date with %s; use " +
+                       "--force-install to install it anyway.",
+                       name, environment)
+                _skip('env is up to date')
+                return
+            if exact and not write_lockfile:
+                logger.info("Env %s cloned from %s; install skipped", name,
+                            template)
+                _skip('cloned from identical template')
+            elif lockfile is not None:
+                _env_install_locked(prefix, name, lockfile, backend=backend)
+            else:
+                _env_install(prefix, name, environment, backend=backend)
+                if write_lockfile:
+                    lockfile = _lockfile_path(environment)
+                    _env_lock(prefix, name, environment, lockfile,
+                              backend=backend)
+                    fingerprint = _env_fingerprint(prefix, environment,
+                                                   lockfile, backend=backend)
+            if fingerprint is not None:
+                _write_fingerprint(prefix, name, fingerprint)
+            if spec is not None and not exact:
+                _save_template(prefix, name, spec, backend=backend)
 
 
 def _handle_bootstrap_command(prefix, name):
     """Run BOOTSTRAP_COMMAND in the Conda environment prefix:name."""
     command = os.getenv(ENV_BOOTSTRAP_COMMAND, None)
-    if command is not None:
+    if command is None:
+        _skip('BOOTSTRAP_COMMAND not set')
+    else:
         # python2.6: index is mandatory
         # https://github.com/python-poetry/poetry/issues/3663
         # poetry -vv fails ! generic ugly fix here !
@@ -305,31 +1674,227 @@ def _handle_bootstrap_command(prefix, name):
                             (command, output))
 
 
-def _miniconda_install(prefix, removals=None):
+def _miniconda_install(prefix, removals=None, cache_dir=None,
+                       cache_size=DEFAULT_CACHE_SIZE, installer_sha256=None,
+                       installer=None):
     """Download and install miniconda in prefix, append downloaded file
-    in removals if list is initialized"""
+    in removals if list is initialized.
+
+    If cache_dir is provided, installer is fetched from (and stored in) this
+    cache, whose size is limited to cache_size MiB. A local 'installer'
+    file is used as is (no download)."""
     # Conda's python needs libcrypt.so.1 that needs libxcrypt.so.1
     script = """
 if [ -x /bin/dnf ]; then
     [ -f /usr/lib64/libcrypt.so.1 ] || sudo dnf install -y libxcrypt-compat
 fi
 """
-    subprocess.check_call(script, shell=True)
+    with _command_timing(script) as timing:
+        subprocess.check_call(script, shell=True)
+        timing['returncode'] = 0
     # Download Miniconda
-    (_, miniconda_script) = _download(MINICONDA_INSTALLER_URL)
-    if removals is not None:
-        removals.append(miniconda_script)
+    with _phase('download'):
+        if installer:
+            _skip('local installer')
+            miniconda_script = installer
+            if installer_sha256 is not None \
+                    and _file_hash(installer) != installer_sha256:
+                raise Exception('Checksum mismatch for {0}: expected {1}'
+                                .format(installer, installer_sha256))
+        elif cache_dir:
+            miniconda_script = _cached_download(
+                MINICONDA_INSTALLER_URL, cache_dir, cache_size * 1024 * 1024,
+                sha256=installer_sha256)
+        else:
+            (_, miniconda_script) = _download(MINICONDA_INSTALLER_URL)
+            if removals is not None:
+                removals.append(miniconda_script)
     # Run Miniconda
     miniconda_args = ['/bin/bash', miniconda_script,
                       '-u', '-b', '-p', prefix]
     _run(miniconda_args)
 
 
+def _file_hash(path, algorithm='sha256'):
+    """'algorithm' (hashlib name) hex digest of 'path' content."""
+    digest = hashlib.new(algorithm)
+    with io.open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _offline_installer(installer, cache_dir, installer_sha256=None):
+    """Local Miniconda installer for an offline install: 'installer' if
+    provided, else the cached copy of MINICONDA_INSTALLER_URL; None if
+    not available."""
+    if installer:
+        installer = os.path.expanduser(installer)
+        return installer if os.path.isfile(installer) else None
+    if not cache_dir:
+        return None
+    return _cache_lookup(MINICONDA_INSTALLER_URL, cache_dir,
+                         sha256=installer_sha256)
+
+
+def _offline_environ(wheel_dir=None):
+    """Environment variables restricting conda, mamba, micromamba and pip
+    to local content: file:// channels, package caches and 'wheel_dir'."""
+    env = {'CONDA_OFFLINE': 'true', 'MAMBA_OFFLINE': 'true',
+           'PIP_NO_INDEX': '1'}
+    if wheel_dir:
+        env['PIP_FIND_LINKS'] = os.path.abspath(os.path.expanduser(wheel_dir))
+    return env
+
+
+def _local_channel(channel, channel_alias=None):
+    """Path of a file:// (or absolute path) channel, None if remote.
+    Channel names are resolved with 'channel_alias' if provided."""
+    if channel_alias and '://' not in channel \
+            and not os.path.isabs(channel):
+        channel = '{0}/{1}'.format(channel_alias.rstrip('/'), channel)
+    if channel.startswith('file://'):
+        return channel[len('file://'):]
+    if os.path.isabs(channel):
+        return channel
+    return None
+
+
+def _pkgs_dirs(prefix, pkgs_dir=None):
+    """Package caches that conda may install from for 'prefix'."""
+    result = [os.path.join(prefix, 'pkgs')]
+    for path in [pkgs_dir, _shared_pkgs_dir(prefix)] + \
+            os.getenv('CONDA_PKGS_DIRS', '').split(','):
+        if path:
+            result.append(os.path.expanduser(path))
+    return result
+
+
+def _explicit_urls(lockfile):
+    """Package urls (md5 removed) of an explicit lockfile."""
+    with io.open(lockfile, 'r', encoding='utf-8') as f:
+        return [line.strip().split('#')[0] for line in f
+                if line.strip() and not line.startswith(('#', '@'))]
+
+
+def _normalized_name(name):
+    """PEP 503 normalized python distribution name."""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def _wheel_dir_has(wheel_dir, requirement):
+    """Return True if a distribution (wheel or sdist) matching the name of
+    pip 'requirement' is in 'wheel_dir'."""
+    name = _normalized_name(re.split(r'[\s<>=!~;\[@(]', requirement)[0])
+    for filename in os.listdir(wheel_dir):
+        if _normalized_name(filename).startswith(name + '-'):
+            return True
+    return False
+
+
+def _offline_missing(prefix, environments, reset_conda=False,
+                     cache_dir=None, installer=None, installer_sha256=None,
+                     wheel_dir=None, pkgs_dir=None, use_lockfile=True,
+                     channel_mirror=None):
+    """Return descriptions of what an offline bootstrap of 'environments'
+    in 'prefix' would need to download (empty list if nothing).
+
+    Conda packages are checked against package caches when environment
+    has an explicit lockfile; otherwise environment channels (defaults if
+    none) must be file:// channels, as conda cannot solve from remote
+    channels offline; channel names are resolved with 'channel_mirror' (or
+    prefix channel_alias and default_channels). pip dependencies must be
+    found in 'wheel_dir'."""
+    missing = []
+    channel_alias = channel_mirror or _channel_mirror(prefix)
+    if channel_alias and os.path.isabs(os.path.expanduser(channel_alias)):
+        channel_alias = 'file://' + os.path.abspath(
+            os.path.expanduser(channel_alias))
+    if channel_mirror:
+        # see _configure_channel_mirror
+        default_channels = ['{0}/{1}'.format(channel_alias.rstrip('/'), i)
+                            for i in DEFAULT_CHANNELS]
+    else:
+        default_channels = _default_channels(prefix)
+    if (reset_conda or not os.path.exists(prefix)) and \
+            _offline_installer(installer, cache_dir,
+                               installer_sha256) is None:
+        missing.append('Miniconda installer: {0} is not in cache {1} '
+                       '(use --installer)'.format(
+                           installer or MINICONDA_INSTALLER_URL, cache_dir))
+    pkgs_dirs = _pkgs_dirs(prefix, pkgs_dir)
+    for environment in environments:
+        if environment is None:
+            continue
+        spec = _parse_environment(environment)
+        lockfile = _usable_lockfile(environment) if use_lockfile else None
+        if lockfile is not None:
+            for url in _explicit_urls(lockfile):
+                local = _local_channel(url)
+                filename = url.rstrip('/').rsplit('/', 1)[-1]
+                extracted = re.sub(r'(\.tar\.bz2|\.conda)$', '', filename)
+                if local is not None:
+                    found = os.path.isfile(local)
+                else:
+                    found = [i for i in pkgs_dirs
+                             if os.path.exists(os.path.join(i, filename))
+                             or os.path.isdir(os.path.join(i, extracted))]
+                if not found:
+                    missing.append('{0}: package {1} ({2})'.format(
+                        environment, filename, url))
+        else:
+            channels = []
+            # conda solves envs without channels from defaults
+            for channel in spec['channels'] or ['defaults']:
+                channels.extend(default_channels if channel == 'defaults'
+                                else [channel])
+            for channel in channels:
+                local = _local_channel(channel, channel_alias)
+                if local is None:
+                    missing.append('{0}: channel {1} is remote (use a '
+                                   'file:// channel or an explicit lockfile)'
+                                   .format(environment, channel))
+                elif not os.path.isdir(local):
+                    missing.append('{0}: channel {1} not found'.format(
+                        environment, channel))
+        if spec['pip'] and not (wheel_dir and os.path.isdir(
+                os.path.expanduser(wheel_dir))):
+            missing.append('{0}: wheel directory for pip dependencies {1} '
+                           '(use --wheel-dir)'.format(
+                               environment, ', '.join(spec['pip'])))
+        elif spec['pip']:
+            for requirement in spec['pip']:
+                if requirement.startswith('-') or '://' in requirement \
+                        or not _wheel_dir_has(os.path.expanduser(wheel_dir),
+                                              requirement):
+                    missing.append('{0}: pip package {1} not in {2}'.format(
+                        environment, requirement, wheel_dir))
+    return missing
+
+
+def _offline_preflight(prefix, environments, **kwargs):
+    """Fail fast, listing all missing items, if an offline bootstrap cannot
+    be done (see _offline_missing)."""
+    with _phase('offline_preflight'):
+        missing = _offline_missing(prefix, environments, **kwargs)
+        for item in missing:
+            logger.error("Offline: missing %s", item)
+        if missing:
+            raise Exception("[FATAL] Offline bootstrap impossible: {0} "
+                            "missing item(s)".format(len(missing)))
+
+
 #: .format(bootstrap_d_path) ; activate script
 BOOTSTRAP_ACTIVATE_SCRIPT = """
-# Reload all environment files
+# Reload all environment files (through index when present; index
+# refuses to load if *.conf files were added or removed since it was
+# written, then every file is sourced)
 bootstrap-reload () {{
-    if compgen -G "{0}/*.conf" > /dev/null; then
+    local _bootstrap_confs=("{0}/"*.conf)
+    local _bootstrap_conf_count=${{#_bootstrap_confs[@]}}
+    if [ -f "{0}/index.sh" ] && source "{0}/index.sh"; then
+        :
+    elif compgen -G "{0}/*.conf" > /dev/null; then
         for item in "{0}/"*.conf; do
           source "$item"
         done
@@ -378,13 +1943,151 @@ deactivate-{1} () {{
     unset BOOTSTRAP_ENV
 }}
 """
+#: activation index in bootstrap.conf.d, sourced instead of *.conf files
+ACTIVATE_INDEX_FILE = 'index.sh'
+#: .format(env_name, activate_conf) ; index stubs sourcing env script on
+#: first call
+ACTIVATE_INDEX_STUB = """activate-{0} () {{
+    source {1} && activate-{0} "$@"
+}}
+deactivate-{0} () {{
+    source {1} && deactivate-{0} "$@"
+}}
+"""
 #: command to activate conda env (bootstrap script non found)
 ACTIVATE_CONDA_COMMAND = "source {0} && conda activate {1}"
 #! command to activate conda env
 ACTIVATE_BOOTSTRAP_COMMAND = "source {0} && bootstrap-activate {1}"
 
 
-def _print_activate_command(prefix, name, bootstrap_conf_path, skip_activate_script):
+#: shell startup files, inspected to detect if bootstrap.conf is sourced
+LOGIN_SHELL_FILES = ('/etc/profile', '/etc/bashrc', '/etc/bash.bashrc',
+                     '~/.bash_profile', '~/.bash_login', '~/.profile',
+                     '~/.bashrc')
+#: detection result, kept in bootstrap.conf.d
+LOGIN_SHELL_PROBE_FILE = '.login-shell-probe.json'
+
+
+def _files_stamp(paths):
+    """List [path, mtime, size] of 'paths' (None for missing files)."""
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(os.path.expanduser(path))
+            stamp.append([path, st.st_mtime, st.st_size])
+        except OSError:
+            stamp.append([path, None, None])
+    return stamp
+
+
+def _path_spellings(path):
+    """Ways 'path' may be written in a shell script."""
+    path = os.path.abspath(os.path.expanduser(path))
+    spellings = [path]
+    home = os.path.expanduser('~')
+    if path.startswith(home + os.sep):
+        relative = path[len(home):]
+        spellings += ['~' + relative, '$HOME' + relative,
+                      '${HOME}' + relative]
+    return spellings
+
+
+def _profile_sources_bootstrap(bootstrap_conf_path):
+    """Check if a shell startup file sources bootstrap.conf, or loops over
+    files of its folder matching it (ex: for i in ~/.profile.d/*.conf),
+    without running a shell."""
+    import fnmatch
+    spellings = _path_spellings(bootstrap_conf_path)
+    folders = _path_spellings(os.path.dirname(bootstrap_conf_path))
+    name = os.path.basename(bootstrap_conf_path)
+    for path in LOGIN_SHELL_FILES:
+        try:
+            with io.open(os.path.expanduser(path), 'r', encoding='utf-8',
+                         errors='replace') as f:
+                content = f.read()
+        except (IOError, OSError):
+            continue
+        for line in content.splitlines():
+            line = line.split('#', 1)[0].replace('"', '').replace("'", '')
+            for match in re.finditer(r'(^|[\s;&|{(])(source|\.)\s+([^\s;&|)]+)',
+                                     line):
+                if match.group(3) in spellings:
+                    return True
+            match = re.match(r'\s*for\s+\w+\s+in\s+([^;]*)', line)
+            if match is None:
+                continue
+            for word in match.group(1).split():
+                for folder in folders:
+                    if word.startswith(folder + '/') and fnmatch.fnmatch(
+                            name, word[len(folder) + 1:]):
+                        return True
+    return False
+
+
+def _login_shell_loads_bootstrap():
+    """Check if a login shell sets BOOTSTRAP_ACTIVATE; slow, as the whole
+    user profile is run."""
+    try:
+        check_command = ['/bin/bash', '-l', '-c', 'echo -n $BOOTSTRAP_ACTIVATE']
+        return subprocess.check_output(check_command).strip() == b'1'
+    except Exception as e:
+        logger.warning('Error checking if bootstrap.conf is sourced. '
+              'Assuming it is not sourced.')
+        return False
+
+
+def _bootstrap_conf_sourced(bootstrap_conf_path, cache_path,
+                            probe_login_shell=False):
+    """Check if bootstrap.conf is sourced by shell startup files; a login
+    shell is run if they do not and probe_login_shell=True. Result is kept
+    in 'cache_path' until a shell startup file, bootstrap.conf or its
+    folder changes."""
+    stamp = _files_stamp(LOGIN_SHELL_FILES + (
+        bootstrap_conf_path, os.path.dirname(bootstrap_conf_path)))
+    cached = _read_json(cache_path, {})
+    if cached.get('stamp') == stamp \
+            and cached.get('probe_login_shell') == probe_login_shell:
+        return cached['result']
+    result = _profile_sources_bootstrap(bootstrap_conf_path)
+    if not result and probe_login_shell:
+        result = _login_shell_loads_bootstrap()
+    try:
+        _write_json(cache_path, {'stamp': stamp, 'result': result,
+                                 'probe_login_shell': probe_login_shell})
+    except (IOError, OSError):
+        pass
+    return result
+
+
+def _write_activate_index(bootstrap_conf_d_path):
+    """(Re)write activation index of 'bootstrap_conf_d_path': activate-NAME
+    functions are defined as stubs that source activate-NAME.conf on first
+    call, other *.conf files are sourced. Shell startup does not read every
+    env script. Index records the count of *.conf files: it returns 1
+    without defining anything when bootstrap-reload counts another number,
+    so that files added later are sourced. Return True if index was
+    written."""
+    with _file_lock(os.path.join(bootstrap_conf_d_path, '.index.lock')):
+        filenames = [i for i in sorted(os.listdir(bootstrap_conf_d_path))
+                     if i.endswith('.conf')]
+        lines = ['# generated by bootstrap.py; do not edit\n',
+                 '[ "$_bootstrap_conf_count" == {0} ] || return 1\n'
+                 .format(len(filenames))]
+        for filename in filenames:
+            path = shlex.quote(os.path.join(bootstrap_conf_d_path, filename))
+            match = re.match(r'activate-([0-9a-zA-Z_-]+)\.conf$', filename)
+            if match:
+                lines.append(ACTIVATE_INDEX_STUB.format(match.group(1), path))
+            else:
+                lines.append('source {0}\n'.format(path))
+        lines.append('return 0\n')
+        return _write_if_changed(
+            os.path.join(bootstrap_conf_d_path, ACTIVATE_INDEX_FILE),
+            ''.join(lines))
+
+
+def _print_activate_command(prefix, name, bootstrap_conf_path, skip_activate_script,
+                            probe_login_shell=False):
     # -> .profile.d/boostrap.conf.d/
     bootstrap_conf_d_path = os.path.expanduser('{0}.d'.format(bootstrap_conf_path))
     # -> .profile.d/boostrap.conf.d/activate-[NAME].conf
@@ -403,10 +2106,9 @@ def _print_activate_command(prefix, name, bootstrap_conf_path, skip_activate_scr
             real_bootstrap_conf_path = os.path.expanduser(bootstrap_conf_path)
             if not os.path.exists(bootstrap_conf_d_path):
                 os.makedirs(bootstrap_conf_d_path)
-            with io.open(real_bootstrap_conf_path, 'w', encoding='utf-8') as f:
-                f.write(bootstrap_script)
-            with io.open(activate_path, 'w', encoding='utf-8') as f:
-                f.write(activate_script)
+            _write_if_changed(real_bootstrap_conf_path, bootstrap_script)
+            _write_if_changed(activate_path, activate_script)
+            _write_activate_index(bootstrap_conf_d_path)
         except Exception as e:
             logger.error("activate script creation fails: %s".format(e))
     logger.info("Env %s initialized.", prefix)
@@ -419,13 +2121,15 @@ def _print_activate_command(prefix, name, bootstrap_conf_path, skip_activate_scr
         if os.getenv('BOOTSTRAP_ACTIVATE', None) == '1':
             bootstrap_activate_enabled = True
         else:
-            try:
-                check_command = ['/bin/bash', '-l', '-c', 'echo -n $BOOTSTRAP_ACTIVATE']
-                bootstrap_activate_loadable = (
-                    subprocess.check_output(check_command) == '1')
-            except Exception as e:
-                logger.warning('Error checking if bootstrap.conf is sourced. '
-                      'Assuming it is not sourced.')
+            bootstrap_activate_loadable = _bootstrap_conf_sourced(
+                real_bootstrap_conf_path,
+                os.path.join(bootstrap_conf_d_path, LOGIN_SHELL_PROBE_FILE),
+                probe_login_shell=probe_login_shell)
+            if not bootstrap_activate_loadable:
+                logger.info("%s is not sourced by your shell profile; add "
+                            "'source %s' to ~/.bashrc to get "
+                            "bootstrap-activate in new shells.",
+                            bootstrap_conf_path, bootstrap_conf_path)
     activate_command = None
     if bootstrap_activate_enabled:
         activate_command = 'bootstrap-activate {0}'.format(shlex.quote(name))
@@ -452,9 +2156,30 @@ def _print_activate_command(prefix, name, bootstrap_conf_path, skip_activate_scr
 def _bootstrap(prefix, name, environment, args,
                reset_conda=False, reset_env=False,
                profile_dir='', skip_activate_script=False,
-               verbose=0):
+               verbose=0, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE,
+               installer_sha256=None, force_install=False,
+               use_lockfile=True, write_lockfile=False, backend=None,
+               pkgs_dir=None, templates=False, probe_login_shell=False,
+               offline=False, installer=None, wheel_dir=None,
+               channel_mirror=None, require_lockfile=False):
     """Delete existing Miniconda if reset_conda=True.
     Print verbose output (stderr of commands and debug messages) if verbose > 1.
+    Miniconda installer is kept in cache_dir if provided.
+    Env install is skipped when its inputs are unchanged unless
+    force_install=True. Explicit lockfile next to environment is used
+    if use_lockfile=True (required if require_lockfile=True), and
+    (re)generated if write_lockfile=True.
+    backend is one of BACKENDS, auto-detected if None or 'auto'.
+    pkgs_dir is a package cache shared by conda installations.
+    New envs are cloned from template envs if templates=True.
+    A login shell is run to check if bootstrap.conf is sourced if
+    probe_login_shell=True and shell startup files do not show it.
+    Miniconda is installed from local 'installer' file if provided.
+    If offline=True, nothing is downloaded: installer, conda packages and
+    pip packages (from 'wheel_dir') must be available locally, which is
+    checked before any change (see _offline_missing).
+    Channel names resolve to 'channel_mirror' channels if provided.
+    Failures are logged; return False on failure, True otherwise.
     """
     debug = verbose > 1
     logging.root.setLevel(logging.DEBUG if debug else logging.INFO)
@@ -469,23 +2194,53 @@ def _bootstrap(prefix, name, environment, args,
     logger.info("Using %s as environment file", environment)
 
     environment = _skip_env_install(environment)
-    # prepare parent folders, reset conda if asked to
-    _prepare_conda(prefix, reset_conda)
-    # check if conda install is needed
-    skip_miniconda = _skip_miniconda(prefix)
+    if offline:
+        try:
+            _offline_preflight(
+                prefix, [environment], reset_conda=reset_conda,
+                cache_dir=cache_dir, installer=installer,
+                installer_sha256=installer_sha256, wheel_dir=wheel_dir,
+                pkgs_dir=pkgs_dir,
+                use_lockfile=use_lockfile and not write_lockfile,
+                channel_mirror=channel_mirror)
+        except Exception as e:
+            logger.error('Bootstrap failure: %s', str(e))
+            return False
+    _backend_environ.clear()
+    if offline:
+        _backend_environ.update(_offline_environ(wheel_dir))
+    tmp_removals = []
+    with _prefix_lock(prefix):
+        # prepare parent folders, reset conda if asked to
+        with _phase('prepare_conda'):
+            _prepare_conda(prefix, reset_conda)
+        try:
+            # Conda installation
+            _miniconda_phase(prefix, tmp_removals, cache_dir, cache_size,
+                             installer_sha256, installer=installer,
+                             offline=offline)
+
+            with _phase('backend'):
+                if pkgs_dir:
+                    _configure_pkgs_dir(prefix, pkgs_dir)
+                if channel_mirror:
+                    _configure_channel_mirror(prefix, channel_mirror)
+                backend = _detect_backend(prefix, backend)
+        except Exception as e:
+            logger.error('Bootstrap failure: %s', str(e))
+            _cleanup_removals(tmp_removals)
+            return False
 
     try:
-        # Conda installation
-        tmp_removals = []
-        if not skip_miniconda:
-            _miniconda_install(prefix, removals=tmp_removals)
-
-        # Conda env reset, creation and initialization
-        _handle_env(prefix, name, environment, reset_env)
-        _handle_bootstrap_command(prefix, name)
-
-        # Print commands to activate Miniconda env
-        _print_activate_command(prefix, name, profile_dir, skip_activate_script)
+        logger.info("Using %s as backend", backend)
+        # Conda env reset, creation, initialization and activate scripts
+        _bootstrap_env(prefix, name, environment, reset_env, force_install,
+                       profile_dir, skip_activate_script,
+                       use_lockfile=use_lockfile,
+                       write_lockfile=write_lockfile, backend=backend,
+                       templates=templates,
+                       probe_login_shell=probe_login_shell,
+                       require_lockfile=require_lockfile)
         if args:
             logger.info('Use remaining args as command: %s', ' '.join(args))
             # Launch command
@@ -501,26 +2256,647 @@ def _bootstrap(prefix, name, environment, args,
                 'PKG_CONFIG_PATH':
                   os.path.join(prefix, 'envs', name, 'lib', 'pkgconfig')
             })
-            subprocess.check_call(_command(
+            command = _command(
                 os.path.join(prefix, 'envs', name), # env path
                 args[0],                            # command
                 *args[1:]                           # args
-            ), env=env)
+            )
+            with _phase('command'), _command_timing(command) as timing:
+                subprocess.check_call(command, env=env)
+                timing['returncode'] = 0
     except Exception as e:
         logger.error('Bootstrap failure: %s', str(e))
-        # python2.6: isEnabledFor not available
-        debug = logger.getEffectiveLevel() == logging.DEBUG
-        if not debug:
-            if tmp_removals:
-                for tmp_removal in tmp_removals:
-                    try:
-                        os.remove(tmp_removal)
-                    except Exception:
-                        logger.error('Failing to delete %s', tmp_removal)
+        _cleanup_removals(tmp_removals)
+        return False
+    return True
+
+
+def _miniconda_phase(prefix, tmp_removals, cache_dir, cache_size,
+                     installer_sha256, installer=None, offline=False):
+    """Install Miniconda in 'prefix' unless it already exists. In offline
+    mode, installer is never downloaded (see _offline_installer)."""
+    with _phase('miniconda'):
+        if _skip_miniconda(prefix):
+            _skip('prefix exists')
         else:
-            if tmp_removals:
-                for tmp_removal in tmp_removals:
-                    logger.debug('Keeping file %s', tmp_removal)
+            if offline:
+                installer = _offline_installer(installer, cache_dir,
+                                               installer_sha256)
+            _miniconda_install(prefix, removals=tmp_removals,
+                               cache_dir=cache_dir, cache_size=cache_size,
+                               installer_sha256=installer_sha256,
+                               installer=installer)
+
+
+def _cleanup_removals(tmp_removals):
+    """Delete temporary files after a failure; they are kept for
+    investigation in debug mode."""
+    # python2.6: isEnabledFor not available
+    debug = logger.getEffectiveLevel() == logging.DEBUG
+    if not debug:
+        if tmp_removals:
+            for tmp_removal in tmp_removals:
+                try:
+                    os.remove(tmp_removal)
+                except Exception:
+                    logger.error('Failing to delete %s', tmp_removal)
+    else:
+        if tmp_removals:
+            for tmp_removal in tmp_removals:
+                logger.debug('Keeping file %s', tmp_removal)
+
+
+def _bootstrap_env(prefix, name, environment, reset_env, force_install,
+                   profile_dir, skip_activate_script, use_lockfile=True,
+                   write_lockfile=False, backend='conda', templates=False,
+                   probe_login_shell=False, require_lockfile=False):
+    """Reset, create and initialize env 'name', run BOOTSTRAP_COMMAND and
+    print activation commands. Outcome is recorded in envs registry once
+    done (with the failed phase on failure)."""
+    _report_context.env = name
+    # progress is kept here: registry is only written once
+    record = {'environment': environment and os.path.abspath(
+        os.path.expanduser(environment)), 'backend': backend}
+    try:
+        record['phase'] = 'env'
+        fingerprint = _read_fingerprint(prefix, name)
+        with _phase('env'):
+            _handle_env(prefix, name, environment, reset_env,
+                        force_install=force_install,
+                        use_lockfile=use_lockfile,
+                        write_lockfile=write_lockfile, backend=backend,
+                        templates=templates,
+                        require_lockfile=require_lockfile)
+        if fingerprint != _read_fingerprint(prefix, name) \
+                or _registry_get(prefix, name).get('size') is None:
+            record.update(updated=time.time(),
+                          size=_tree_size(os.path.join(prefix, 'envs', name)))
+        record['phase'] = 'bootstrap_command'
+        with _phase('bootstrap_command'):
+            _handle_bootstrap_command(prefix, name)
+        # Print commands to activate Miniconda env
+        record['phase'] = 'activate_script'
+        with _phase('activate_script'):
+            _print_activate_command(prefix, name, profile_dir,
+                                    skip_activate_script,
+                                    probe_login_shell=probe_login_shell)
+    except Exception:
+        _registry_update(prefix, name, status='failed', **record)
+        raise
+    record['phase'] = None
+    _registry_update(prefix, name, status='ok', **record)
+
+
+def _registry_path():
+    """Path of envs registry, None if disabled."""
+    path = os.getenv(ENV_BOOTSTRAP_REGISTRY, DEFAULT_REGISTRY)
+    return os.path.expanduser(path) if path else None
+
+
+def _registry_read():
+    """Return envs registry: {'envs': {'PREFIX:NAME': {...}}}."""
+    path = _registry_path()
+    registry = _read_json(path, {}) if path else {}
+    registry.setdefault('envs', {})
+    return registry
+
+
+@contextlib.contextmanager
+def _registry_edit():
+    """Yield envs registry (None if disabled), written back at context end
+    if modified. Registry is locked meanwhile, as parallel bootstraps
+    update it."""
+    path = _registry_path()
+    if path is None:
+        yield None
+        return
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with _file_lock(path + '.lock'):
+        registry = _registry_read()
+        original = json.dumps(registry, sort_keys=True)
+        yield registry
+        if json.dumps(registry, sort_keys=True) != original:
+            _write_json(path, registry)
+
+
+def _registry_key(prefix, name):
+    return '{0}:{1}'.format(os.path.abspath(prefix), name)
+
+
+def _registry_get(prefix, name):
+    return _registry_read()['envs'].get(_registry_key(prefix, name), {})
+
+
+def _registry_update(prefix, name, **values):
+    """Set 'values' of env 'name' of 'prefix' in envs registry; registry
+    is not locked nor written if it already holds them. Registry errors are
+    logged, never raised."""
+    try:
+        if _registry_path() is None:
+            return
+        entry = _registry_get(prefix, name)
+        if entry and [k for k in values if k in entry] == list(values) \
+                and all(entry[k] == v for k, v in values.items()):
+            return
+        with _registry_edit() as registry:
+            if registry is None:
+                return
+            entry = registry['envs'].setdefault(
+                _registry_key(prefix, name),
+                {'prefix': os.path.abspath(prefix), 'name': name,
+                 'created': time.time()})
+            entry.update(values)
+    except Exception as e:
+        logger.warning("Envs registry update failed: %s", e)
+
+
+def _tree_size(path):
+    """Disk usage (bytes) of 'path' tree; hard links (conda links files of
+    its package cache) are counted once."""
+    size = 0
+    inodes = set()
+    for root, dirs, files in os.walk(path):
+        for filename in files + dirs:
+            try:
+                st = os.lstat(os.path.join(root, filename))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) not in inodes:
+                inodes.add((st.st_dev, st.st_ino))
+                size += st.st_blocks * 512
+    return size
+
+
+def _prefix_env_names(prefix):
+    """Names of envs found in prefix/envs, template envs excepted (see
+    _save_template)."""
+    envs_dir = os.path.join(prefix, 'envs')
+    try:
+        names = os.listdir(envs_dir)
+    except OSError:
+        return []
+    return sorted(i for i in names
+                  if not i.startswith(TEMPLATE_PREFIX)
+                  and os.path.isdir(os.path.join(envs_dir, i, 'conda-meta')))
+
+
+def _registry_stale_prefixes(registry):
+    """Prefixes whose envs differ from the registered ones (envs created or
+    removed outside bootstrap)."""
+    registered = {}
+    for entry in registry['envs'].values():
+        registered.setdefault(entry['prefix'], []).append(entry['name'])
+    return sorted(prefix for prefix, names in registered.items()
+                  if sorted(names) != _prefix_env_names(prefix))
+
+
+def _registry_reconcile(prefixes):
+    """Rescan envs of 'prefixes': envs created outside bootstrap are added,
+    deleted envs are dropped and sizes are refreshed."""
+    with _registry_edit() as registry:
+        if registry is None:
+            return
+        for prefix in prefixes:
+            prefix = os.path.abspath(prefix)
+            envs_dir = os.path.join(prefix, 'envs')
+            names = _prefix_env_names(prefix)
+            for key, entry in list(registry['envs'].items()):
+                if entry['prefix'] == prefix and entry['name'] not in names:
+                    logger.info("%s:%s not found; dropped from registry",
+                                prefix, entry['name'])
+                    del registry['envs'][key]
+            for name in names:
+                entry = registry['envs'].setdefault(
+                    _registry_key(prefix, name),
+                    {'prefix': prefix, 'name': name, 'environment': None,
+                     'created': os.stat(os.path.join(envs_dir, name))
+                     .st_mtime, 'status': 'unknown'})
+                entry['size'] = _tree_size(os.path.join(envs_dir, name))
+
+
+def _format_size(size):
+    if size is None:
+        return '?'
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    return '{0:.0f}{1}'.format(size, unit)
+
+
+def _format_time(timestamp):
+    if timestamp is None:
+        return '-'
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
+
+
+def _registry_main(argv):
+    """'list' and 'status' commands: show envs registry."""
+    parser = argparse.ArgumentParser(
+        prog='bootstrap.py {0}'.format(argv[0]),
+        description='Show envs created by bootstrap.py (from registry).')
+    if argv[0] == 'status':
+        parser.add_argument('name', nargs='?', default=None,
+                            help='Only show this env.')
+    parser.add_argument('--prefix', dest='prefix', default=None,
+                        help='Only show envs of this conda prefix.')
+    parser.add_argument('--reconcile', dest='reconcile', action='store_true',
+                        default=False,
+                        help='Rescan prefixes whose envs changed outside '
+                             'bootstrap (--prefix: rescan it) before '
+                             'showing envs.')
+    parser.add_argument('--json', dest='json', action='store_true',
+                        default=False, help='Output JSON.')
+    args = parser.parse_args(argv[1:])
+    prefix = args.prefix and os.path.abspath(os.path.expanduser(args.prefix))
+    if args.reconcile:
+        stale = _registry_stale_prefixes(_registry_read())
+        if prefix is not None:
+            stale = [prefix]
+        _registry_reconcile(stale)
+    registry = _registry_read()
+    envs = sorted(registry['envs'].values(),
+                  key=lambda i: (i['prefix'], i['name']))
+    if prefix is not None:
+        envs = [i for i in envs if i['prefix'] == prefix]
+    if getattr(args, 'name', None) is not None:
+        envs = [i for i in envs if i['name'] == args.name]
+    if args.json:
+        stdout.info('%s', json.dumps(envs, indent=2, sort_keys=True))
+    elif argv[0] == 'list':
+        for env in envs:
+            stdout.info('%-20s %6s  %s  %s', env['name'],
+                        _format_size(env.get('size')),
+                        _format_time(env.get('updated')), env['prefix'])
+    else:
+        for env in envs:
+            stdout.info('%s (%s)\n  environment: %s\n  backend: %s\n'
+                        '  status: %s%s\n  created: %s\n  updated: %s\n'
+                        '  size: %s', env['name'], env['prefix'],
+                        env.get('environment'), env.get('backend'),
+                        env.get('status'),
+                        ' ({0})'.format(env['phase'])
+                        if env.get('phase') else '',
+                        _format_time(env.get('created')),
+                        _format_time(env.get('updated')),
+                        _format_size(env.get('size')))
+    if not args.reconcile:
+        for stale in _registry_stale_prefixes(registry):
+            if prefix is None or stale == prefix:
+                logger.warning("Envs of %s changed outside bootstrap; use "
+                               "--reconcile to rescan them.", stale)
+    if getattr(args, 'name', None) is not None and not envs:
+        logger.error("Env %s not found in registry", args.name)
+        return 1
+    return 0
+
+
+#: package record fields kept in mirror repodata.json
+REPODATA_FIELDS = ('build', 'build_number', 'constrains', 'depends',
+                   'features', 'license', 'license_family', 'md5', 'name',
+                   'noarch', 'sha256', 'size', 'subdir', 'timestamp',
+                   'track_features', 'version')
+
+
+def _mirror_solve(prefix, environment):
+    """Return package records (conda FETCH actions) of 'environment'
+    solved by conda of 'prefix'. An empty package cache is used so that
+    every package of the solution is listed, cached ones included."""
+    import tempfile
+    import shutil
+    spec = _parse_environment(environment)
+    if spec['pip']:
+        logger.warning("%s: pip dependencies are not mirrored (see "
+                       "--wheel-dir)", environment)
+    tmpdir = tempfile.mkdtemp(prefix='bootstrap-mirror-')
+    try:
+        args = ['create', '--dry-run', '--json', '-p',
+                os.path.join(tmpdir, 'env')]
+        if spec['channels']:
+            args.append('--override-channels')
+        for channel in spec['channels']:
+            args.extend(['-c', channel])
+        args.extend(spec['dependencies'])
+        env = dict(os.environ)
+        env['CONDA_PKGS_DIRS'] = os.path.join(tmpdir, 'pkgs')
+        # stderr warnings would break JSON parsing
+        returncode, output, errors = _subprocess_stdout(
+            _command(prefix, 'conda', *args), env=env)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    try:
+        result = json.JSONDecoder().raw_decode(output[output.index('{'):])[0]
+    except ValueError:
+        result = {}
+    if returncode != 0 or 'actions' not in result:
+        raise Exception("[FATAL] Error solving %s: %s" % (
+            environment, result.get('message', output + errors)))
+    return result['actions'].get('FETCH', [])
+
+
+def _mirror_channel_name(url):
+    """Mirror channel folder of a package url: channel path of http(s)
+    urls (conda-forge, pkgs/main...), folder name of file:// urls."""
+    channel_url = url.rsplit('/', 2)[0]
+    (scheme, _, rest) = channel_url.partition('://')
+    if scheme == 'file':
+        return os.path.basename(rest.rstrip('/'))
+    path = rest.partition('/')[2].strip('/')
+    # token protected channels: /t/TOKEN/channel
+    return re.sub(r'^t/[^/]+/', '', path)
+
+
+def _mirror_package(output, record):
+    """Download package 'record' in its 'output' channel folder unless it
+    is already there with the same md5; return downloaded bytes."""
+    path = os.path.join(output, _mirror_channel_name(record['url']),
+                        record['subdir'], record['fn'])
+    if os.path.isfile(path):
+        if record.get('md5'):
+            present = _file_hash(path, 'md5') == record['md5']
+        else:
+            present = os.path.getsize(path) == record.get('size')
+        if present:
+            return 0
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    digest = hashlib.md5()
+    stats = {}
+    (_, tmp_path) = _download(record['url'], _tmpdir=os.path.dirname(path),
+                              digest=digest, jobs=1, stats=stats)
+    if record.get('md5') and digest.hexdigest() != record['md5']:
+        os.remove(tmp_path)
+        raise Exception('Checksum mismatch for {0}: expected {1}, got {2}'
+                        .format(record['url'], record['md5'],
+                                digest.hexdigest()))
+    os.rename(tmp_path, path)
+    logger.info("Downloaded %s", record['fn'])
+    return stats['bytes']
+
+
+def _mirror_index(output, records):
+    """Add 'records' to repodata.json of their channel folders in 'output';
+    an empty noarch index is created in each channel, as conda needs it."""
+    indexes = collections.defaultdict(list)
+    for record in records:
+        channel = _mirror_channel_name(record['url'])
+        indexes[(channel, record['subdir'])].append(record)
+        indexes.setdefault((channel, 'noarch'), [])
+    for (channel, subdir), entries in sorted(indexes.items()):
+        path = os.path.join(output, channel, subdir, 'repodata.json')
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        repodata = _read_json(path, {})
+        repodata.setdefault('info', {'subdir': subdir})
+        repodata.setdefault('packages', {})
+        repodata.setdefault('packages.conda', {})
+        repodata.setdefault('repodata_version', 1)
+        for record in entries:
+            key = 'packages.conda' if record['fn'].endswith('.conda') \
+                else 'packages'
+            repodata[key][record['fn']] = dict(
+                (i, record[i]) for i in REPODATA_FIELDS
+                if record.get(i) is not None)
+        _write_if_changed(path, json.dumps(repodata, indent=1,
+                                           sort_keys=True) + '\n')
+
+
+def _mirror_main(argv):
+    """'mirror' command: solve environments and download their packages in
+    an indexed channels mirror."""
+    parser = argparse.ArgumentParser(
+        prog='bootstrap.py {0}'.format(MIRROR_COMMAND),
+        description='Build (or update) a folder of conda channels holding '
+                    'packages of environments; use it with '
+                    '--channel-mirror.')
+    parser.add_argument('output', help='Mirror folder.')
+    parser.add_argument('environments', nargs='+',
+                        help='environment.yml files to mirror.')
+    parser.add_argument('--prefix', dest='prefix',
+                        default=os.getenv(ENV_BOOTSTRAP_CONDA_PREFIX,
+                                          '~/.miniconda2'),
+                        help='conda installation used to solve '
+                             'environments.')
+    parser.add_argument('--jobs', dest='jobs', type=int,
+                        default=int(os.getenv(ENV_BOOTSTRAP_DOWNLOAD_JOBS,
+                                              DEFAULT_DOWNLOAD_JOBS)),
+                        help='Count of packages downloaded at once.')
+    args = parser.parse_args(argv)
+    prefix = os.path.expanduser(args.prefix)
+    output = os.path.abspath(os.path.expanduser(args.output))
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    records = {}
+    for environment in args.environments:
+        logger.info("Solving %s", environment)
+        for record in _mirror_solve(prefix, os.path.expanduser(environment)):
+            records[record['url']] = record
+    records = [records[i] for i in sorted(records)]
+    with _file_lock(os.path.join(output, '.lock'),
+                    wait_message='Waiting for mirror lock'):
+        results = _parallel_map(lambda i: _mirror_package(output, i),
+                                records, args.jobs)
+        errors = [e for _, e in results if e is not None]
+        for error in errors:
+            logger.error("%s", error)
+        downloaded = [i for i, _ in results if i]
+        _mirror_index(output, [r for r, (_, e) in zip(records, results)
+                               if e is None])
+    logger.info("Mirror %s: %d packages, %d downloaded (%.1f MiB), %d "
+                "failed", output, len(records), len(downloaded),
+                sum(downloaded) / 1048576.0, len(errors))
+    if errors:
+        return 1
+    logger.info("Use --channel-mirror file://%s to bootstrap from it",
+                output)
+    return 0
+
+
+#: per-thread log context; see _buffer_logs
+_log_context = threading.local()
+#: serialize buffered logs output
+_log_lock = threading.Lock()
+
+
+class _LogContextFilter(logging.Filter):
+    """Handler filter that holds back records of threads running inside
+    _buffer_logs."""
+
+    def filter(self, record):
+        buffer = getattr(_log_context, 'buffer', None)
+        if buffer is None:
+            return True
+        buffer.append(record)
+        return False
+
+
+@contextlib.contextmanager
+def _buffer_logs(label):
+    """Hold back records logged by current thread while the context is
+    active; then output them at once, prefixed by '[label]'."""
+    _log_context.buffer = []
+    try:
+        yield
+    finally:
+        records = _log_context.buffer
+        _log_context.buffer = None
+        with _log_lock:
+            for record in records:
+                record.msg = '[{0}] {1}'.format(label, record.getMessage())
+                record.args = ()
+                logging.getLogger(record.name).handle(record)
+
+
+def _parallel_map(func, items, jobs):
+    """Call 'func' on each of 'items' from at most 'jobs' threads. Return
+    a list of (result, exception) in 'items' order."""
+    results = [None] * len(items)
+    pending = list(enumerate(items))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                index, item = pending.pop(0)
+            try:
+                results[index] = (func(item), None)
+            except Exception as e:
+                results[index] = (None, e)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(jobs, len(items))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _read_batch(path):
+    """Read a batch file: one 'NAME ENVIRONMENT_YML' pair per line, shell
+    quoted if needed; empty lines and # comments are ignored. Relative
+    environment paths are resolved from batch file folder."""
+    envs = []
+    base = os.path.dirname(os.path.abspath(os.path.expanduser(path)))
+    with io.open(os.path.expanduser(path), 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            # '#' starts a comment unless quoted (ex: "envs/#1.yml")
+            items = shlex.split(line, comments=True)
+            if not items:
+                continue
+            if len(items) != 2:
+                raise Exception('{0}:{1}: expected NAME ENVIRONMENT_YML'
+                                .format(path, line_number))
+            envs.append((items[0], os.path.join(
+                base, os.path.expanduser(items[1]))))
+    return envs
+
+
+def _bootstrap_batch(prefix, envs, jobs=DEFAULT_JOBS,
+                     reset_conda=False, reset_env=False,
+                     profile_dir='', skip_activate_script=False,
+                     verbose=0, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE,
+                     installer_sha256=None, force_install=False,
+                     use_lockfile=True, write_lockfile=False, backend=None,
+                     pkgs_dir=None, templates=False, probe_login_shell=False,
+                     offline=False, installer=None, wheel_dir=None,
+                     channel_mirror=None, require_lockfile=False):
+    """Install Miniconda once in 'prefix', then bootstrap each
+    (name, environment) of 'envs' from at most 'jobs' threads.
+    Logs of each env are output as one block once it is done.
+    Return a list of (name, exception), exception being None on success.
+    """
+    debug = verbose > 1
+    logging.root.setLevel(logging.DEBUG if debug else logging.INFO)
+    prefix = os.path.expanduser(prefix)
+    logger.info("Using %s as conda prefix", prefix)
+    if offline:
+        try:
+            _offline_preflight(
+                prefix, [i for i in (os.path.expanduser(e) for _, e in envs)
+                         if os.path.exists(i)],
+                reset_conda=reset_conda, cache_dir=cache_dir,
+                installer=installer, installer_sha256=installer_sha256,
+                wheel_dir=wheel_dir, pkgs_dir=pkgs_dir,
+                use_lockfile=use_lockfile and not write_lockfile,
+                channel_mirror=channel_mirror)
+        except Exception as e:
+            logger.error('Bootstrap failure: %s', str(e))
+            return [(name, e) for name, _ in envs]
+    _backend_environ.clear()
+    if offline:
+        _backend_environ.update(_offline_environ(wheel_dir))
+    tmp_removals = []
+    with _prefix_lock(prefix):
+        with _phase('prepare_conda'):
+            _prepare_conda(prefix, reset_conda)
+        try:
+            _miniconda_phase(prefix, tmp_removals, cache_dir, cache_size,
+                             installer_sha256, installer=installer,
+                             offline=offline)
+        except Exception as e:
+            logger.error('Bootstrap failure: %s', str(e))
+            _cleanup_removals(tmp_removals)
+            return [(name, e) for name, _ in envs]
+        try:
+            with _phase('backend'):
+                if pkgs_dir:
+                    _configure_pkgs_dir(prefix, pkgs_dir)
+                if channel_mirror:
+                    _configure_channel_mirror(prefix, channel_mirror)
+                backend = _detect_backend(prefix, backend)
+        except Exception as e:
+            logger.error('Bootstrap failure: %s', str(e))
+            return [(name, e) for name, _ in envs]
+    logger.info("Using %s as backend", backend)
+    shared_pkgs_dir = _shared_pkgs_dir(prefix)
+    if jobs > 1 and len(envs) > 1 and shared_pkgs_dir is not None and \
+            _pkgs_dir_prefixes(shared_pkgs_dir) != [os.path.abspath(prefix)]:
+        logger.info("Shared package cache %s used by other conda "
+                    "installations: env installs run one at a time",
+                    shared_pkgs_dir)
+
+    def bootstrap_env(item):
+        name, environment = item
+        with _buffer_logs(name):
+            try:
+                name = _fix_bootstrap_name(name, warn=True)
+                logger.info("Using %s as environment file", environment)
+                environment = _skip_env_install(environment)
+                _bootstrap_env(prefix, name, environment, reset_env,
+                               force_install, profile_dir,
+                               skip_activate_script,
+                               use_lockfile=use_lockfile,
+                               write_lockfile=write_lockfile,
+                               backend=backend, templates=templates,
+                               probe_login_shell=probe_login_shell,
+                               require_lockfile=require_lockfile)
+            except Exception as e:
+                logger.error('Bootstrap failure: %s', str(e))
+                raise
+
+    handlers = logging.root.handlers + stdout.handlers
+    log_filter = _LogContextFilter()
+    for handler in handlers:
+        handler.addFilter(log_filter)
+    try:
+        results = _parallel_map(bootstrap_env, envs, jobs)
+    finally:
+        for handler in handlers:
+            handler.removeFilter(log_filter)
+    results = [(name, error) for (name, _), (_, error) in zip(envs, results)]
+    failures = [name for name, error in results if error is not None]
+    logger.info("Batch done: %d succeeded, %d failed",
+                len(results) - len(failures), len(failures))
+    for name, error in results:
+        if error is None:
+            logger.info("  %s: ok", name)
+        else:
+            logger.error("  %s: failed (%s)", name, error)
+    return results
 
 
 def _default_bootstrap_name(bootstrap_path):
@@ -563,11 +2939,29 @@ def _parser():
     # default conda prefix
     default_conda_prefix = os.getenv(ENV_BOOTSTRAP_CONDA_PREFIX,
                                      '~/.miniconda2')
+    # downloaded files cache
+    default_cache_dir = os.getenv(ENV_BOOTSTRAP_CACHE_DIR, DEFAULT_CACHE_DIR)
+    default_cache_size = int(os.getenv(ENV_BOOTSTRAP_CACHE_SIZE,
+                                       DEFAULT_CACHE_SIZE))
+    default_jobs = int(os.getenv(ENV_BOOTSTRAP_JOBS, DEFAULT_JOBS))
+    default_backend = os.getenv(ENV_BOOTSTRAP_BACKEND, 'auto')
+    default_pkgs_dir = os.getenv(ENV_BOOTSTRAP_PKGS_DIR, None)
+    default_log_file = os.getenv(ENV_BOOTSTRAP_LOG_FILE, None)
+    default_log_format = os.getenv(ENV_BOOTSTRAP_LOG_FORMAT, 'text')
+    default_offline = os.getenv(ENV_BOOTSTRAP_OFFLINE, '') not in ('', '0')
+    default_installer = os.getenv(ENV_BOOTSTRAP_INSTALLER, None)
+    default_wheel_dir = os.getenv(ENV_BOOTSTRAP_WHEEL_DIR, None)
+    default_channel_mirror = os.getenv(ENV_BOOTSTRAP_CHANNEL_MIRROR, None)
     # default environment.yml path
     default_environment_yml = \
         os.getenv(ENV_BOOTSTRAP_CONDA_ENVYML,
                   os.path.join(default_bootstrap_path, 'environment.yml'))
-    cmd = argparse.ArgumentParser(description=COMMAND_DESCRIPTION)
+    cmd = argparse.ArgumentParser(
+        description=COMMAND_DESCRIPTION,
+        epilog="'bootstrap.py list' and 'bootstrap.py status [NAME]' show "
+               "bootstrapped envs; 'bootstrap.py mirror OUTPUT "
+               "ENVIRONMENT...' builds a local channels mirror (use "
+               "'-- list' to run a command named list).")
     cmd.add_argument('--name',
                      dest='name', default=default_bootstrap_name,
                      help='Name for your conda environment.')
@@ -575,12 +2969,56 @@ def _parser():
                      dest='environment',
                      default=default_environment_yml,
                      help='environment.yml for your conda environment.')
+    cmd.add_argument('--batch',
+                     dest='batch', default=None,
+                     help='File listing NAME ENVIRONMENT_YML pairs to bootstrap '
+                          '(--name and --environment are ignored).')
+    cmd.add_argument('--jobs', dest='jobs', type=int, default=default_jobs,
+                     help='Count of envs bootstrapped in parallel (--batch); '
+                          'with a --pkgs-dir used by other conda '
+                          'installations, env installs still run one at a '
+                          'time as the shared package cache is locked.')
     cmd.add_argument('--reset-conda',
                      dest='reset_conda', action='store_true', default=False,
                      help='Delete existing conda install (DANGER).')
     cmd.add_argument('--reset-env',
                      dest='reset_env', action='store_true', default=False,
                      help='Delete existing conda environment.')
+    cmd.add_argument('--force-install',
+                     dest='force_install', action='store_true', default=False,
+                     help='Install environment even if unchanged.')
+    cmd.add_argument('--ignore-lockfile',
+                     dest='use_lockfile', action='store_false', default=True,
+                     help='Solve environment even if an explicit lockfile '
+                          '(environment.lock) exists.')
+    cmd.add_argument('--write-lockfile',
+                     dest='write_lockfile', action='store_true', default=False,
+                     help='Solve environment and write its explicit lockfile.')
+    cmd.add_argument('--require-lockfile',
+                     dest='require_lockfile', action='store_true',
+                     default=False,
+                     help='Fail if environment has no lockfile, or if it '
+                          'changed since it was locked.')
+    cmd.add_argument('--backend', dest='backend', default=default_backend,
+                     choices=('auto',) + BACKENDS,
+                     help='Tool used to create and install envs; auto '
+                          'selects the first of {0} found in prefix.'
+                          .format(', '.join(BACKENDS)))
+    cmd.add_argument('--pkgs-dir', dest='pkgs_dir', default=default_pkgs_dir,
+                     help='Package cache shared by conda installations '
+                          '(ex: ~/.cache/clickable_bootstrap/pkgs).')
+    cmd.add_argument('--templates', dest='templates', action='store_true',
+                     default=False,
+                     help='Clone new envs from the closest template env and '
+                          'keep installed envs as templates.')
+    cmd.add_argument('--log-file', dest='log_file', default=default_log_file,
+                     help='Append whole output of commands to this file.')
+    cmd.add_argument('--log-format', dest='log_format',
+                     default=default_log_format, choices=('text', 'json'),
+                     help='Log messages as colored text or as JSON lines.')
+    cmd.add_argument('--report', dest='report', default=None,
+                     help='Write phases and commands timings to this JSON '
+                          'file.')
     cmd.add_argument('-v', '--verbose', dest='verbose', action='count', default=0,
                      help='Enable verbose output')
     cmd.add_argument('--prefix',
@@ -592,12 +3030,79 @@ def _parser():
     cmd.add_argument('--skip-activate-script', dest='skip_activate_script',
                      action='store_true', default=False,
                      help='Do not create activate-[NAME] script')
+    cmd.add_argument('--probe-login-shell', dest='probe_login_shell',
+                     action='store_true', default=False,
+                     help='Run a login shell to check if bootstrap.conf is '
+                          'sourced when shell startup files do not show it '
+                          '(slow).')
+    cmd.add_argument('--cache-dir', dest='cache_dir', default=default_cache_dir,
+                     help='Cache for downloaded files (empty to disable).')
+    cmd.add_argument('--cache-size', dest='cache_size', type=int,
+                     default=default_cache_size,
+                     help='Cache size budget in MiB.')
+    cmd.add_argument('--installer-sha256', dest='installer_sha256', default=None,
+                     help='Expected sha256 of Miniconda installer.')
+    cmd.add_argument('--installer', dest='installer',
+                     default=default_installer,
+                     help='Local Miniconda installer (no download).')
+    cmd.add_argument('--offline', dest='offline', action='store_true',
+                     default=default_offline,
+                     help='Do not use network: installer from --installer or '
+                          'cache, conda packages from file:// channels and '
+                          'package caches, pip packages from --wheel-dir.')
+    cmd.add_argument('--wheel-dir', dest='wheel_dir',
+                     default=default_wheel_dir,
+                     help='Folder of wheels for pip dependencies (--offline).')
+    cmd.add_argument('--channel-mirror', dest='channel_mirror',
+                     default=default_channel_mirror,
+                     help='Channels mirror (url or folder built by '
+                          "'bootstrap.py mirror'): channel names of "
+                          'environments resolve to its channels.')
     cmd.add_argument('args', nargs=argparse.REMAINDER,
                      help='Command launched in environment (ex: powo-roles install --help).')
     return cmd
 
 
+#: commands that are not bootstrap runs; see _registry_main
+REGISTRY_COMMANDS = ('list', 'status')
+#: channels mirror builder command; see _mirror_main
+MIRROR_COMMAND = 'mirror'
+
+
+def _main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in REGISTRY_COMMANDS:
+        return _registry_main(argv)
+    if argv and argv[0] == MIRROR_COMMAND:
+        return _mirror_main(argv[1:])
+    parser = _parser()
+    args = vars(parser.parse_args(argv))
+    batch = args.pop('batch')
+    jobs = args.pop('jobs')
+    _open_log_file(args.pop('log_file'))
+    if args.pop('log_format') == 'json':
+        _json_logs()
+    report = args.pop('report')
+    if batch is not None and args['args']:
+        parser.error('a command cannot be launched with --batch')
+    if report:
+        _report_start()
+    try:
+        if batch is None:
+            return 0 if _bootstrap(**args) else 1
+        for key in ('name', 'environment', 'args'):
+            del args[key]
+        results = _bootstrap_batch(envs=_read_batch(batch), jobs=jobs, **args)
+        return 1 if [i for i in results if i[1] is not None] else 0
+    finally:
+        if report:
+            _report_write(report)
+
+
+# python -m bootstrap (bootstrap.py folder as working directory or in
+# PYTHONPATH) loads this module from cached bytecode; python bootstrap.py
+# compiles the whole script on each run
 if __name__ == '__main__':
     _initLogger()
-    args = _parser().parse_args()
-    _bootstrap(**vars(args))
+    sys.exit(_main())
@@ -0,0 +1,602 @@
+#! /bin/env python2
+# -*- encoding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4 expandtab ai
+
+"""Micro-benchmarks for bootstrap.py and bootstrap-repository.py.
+
+Launch all benchmarks, or only the ones given as arguments:
+
+    python tests/benchmark.py [env_exists backends logger startup noop
+                                shell_startup pipeline repository ...]
+
+BENCH_CONDA_PREFIX may point to a real conda installation (and
+BENCH_ENVIRONMENT to an environment.yml installed by backends
+benchmark); stub executables are used otherwise.
+
+pipeline and repository benchmarks run both scripts against stub conda,
+curl, git, pipenv and hatch executables sleeping --latency seconds
+(ex: --latency 0.05 --latency conda=0.4), and report time spent outside
+of them, by phase and by environment.
+
+--save-baseline FILE stores results; --baseline FILE compares results
+with stored ones and fails if one is slower by more than --tolerance.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# EnvOverrides
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def _measure(func, number=10, repeat=3):
+    """Return best time (seconds) of one call to func."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+#: benchmark name -> result name -> seconds, filled by _report
+RESULTS = {}
+#: name of running benchmark
+_current = [None]
+#: list collecting _report results instead of reporting them; see _best_of
+_collect = [None]
+
+
+def _report(name, seconds):
+    if _collect[0] is not None:
+        _collect[0].append((name, seconds))
+        return
+    print('{0:<40} {1:>10.3f} ms'.format(name, seconds * 1000))
+    RESULTS.setdefault(_current[0], {})[name] = seconds
+
+
+def _best_of(func, repeat=5):
+    """Call func 'repeat' times; report best time of each of its results."""
+    best = {}
+    for _ in range(repeat):
+        _collect[0] = []
+        try:
+            func()
+        finally:
+            (results, _collect[0]) = (_collect[0], None)
+        for name, seconds in results:
+            best[name] = min(seconds, best.get(name, seconds))
+    for name, seconds in best.items():
+        _report(name, seconds)
+
+
+def _stub(path, script):
+    """Write an executable script in path."""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(script)
+    os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+
+
+#: conda stub: a python interpreter startup, as conda does
+PYTHON_STUB = "#! {0}\nimport sys\nsys.exit(0)\n".format(sys.executable)
+
+
+def bench_env_exists():
+    """Filesystem probe vs conda list subprocess"""
+    import bootstrap
+    tmpdir = tempfile.mkdtemp()
+    try:
+        prefix = os.getenv('BENCH_CONDA_PREFIX', None)
+        if prefix is None:
+            prefix = os.path.join(tmpdir, 'prefix')
+            os.makedirs(os.path.join(prefix, 'conda-meta'))
+            os.makedirs(os.path.join(prefix, 'envs', 'bench', 'conda-meta'))
+            _stub(os.path.join(prefix, 'bin', 'conda'), PYTHON_STUB)
+        _report('env_exists filesystem probe',
+                _measure(lambda: bootstrap._env_exists_fs(prefix, 'bench'),
+                         number=1000))
+        _report('env_exists conda list',
+                _measure(lambda: bootstrap._subprocess_capture(
+                    bootstrap._command(prefix, 'conda', 'list', '-n', 'bench'))))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+#: simulated solve/install latency (seconds) of stub backends
+STUB_BACKEND_LATENCY = {'conda': 0.4, 'mamba': 0.1, 'micromamba': 0.05}
+
+
+def bench_backends():
+    """Env create + install + remove time by backend"""
+    import bootstrap
+    tmpdir = tempfile.mkdtemp()
+    try:
+        prefix = os.getenv('BENCH_CONDA_PREFIX', None)
+        environment = os.getenv('BENCH_ENVIRONMENT', None)
+        if prefix is None:
+            prefix = os.path.join(tmpdir, 'prefix')
+            for backend, latency in STUB_BACKEND_LATENCY.items():
+                _stub(os.path.join(prefix, 'bin', backend),
+                      '#! /bin/bash\nsleep {0}\n'.format(latency))
+        if environment is None:
+            environment = os.path.join(tmpdir, 'environment.yml')
+            with open(environment, 'w') as f:
+                f.write('dependencies: []\n')
+        for backend in bootstrap.BACKENDS:
+            if not os.path.exists(os.path.join(prefix, 'bin', backend)):
+                _report('{0} (not installed)'.format(backend), 0)
+                continue
+            name = 'bench-{0}'.format(backend)
+
+            def install():
+                bootstrap._env_create(prefix, name, backend=backend)
+                bootstrap._env_install(prefix, name, environment,
+                                       backend=backend)
+                bootstrap._env_remove(prefix, name, backend=backend)
+            _report('{0} create + install + remove'.format(backend),
+                    _measure(install, number=1))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class _StackLogger(object):
+    """Previous bootstrap.Logger: caller name from a whole stack walk"""
+
+    def __getattr__(self, name):
+        import logging
+        import traceback
+        try:
+            logger_name = traceback.extract_stack()[-2][2]
+        except:
+            logger_name = "none"
+        return getattr(logging.getLogger(logger_name), name)
+
+
+def bench_logger():
+    """Per-call cost of a filtered out debug message"""
+    import logging
+    import bootstrap
+    logging.root.setLevel(logging.INFO)
+    for name, logger in (('stack walk', _StackLogger()),
+                         ('caller frame + cache', bootstrap.logger)):
+        def log():
+            logger.debug('message %s', 'arg')
+        _report('logger.debug ({0})'.format(name),
+                _measure(log, number=10000))
+
+
+BOOTSTRAP = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'bootstrap.py')
+
+
+def _cached_call(args, **kwargs):
+    """Call 'python -m bootstrap args': bootstrap module is loaded from
+    cached bytecode (written by a first call), unlike python bootstrap.py
+    that compiles the whole script on each run."""
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    subprocess.check_call([sys.executable, '-m', 'bootstrap'] + args,
+                          cwd=os.path.dirname(BOOTSTRAP), env=env, **kwargs)
+
+
+def bench_startup():
+    """python bootstrap.py: interpreter, imports and argument parsing"""
+    with open(os.devnull, 'w') as devnull:
+        _report('python -c pass', _measure(
+            lambda: subprocess.check_call([sys.executable, '-c', 'pass'])))
+        _report('python bootstrap.py --help', _measure(
+            lambda: subprocess.check_call([sys.executable, BOOTSTRAP, '--help'],
+                                          stdout=devnull)))
+        _cached_call(['--help'], stdout=devnull)
+        _report('python -m bootstrap --help', _measure(
+            lambda: _cached_call(['--help'], stdout=devnull)))
+
+
+def bench_noop():
+    """python bootstrap.py on an already bootstrapped, unchanged env"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        prefix = os.path.join(tmpdir, 'prefix')
+        os.makedirs(os.path.join(prefix, 'conda-meta'))
+        _stub(os.path.join(prefix, 'bin', 'conda'),
+              '#! /bin/bash\n[ "$1" == "create" ] && '
+              'mkdir -p "$(dirname "$0")/../envs/$3/conda-meta"\nexit 0\n')
+        environment = os.path.join(tmpdir, 'environment.yml')
+        with open(environment, 'w') as f:
+            f.write('dependencies: []\n')
+        command = [sys.executable, BOOTSTRAP, '--prefix', prefix,
+                   '--name', 'bench', '--environment', environment,
+                   '--profile-dir', os.path.join(tmpdir, 'bootstrap.conf')]
+        with open(os.devnull, 'w') as devnull:
+            def run():
+                subprocess.check_call(command, stdout=devnull,
+                                      stderr=devnull)
+            run()
+            _report('python bootstrap.py (no-op)', _measure(run))
+
+            def run_cached():
+                _cached_call(command[2:], stdout=devnull, stderr=devnull)
+            run_cached()
+            _report('python -m bootstrap (no-op)', _measure(run_cached))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_shell_startup():
+    """Sourcing bootstrap.conf by env count: activation index vs *.conf"""
+    import bootstrap
+    for count in (1, 10, 50, 200):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            conf = os.path.join(tmpdir, 'bootstrap.conf')
+            conf_d = conf + '.d'
+            os.makedirs(conf_d)
+            with open(conf, 'w') as f:
+                f.write(bootstrap.BOOTSTRAP_ACTIVATE_SCRIPT.format(conf_d))
+            for i in range(count):
+                name = 'env{0}'.format(i)
+                with open(os.path.join(conf_d, 'activate-{0}.conf'
+                                       .format(name)), 'w') as f:
+                    f.write(bootstrap.ACTIVATE_SCRIPT.format(
+                        '/nonexistent/bin/activate', name))
+            command = ['/bin/bash', '-c', 'source {0}'.format(conf)]
+            _report('{0} envs, *.conf'.format(count),
+                    _measure(lambda: subprocess.check_call(command)))
+            bootstrap._write_activate_index(conf_d)
+            _report('{0} envs, index'.format(count),
+                    _measure(lambda: subprocess.check_call(command)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+#: stubs simulated latency (seconds): default and by tool, see --latency
+STUB_LATENCY = {'default': 0.05}
+
+#: appended by stubs to calls log: tool, first argument, start, end
+STUB_LOG = 'echo "{name} $1 $start $EPOCHREALTIME" >> {log}'
+
+#: conda stub: create makes env folder, list succeeds if env exists
+CONDA_STUB = """#! /bin/bash
+start=$EPOCHREALTIME
+trap '""" + STUB_LOG + """' EXIT
+sleep {latency}
+prefix="$(cd "$(dirname "$0")/.." && pwd)"
+case "$1" in
+    create) mkdir -p "$prefix/envs/$3/conda-meta";;
+    list) [ "$2" == "--explicit" ] && echo @EXPLICIT
+          [ -d "$prefix/envs/${{@: -1}}" ];;
+esac
+"""
+
+#: Miniconda installer served by curl stub: installs conda stub in -p PREFIX
+INSTALLER_STUB = """#! /bin/bash
+while [ $# -gt 0 ] && [ "$1" != "-p" ]; do shift; done
+prefix="$2"
+[ -n "$prefix" ] || exit 1
+mkdir -p "$prefix/conda-meta" "$prefix/bin"
+cp {conda} "$prefix/bin/conda"
+touch "$prefix/bin/activate"
+"""
+
+CURL_STUB = """#! /bin/bash
+start=$EPOCHREALTIME
+trap '""" + STUB_LOG + """' EXIT
+sleep {latency}
+cat {installer}
+"""
+
+#: git stub: network commands sleep, then real git is run
+GIT_STUB = """#! /bin/bash
+start=$EPOCHREALTIME
+trap '""" + STUB_LOG + """' EXIT
+case "$1" in
+    clone|fetch|pull|ls-remote|remote) sleep {latency};;
+esac
+{git} "$@"
+"""
+
+#: pipenv and hatch stubs: venv is next to project, as pipenv and hatch
+#: keep it out of the working copy
+PIPENV_STUB = """#! /bin/bash
+start=$EPOCHREALTIME
+trap '""" + STUB_LOG + """' EXIT
+sleep {latency}
+venv="$PWD.venv"
+case "$1" in
+    --venv) echo "$venv";;
+    install) mkdir -p "$venv/bin"; cp {tool} "$venv/bin/";;
+    run) shift; PATH="$venv/bin:$PATH" "$@";;
+esac
+"""
+
+HATCH_STUB = """#! /bin/bash
+start=$EPOCHREALTIME
+trap '""" + STUB_LOG + """' EXIT
+sleep {latency}
+venv="$PWD.venv"
+case "$1" in
+    env) echo "$venv";;
+    run) mkdir -p "$venv/bin"; cp {tool} "$venv/bin/"
+         shift; PATH="$venv/bin:$PATH" "$@";;
+esac
+"""
+
+
+def _latency(tool):
+    return STUB_LATENCY.get(tool, STUB_LATENCY['default'])
+
+
+def _stubs(tmpdir):
+    """Write conda, curl, git, pipenv and hatch stubs in tmpdir/stubs;
+    return (stubs folder, calls log path)."""
+    stubs = os.path.join(tmpdir, 'stubs')
+    log = os.path.join(tmpdir, 'calls.log')
+    tool = os.path.join(tmpdir, 'tool')
+    _stub(tool, '#! /bin/bash\nexit 0\n')
+    conda = os.path.join(tmpdir, 'conda')
+    _stub(conda, CONDA_STUB.format(name='conda', log=log,
+                                   latency=_latency('conda')))
+    installer = os.path.join(tmpdir, 'installer.sh')
+    _stub(installer, INSTALLER_STUB.format(conda=conda))
+    _stub(os.path.join(stubs, 'curl'), CURL_STUB.format(
+        name='curl', log=log, latency=_latency('curl'), installer=installer))
+    _stub(os.path.join(stubs, 'git'), GIT_STUB.format(
+        name='git', log=log, latency=_latency('git'),
+        git=shutil.which('git') or '/bin/git'))
+    _stub(os.path.join(stubs, 'pipenv'), PIPENV_STUB.format(
+        name='pipenv', log=log, latency=_latency('pipenv'), tool=tool))
+    _stub(os.path.join(stubs, 'hatch'), HATCH_STUB.format(
+        name='hatch', log=log, latency=_latency('hatch'), tool=tool))
+    return stubs, log
+
+
+def _stub_overrides(stubs):
+    """Environment running stubs instead of real tools; restore() it."""
+    from bootstrap_test import EnvOverrides
+    overrides = EnvOverrides()
+    overrides['PATH'] = os.pathsep.join([stubs, os.environ['PATH']])
+    overrides['BOOTSTRAP_DOWNLOADER'] = 'curl'
+    return overrides
+
+
+def _calls(log):
+    """Stub calls (tool, argument, start, end) logged since last call."""
+    if not os.path.exists(log):
+        return []
+    with open(log) as f:
+        calls = [line.split() for line in f if line.strip()]
+    os.remove(log)
+    return [(i[0], i[1], float(i[-2]), float(i[-1])) for i in calls]
+
+
+def _stub_time(calls, start, end):
+    """Time spent in stubs between start and end (overlapping calls of
+    parallel runs are counted once)."""
+    intervals = sorted((max(i[2], start), min(i[3], end)) for i in calls
+                       if i[3] > start and i[2] < end)
+    total, current = 0, None
+    for (a, b) in intervals:
+        if current is None or a > current[1]:
+            if current is not None:
+                total += current[1] - current[0]
+            current = [a, b]
+        else:
+            current[1] = max(current[1], b)
+    if current is not None:
+        total += current[1] - current[0]
+    return total
+
+
+def _report_phases(scenario, report, calls, envs=1):
+    """Report overhead (duration minus stub time) of bootstrap.py report
+    phases, summed by phase path; env phases are divided by envs."""
+    overheads = {}
+    for phase in report['phases']:
+        path = phase['name'] if phase['parent'] is None \
+            else '{0}/{1}'.format(phase['parent'], phase['name'])
+        overhead = phase['duration'] - _stub_time(
+            calls, phase['start'], phase['start'] + phase['duration'])
+        if phase['env'] is not None:
+            overhead /= envs
+        overheads[path] = overheads.get(path, 0) + overhead
+    for path in sorted(overheads):
+        _report('{0} {1}'.format(scenario, path), overheads[path])
+    total = report['duration'] - _stub_time(
+        calls, report['start'], report['start'] + report['duration'])
+    _report('{0} total'.format(scenario), total / envs)
+
+
+def bench_pipeline():
+    """bootstrap.py overhead by phase: fresh install, no-op, batch"""
+    _best_of(_pipeline)
+
+
+def _pipeline():
+    tmpdir = tempfile.mkdtemp()
+    stubs, log = _stubs(tmpdir)
+    overrides = _stub_overrides(stubs)
+    overrides['BOOTSTRAP_REGISTRY'] = os.path.join(tmpdir, 'registry.json')
+    try:
+        prefix = os.path.join(tmpdir, 'prefix')
+        report = os.path.join(tmpdir, 'report.json')
+        environment = os.path.join(tmpdir, 'environment.yml')
+        with open(environment, 'w') as f:
+            f.write('dependencies:\n  - python\n')
+        command = [sys.executable, BOOTSTRAP, '--prefix', prefix,
+                   '--report', report, '--cache-dir', '',
+                   '--profile-dir', os.path.join(tmpdir, 'bootstrap.conf')]
+
+        def run(scenario, args, envs=1):
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(command + args, stdout=devnull,
+                                      stderr=devnull)
+            with open(report) as f:
+                _report_phases(scenario, json.load(f), _calls(log), envs)
+        single = ['--name', 'bench', '--environment', environment]
+        run('fresh', single)
+        run('noop', single)
+        count = 10
+        batch = os.path.join(tmpdir, 'batch')
+        with open(batch, 'w') as f:
+            for i in range(count):
+                f.write('bench{0} {1}\n'.format(i, environment))
+        run('batch (per env)', ['--batch', batch], envs=count)
+    finally:
+        overrides.restore()
+        shutil.rmtree(tmpdir)
+
+
+BOOTSTRAP_REPOSITORY = os.path.join(os.path.dirname(BOOTSTRAP),
+                                    'bootstrap-repository.py')
+
+
+def _bootstrap_repository():
+    """bootstrap-repository.py module (cannot be imported by name)."""
+    import importlib.util
+    spec = importlib.util.spec_from_file_location('bootstrap_repository',
+                                                  BOOTSTRAP_REPOSITORY)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _git_remote(tmpdir, mode):
+    """Bare repository of a pipenv or hatch project; return its path."""
+    git = shutil.which('git') or '/bin/git'
+    work = os.path.join(tmpdir, 'work', mode)
+    os.makedirs(work)
+    with open(os.path.join(work, 'Pipfile' if mode == 'pipenv'
+                           else 'pyproject.toml'), 'w') as f:
+        f.write('[deps]\n')
+    with open(os.devnull, 'w') as devnull:
+        for args in (['init', '-q', '-b', 'main'], ['add', '.'],
+                     ['-c', 'user.name=bench', '-c',
+                      'user.email=bench@example.com', 'commit', '-q', '-m',
+                      'init']):
+            subprocess.check_call([git] + args, cwd=work, stdout=devnull)
+        remote = os.path.join(tmpdir, 'remote', mode + '.git')
+        subprocess.check_call([git, 'clone', '-q', '--bare', work, remote],
+                              stdout=devnull)
+    return remote
+
+
+def bench_repository():
+    """bootstrap-repository.py overhead by phase: clone, up-to-date"""
+    _best_of(_repository)
+
+
+def _repository():
+    import contextlib
+    module = _bootstrap_repository()
+    tmpdir = tempfile.mkdtemp()
+    stubs, log = _stubs(tmpdir)
+    overrides = _stub_overrides(stubs)
+    phases = []
+
+    def timed(name, func):
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                phases.append((name, start, time.time()))
+        return wrapper
+    module._git_phase = timed('git', module._git_phase)
+    module._env_phase = timed('env', module._env_phase)
+    try:
+        for mode in ('pipenv', 'hatch'):
+            url = _git_remote(tmpdir, mode)
+            for scenario in ('clone', 'up-to-date'):
+                with open(os.devnull, 'w') as devnull, \
+                        contextlib.redirect_stderr(devnull):
+                    start = time.time()
+                    module._bootstrap(os.path.join(stubs, 'git'), url,
+                                      os.path.join(tmpdir, 'repositories'),
+                                      None, ['tool'], output=devnull)
+                    end = time.time()
+                calls = _calls(log)
+                for name, a, b in phases:
+                    _report('{0} {1} {2}'.format(mode, scenario, name),
+                            b - a - _stub_time(calls, a, b))
+                _report('{0} {1} total'.format(mode, scenario),
+                        end - start - _stub_time(calls, start, end))
+                del phases[:]
+    finally:
+        overrides.restore()
+        shutil.rmtree(tmpdir)
+
+
+BENCHMARKS = [
+    ('env_exists', bench_env_exists),
+    ('backends', bench_backends),
+    ('logger', bench_logger),
+    ('startup', bench_startup),
+    ('noop', bench_noop),
+    ('shell_startup', bench_shell_startup),
+    ('pipeline', bench_pipeline),
+    ('repository', bench_repository),
+]
+
+
+#: results below this difference (seconds) are never regressions
+REGRESSION_NOISE = 0.005
+
+
+def _compare(baseline, tolerance):
+    """Print results slower than 'baseline' by more than 'tolerance'
+    (ratio); return their count."""
+    regressions = 0
+    for benchmark, results in sorted(RESULTS.items()):
+        for name, seconds in sorted(results.items()):
+            base = baseline.get(benchmark, {}).get(name)
+            if base is None:
+                continue
+            if seconds > base * (1 + tolerance) \
+                    and seconds - base > REGRESSION_NOISE:
+                regressions += 1
+                print('REGRESSION {0}: {1:.3f} ms (baseline {2:.3f} ms, '
+                      '{3:+.0%})'.format(name, seconds * 1000, base * 1000,
+                                         seconds / base - 1))
+    return regressions
+
+
+def _parser():
+    cmd = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    cmd.add_argument('benchmarks', nargs='*',
+                     help='Benchmarks to run (default: all).')
+    cmd.add_argument('--latency', action='append', default=[],
+                     help='Stubs latency in seconds (TOOL=SECONDS for one '
+                          'of conda, curl, git, pipenv, hatch).')
+    cmd.add_argument('--baseline', default=None,
+                     help='Compare results with this baseline file.')
+    cmd.add_argument('--save-baseline', default=None,
+                     help='Write results in this baseline file.')
+    cmd.add_argument('--tolerance', type=float, default=0.5,
+                     help='Slowdown ratio reported as regression.')
+    return cmd
+
+
+if __name__ == '__main__':
+    args = _parser().parse_args()
+    for latency in args.latency:
+        (tool, _, seconds) = latency.rpartition('=')
+        STUB_LATENCY[tool or 'default'] = float(seconds)
+    for name, benchmark in BENCHMARKS:
+        if not args.benchmarks or name in args.benchmarks:
+            print('# {0}: {1}'.format(name, benchmark.__doc__))
+            _current[0] = name
+            benchmark()
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(RESULTS, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            sys.exit(1 if _compare(json.load(f), args.tolerance) else 0)
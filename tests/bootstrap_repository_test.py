@@ -0,0 +1,322 @@
+#! /bin/env python2
+# -*- encoding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4 expandtab ai
+
+import os
+import pytest
+import shutil
+import stat
+import subprocess
+
+
+def _module():
+    """bootstrap-repository.py cannot be imported with an import statement"""
+    import importlib.util
+    path = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'bootstrap-repository.py')
+    spec = importlib.util.spec_from_file_location('bootstrap_repository',
+                                                  path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+GIT = shutil.which('git')
+
+def _git(*args, **kwargs):
+    subprocess.check_call([GIT, '-c', 'user.name=test',
+                           '-c', 'user.email=test@example.com'] + list(args),
+                          stdout=subprocess.DEVNULL, **kwargs)
+
+def _git_repository(tmpdir, name, bootstrap_script):
+    """Create a bare repository 'name.git' whose bootstrap/bootstrap.sh is
+    'bootstrap_script'; return its url"""
+    work = tmpdir.join('work', name)
+    script = work.join('bootstrap/bootstrap.sh')
+    script.write(bootstrap_script, ensure=True)
+    script.chmod(stat.S_IRWXU)
+    _git('init', '-q', '-b', 'main', str(work))
+    _git('add', '.', cwd=str(work))
+    _git('commit', '-q', '-m', 'init', cwd=str(work))
+    work.join('README').write('readme\n')
+    _git('add', '.', cwd=str(work))
+    _git('commit', '-q', '-m', 'readme', cwd=str(work))
+    bare = tmpdir.join('remote', '{0}.git'.format(name))
+    _git('clone', '-q', '--bare', str(work), str(bare))
+    # partial clones
+    _git('config', 'uploadpack.allowFilter', 'true', cwd=str(bare))
+    return str(bare)
+
+def _git_output(path, *args):
+    return subprocess.check_output([GIT] + list(args), cwd=str(path),
+                                   universal_newlines=True).strip()
+
+#: bootstrap.sh recording its arguments next to the working copy
+RECORDING_BOOTSTRAP = """#! /bin/bash
+echo "$@" > "../$(basename "$PWD").args"
+"""
+
+def test_read_manifest(tmpdir):
+    module = _module()
+    manifest = tmpdir.join('manifest')
+    manifest.write("""# tools
+https://example.com/a.git
+https://example.com/b.git  develop   # comment
+https://example.com/c.git - --help 'two words'
+
+""")
+    assert [('https://example.com/a.git', None, []),
+            ('https://example.com/b.git', 'develop', []),
+            ('https://example.com/c.git', None, ['--help', 'two words'])] \
+        == module._read_manifest(str(manifest))
+    shutil.rmtree(str(tmpdir))
+
+@pytest.mark.skipif(GIT is None, reason='git not installed')
+def test_bootstrap_manifest(tmpdir, capfd):
+    """Repositories are bootstrapped in parallel; a failing repository does
+    not stop the other ones"""
+    module = _module()
+    urls = [_git_repository(tmpdir, name, RECORDING_BOOTSTRAP)
+            for name in ('one', 'two')]
+    urls.append(_git_repository(tmpdir, 'bad', '#! /bin/bash\nexit 1\n'))
+    manifest = tmpdir.join('manifest')
+    manifest.write('{0}\n{1} main arg1 arg2\n{2}\n'.format(*urls))
+    repositories = tmpdir.join('repositories')
+    assert 1 == module._main(['--manifest', str(manifest),
+                              '--repository-path', str(repositories),
+                              '--git-command', GIT, '--jobs', '2',
+                              '--env-jobs', '1'])
+    assert '--\n' == repositories.join('one.args').read()
+    assert '-- arg1 arg2\n' == repositories.join('two.args').read()
+    assert repositories.join('bad/bootstrap/bootstrap.sh').isfile()
+    for name in ('one', 'two', 'bad'):
+        assert repositories.join('.bootstrap-logs/{0}.log'.format(name)) \
+            .isfile()
+    err = capfd.readouterr().err
+    assert 'Manifest done: 2 succeeded, 1 failed.' in err
+    assert '[ERROR]   bad: failed' in err
+    shutil.rmtree(str(tmpdir))
+
+@pytest.mark.skipif(GIT is None, reason='git not installed')
+def test_bootstrap_clone_options(tmpdir):
+    """Shallow, partial and reference cache clones"""
+    module = _module()
+    url = 'file://' + _git_repository(tmpdir, 'tool', RECORDING_BOOTSTRAP)
+    repositories = tmpdir.join('repositories')
+    cache = tmpdir.join('cache')
+    kwargs = dict(git_command=GIT, git_url=url,
+                  repository_path=str(repositories), ref=None, args=[],
+                  depth=1, clone_filter='blob:none',
+                  reference_cache=str(cache))
+    module._bootstrap(**kwargs)
+    clone = repositories.join('tool')
+    assert 'true' == _git_output(clone, 'rev-parse', '--is-shallow-repository')
+    assert 'true' == _git_output(clone, 'config', 'remote.origin.promisor')
+    (mirror,) = [i for i in cache.listdir() if i.ext == '.git']
+    assert str(mirror.join('objects')) == \
+        clone.join('.git/objects/info/alternates').read().strip()
+    assert '--\n' == repositories.join('tool.args').read()
+    # mirror is updated, not cloned again
+    module._bootstrap(reset_git=True, **kwargs)
+    assert [mirror] == [i for i in cache.listdir() if i.ext == '.git']
+    assert clone.join('README').isfile()
+    shutil.rmtree(str(tmpdir))
+
+@pytest.mark.skipif(GIT is None, reason='git not installed')
+def test_bootstrap_up_to_date(tmpdir, capfd):
+    """An unchanged working copy is only fetched"""
+    module = _module()
+    url = _git_repository(tmpdir, 'tool', RECORDING_BOOTSTRAP)
+    calls = tmpdir.join('git.calls')
+    git = tmpdir.join('git')
+    git.write('#! /bin/bash\necho "$1" >> {0}\nexec {1} "$@"\n'
+              .format(calls, GIT))
+    git.chmod(stat.S_IRWXU)
+    repositories = tmpdir.join('repositories')
+    kwargs = dict(git_command=str(git), git_url=url,
+                  repository_path=str(repositories), ref=None, args=[])
+
+    def commands():
+        result = calls.read().split()
+        calls.remove()
+        return result
+    module._bootstrap(**kwargs)
+    assert 'clone' in commands()
+    module._bootstrap(**kwargs)
+    run = commands()
+    assert 1 == run.count('fetch')
+    for command in ('remote', 'switch', 'clean', 'merge', 'pull', 'submodule'):
+        assert command not in run
+    assert 'Skipping switch, clean, pull and submodule update' \
+        in capfd.readouterr().err
+    # new remote commit
+    work = tmpdir.join('work', 'tool')
+    work.join('README').write('updated\n')
+    _git('commit', '-q', '-a', '-m', 'update', cwd=str(work))
+    _git('push', '-q', url, 'main', cwd=str(work))
+    module._bootstrap(**kwargs)
+    run = commands()
+    assert 1 == run.count('fetch')
+    for command in ('switch', 'clean', 'merge'):
+        assert command in run
+    assert 'pull' not in run
+    assert 'updated\n' == repositories.join('tool/README').read()
+    assert 'Skipping submodule update: no submodules.' \
+        in capfd.readouterr().err
+    shutil.rmtree(str(tmpdir))
+
+@pytest.mark.skipif(GIT is None, reason='git not installed')
+def test_bootstrap_submodules(tmpdir, monkeypatch, capfd):
+    """Submodules are updated with their own reference mirror, and skipped
+    when unchanged"""
+    # file:// submodules are disabled by default
+    monkeypatch.setenv('GIT_CONFIG_COUNT', '1')
+    monkeypatch.setenv('GIT_CONFIG_KEY_0', 'protocol.file.allow')
+    monkeypatch.setenv('GIT_CONFIG_VALUE_0', 'always')
+    module = _module()
+    libs = [_git_repository(tmpdir, name, RECORDING_BOOTSTRAP)
+            for name in ('lib1', 'lib2')]
+    url = _git_repository(tmpdir, 'meta', RECORDING_BOOTSTRAP)
+    work = tmpdir.join('work', 'meta')
+    for lib in libs:
+        _git('-c', 'protocol.file.allow=always', 'submodule', 'add', '-q',
+             'file://' + lib, cwd=str(work))
+    _git('commit', '-q', '-m', 'submodules', cwd=str(work))
+    _git('push', '-q', url, 'main', cwd=str(work))
+    repositories = tmpdir.join('repositories')
+    cache = tmpdir.join('cache')
+    kwargs = dict(git_command=GIT, git_url=url,
+                  repository_path=str(repositories), ref=None, args=[],
+                  reference_cache=str(cache), submodule_jobs=2)
+    module._bootstrap(**kwargs)
+    clone = repositories.join('meta')
+    for lib in ('lib1', 'lib2'):
+        assert clone.join(lib, 'README').isfile()
+        (mirror,) = [i for i in cache.listdir()
+                     if i.basename.startswith(lib) and i.ext == '.git']
+        assert str(mirror.join('objects')) == clone.join(
+            '.git/modules', lib, 'objects/info/alternates').read().strip()
+    assert 'Updating 2 submodules (0 up to date, skipped).' \
+        in capfd.readouterr().err
+    # only the moved submodule is updated
+    lib1 = work.join('lib1')
+    lib1.join('README').write('updated\n')
+    _git('commit', '-q', '-a', '-m', 'update', cwd=str(lib1))
+    _git('push', '-q', 'origin', 'HEAD:main', cwd=str(lib1))
+    _git('commit', '-q', '-a', '-m', 'update lib1', cwd=str(work))
+    _git('push', '-q', url, 'main', cwd=str(work))
+    module._bootstrap(**kwargs)
+    assert 'updated\n' == clone.join('lib1', 'README').read()
+    assert 'Updating 1 submodules (1 up to date, skipped).' \
+        in capfd.readouterr().err
+    shutil.rmtree(str(tmpdir))
+
+#: pipenv and hatch stubs: install creates venv, run and --venv/env find
+#: use it, run resolves script 'script' as 'tool script'; calls are
+#: recorded in calls file
+ENV_STUBS = {
+    'pipenv': """#! /bin/bash
+echo "pipenv $1" >> {calls}
+case "$1" in
+    --venv) echo {venv};;
+    install) mkdir -p {venv}/bin; cp {tool} {venv}/bin/;;
+    run) shift; [ "$1" == script ] && set -- tool script
+         VIRTUAL_ENV={venv} PATH={venv}/bin:$PATH exec "$@";;
+esac
+""",
+    'hatch': """#! /bin/bash
+echo "hatch $1" >> {calls}
+case "$1" in
+    env) echo {venv};;
+    run) mkdir -p {venv}/bin; cp {tool} {venv}/bin/
+         shift; [ "$1" == script ] && set -- tool script
+         VIRTUAL_ENV={venv} PATH={venv}/bin:$PATH exec "$@";;
+esac
+"""}
+
+#: first call of an env install by mode
+ENV_INSTALL = {'pipenv': 'pipenv install', 'hatch': 'hatch run'}
+
+def _env_stub(tmpdir, monkeypatch, mode):
+    """Install `mode` stub in PATH; return a function popping its calls"""
+    calls = tmpdir.join('calls')
+    bin_path = tmpdir.join('bin')
+    tool = tmpdir.join('tool')
+    tool.write('#! /bin/bash\necho "tool $VIRTUAL_ENV $@" >> {0}\n'
+               .format(calls))
+    tool.chmod(stat.S_IRWXU)
+    stub = bin_path.join(mode)
+    stub.write(ENV_STUBS[mode].format(calls=calls, venv=tmpdir.join('venv'),
+                                      tool=tool), ensure=True)
+    stub.chmod(stat.S_IRWXU)
+    monkeypatch.setenv('PATH', '{0}:{1}'.format(bin_path, os.getenv('PATH')))
+
+    def commands():
+        result = calls.read().splitlines()
+        calls.remove()
+        return result
+    return commands
+
+@pytest.mark.parametrize('mode,inputs', [('pipenv', 'Pipfile'),
+                                         ('hatch', 'pyproject.toml')])
+def test_env_phase_unchanged(tmpdir, monkeypatch, capfd, mode, inputs):
+    """Env install is skipped when dependency inputs are unchanged"""
+    module = _module()
+    commands = _env_stub(tmpdir, monkeypatch, mode)
+    target = tmpdir.join('target')
+    target.join('.git').ensure(dir=True)
+    target.join(inputs).write('[deps]\n')
+    venv = tmpdir.join('venv')
+    module._env_phase(str(target), ['tool', 'arg'], False, False)
+    assert ENV_INSTALL[mode] in commands()
+    module._env_phase(str(target), ['tool', 'arg'], False, False)
+    # pipenv run is kept (scripts, .env); hatch is bypassed
+    assert {'pipenv': ['pipenv run', 'tool {0} arg'.format(venv)],
+            'hatch': ['tool {0} arg'.format(venv)]}[mode] == commands()
+    assert 'unchanged' in capfd.readouterr().err
+    target.join(inputs).write('[deps]\nother = "*"\n')
+    module._env_phase(str(target), ['tool', 'arg'], False, False)
+    assert ENV_INSTALL[mode] in commands()
+    # reset always rebuilds
+    module._env_phase(str(target), ['tool', 'arg'], True, False)
+    assert ENV_INSTALL[mode] in commands()
+    shutil.rmtree(str(tmpdir))
+
+def test_env_phase_unchanged_hatch_env_vars(tmpdir, monkeypatch):
+    """hatch env-vars disable the fast path"""
+    module = _module()
+    commands = _env_stub(tmpdir, monkeypatch, 'hatch')
+    target = tmpdir.join('target')
+    target.join('.git').ensure(dir=True)
+    target.join('pyproject.toml').write(
+        '[tool.hatch.envs.default.env-vars]\nSOME_VAR = "value"\n')
+    module._env_phase(str(target), ['tool', 'arg'], False, False)
+    commands()
+    module._env_phase(str(target), ['tool', 'arg'], False, False)
+    run = commands()
+    assert 'hatch --version' in run
+    assert 'hatch run' in run
+    shutil.rmtree(str(tmpdir))
+
+@pytest.mark.parametrize('mode,inputs,content', [
+    ('pipenv', 'Pipfile', '[scripts]\nscript = "tool script"\n'),
+    ('hatch', 'pyproject.toml',
+     '[tool.hatch.envs.default.scripts]\nscript = "tool script"\n')])
+def test_env_phase_unchanged_script(tmpdir, monkeypatch, mode, inputs,
+                                    content):
+    """pipenv and hatch scripts behave the same on the fast path"""
+    module = _module()
+    commands = _env_stub(tmpdir, monkeypatch, mode)
+    target = tmpdir.join('target')
+    target.join('.git').ensure(dir=True)
+    target.join(inputs).write(content)
+    venv = tmpdir.join('venv')
+    module._env_phase(str(target), ['script'], False, False)
+    assert 'tool {0} script'.format(venv) in commands()
+    module._env_phase(str(target), ['script'], False, False)
+    run = commands()
+    assert '{0} run'.format(mode) in run
+    assert 'tool {0} script'.format(venv) in run
+    # hatch scripts disable the fast path
+    assert (mode == 'hatch') == ('hatch --version' in run)
+    assert 'pipenv install' not in run
+    shutil.rmtree(str(tmpdir))
@@ -2,6 +2,7 @@
 # -*- encoding: utf-8 -*-
 # vim: tabstop=4 shiftwidth=4 softtabstop=4 expandtab ai
 
+import hashlib
 import logging
 import os
 import py
@@ -21,6 +22,14 @@ except ImportError:
     # Python 2.6
     from ordereddict import OrderedDict
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
 
 class EnvOverrides(object):
     """This class allows to register environment modification so that it
@@ -59,6 +68,20 @@ def environment():
     yield environment
     environment.restore()
 
+@pytest.fixture(autouse=True)
+def reap_synchronously():
+    """Trees are deleted before tests clean their folders"""
+    with patch('bootstrap.REAP_IN_BACKGROUND', False):
+        yield
+
+@pytest.fixture(autouse=True)
+def no_registry():
+    """Tests do not record envs in user registry"""
+    environment = EnvOverrides()
+    environment['BOOTSTRAP_REGISTRY'] = ''
+    yield
+    environment.restore()
+
 @pytest.fixture()
 def chdir():
     import tempfile
@@ -69,6 +92,54 @@ def chdir():
     os.chdir(origpath)
     shutil.rmtree(newpath)
 
+class _RangeHandler(BaseHTTPRequestHandler):
+    """Serve server.content, honoring Range headers if server.ranges; the
+    server.failures first responses are truncated"""
+    def do_GET(self):
+        content = self.server.content
+        range_header = self.headers.get('Range')
+        self.server.requests.append(range_header)
+        if range_header and self.server.ranges:
+            start, end = [int(i) for i in range_header[6:].split('-')]
+            end = min(end, len(content) - 1)
+            body = content[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, end, len(content)))
+        else:
+            body = content
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.server.failures > 0 and len(body) > 1:
+            self.server.failures -= 1
+            body = body[:len(body) // 2]
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+@pytest.fixture()
+def http_server():
+    """Local HTTP server stand-in; content, range support and failures are
+    set by tests, served urls are http_server.url + '/any-path'"""
+    import threading
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), _RangeHandler)
+    server.content = b''
+    server.ranges = True
+    server.failures = 0
+    server.requests = []
+    server.url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
 def _out(capture):
     """pytest for python 2.6 uses tuple instead of attributes"""
     try:
@@ -172,11 +243,109 @@ def test_download_error(capfd, caplog, tmpdir):
     assert len(records) == 0
     shutil.rmtree(str(tmpdir))
 
+@patch('bootstrap.DOWNLOAD_MIN_SEGMENT_SIZE', 100)
+def test_download_ranges(http_server, tmpdir):
+    """File is downloaded with parallel ranges and hashed on the fly"""
+    import hashlib
+    from bootstrap import _download
+    http_server.content = os.urandom(1000)
+    digest = hashlib.sha256()
+    stats = {}
+    (_, path) = _download(http_server.url + '/installer.sh', jobs=4,
+                          _tmpdir=str(tmpdir), digest=digest, stats=stats)
+    assert open(path, 'rb').read() == http_server.content
+    assert digest.hexdigest() == hashlib.sha256(http_server.content).hexdigest()
+    assert stats['bytes'] == 1000
+    # probe + 4 ranges
+    assert len(http_server.requests) == 5
+    assert 'bytes=750-999' in http_server.requests
+    assert len(tmpdir.listdir()) == 1
+    shutil.rmtree(str(tmpdir))
+
+def test_download_no_ranges(http_server, tmpdir):
+    """File is downloaded with one request if server ignores ranges"""
+    import hashlib
+    from bootstrap import _download
+    http_server.content = os.urandom(1000)
+    http_server.ranges = False
+    digest = hashlib.sha256()
+    (_, path) = _download(http_server.url + '/installer.sh', jobs=4,
+                          _tmpdir=str(tmpdir), digest=digest)
+    assert open(path, 'rb').read() == http_server.content
+    assert digest.hexdigest() == hashlib.sha256(http_server.content).hexdigest()
+    assert len(http_server.requests) == 1
+    shutil.rmtree(str(tmpdir))
+
+@patch('bootstrap.DOWNLOAD_MIN_SEGMENT_SIZE', 100)
+def test_download_retry(http_server, tmpdir):
+    """Interrupted range is retried from its last received byte"""
+    from bootstrap import _download
+    http_server.content = os.urandom(1000)
+    # first range response is truncated
+    http_server.failures = 1
+    (_, path) = _download(http_server.url + '/installer.sh', jobs=2,
+                          _tmpdir=str(tmpdir))
+    assert open(path, 'rb').read() == http_server.content
+    shutil.rmtree(str(tmpdir))
+
+@patch('bootstrap.DOWNLOAD_RETRIES', 0)
+@patch('bootstrap.DOWNLOAD_MIN_SEGMENT_SIZE', 100)
+def test_download_resume(http_server, caplog, tmpdir):
+    """A failed download keeps its partial file; next call resumes it"""
+    import hashlib
+    from bootstrap import _download
+    http_server.content = os.urandom(1000)
+    partial = tmpdir.join('partial', 'file')
+    # first range response is truncated
+    http_server.failures = 1
+    def f():
+        _download(http_server.url + '/installer.sh', jobs=1,
+                  _tmpdir=str(tmpdir), partial_path=str(partial))
+    pytest.raises(Exception, f)
+    assert partial.exists()
+    assert tmpdir.join('partial', 'file.state').exists()
+    # no leftover temporary file
+    assert len([i for i in tmpdir.listdir() if i.isfile()]) == 0
+    del http_server.requests[:]
+    digest = hashlib.sha256()
+    (_, path) = _download(http_server.url + '/installer.sh', jobs=1,
+                          _tmpdir=str(tmpdir), partial_path=str(partial),
+                          digest=digest)
+    assert open(path, 'rb').read() == http_server.content
+    assert digest.hexdigest() == hashlib.sha256(http_server.content).hexdigest()
+    assert 'bytes=500-999' in http_server.requests
+    assert not partial.exists()
+    assert not tmpdir.join('partial', 'file.state').exists()
+    assert None != re.search('resuming', caplog.records[0].message, flags=re.I)
+    shutil.rmtree(str(tmpdir))
+
 def test_command():
     from bootstrap import _command
     assert ['/prefix/bin/command', 'param1', 'param2'] == \
             _command('/prefix', 'command', 'param1', 'param2')
 
+def test_detect_backend(tmpdir):
+    """First available backend of mamba, micromamba and conda is used"""
+    from bootstrap import _detect_backend
+    assert 'conda' == _detect_backend(str(tmpdir))
+    _success_script(tmpdir.join('bin/conda'))
+    _success_script(tmpdir.join('bin/micromamba'))
+    assert 'micromamba' == _detect_backend(str(tmpdir))
+    assert 'micromamba' == _detect_backend(str(tmpdir), 'auto')
+    assert 'conda' == _detect_backend(str(tmpdir), 'conda')
+    pytest.raises(Exception, lambda: _detect_backend(str(tmpdir), 'mamba'))
+    shutil.rmtree(str(tmpdir))
+
+def test_backend_command():
+    from bootstrap import _backend_command
+    assert ['/prefix/bin/mamba', 'env', 'update', '-n', 'name', '--file',
+            'env.yml'] == _backend_command('/prefix', 'mamba', 'install',
+                                           name='name', file='env.yml')
+    assert ['/prefix/bin/micromamba', 'install', '-r', '/prefix', '-n', 'name',
+            '-f', 'env.yml', '-y'] == \
+        _backend_command('/prefix', 'micromamba', 'install', name='name',
+                         file='env.yml')
+
 def test_prepare_conda_not_existing(caplog, tmpdir):
     """If provided prefix is not existing, but parent of prefix exists,
     then nothing is done (prefix does not exist and parent directory is
@@ -224,6 +393,29 @@ def test_prepare_conda_reset_existing(caplog, tmpdir):
     assert len([i for i in records if i.name == 'stdout']) == 0
     shutil.rmtree(str(tmpdir))
 
+def test_trash(tmpdir):
+    """Tree is renamed at once then deleted by a background process"""
+    from bootstrap import _trash, TRASH_DIR
+    tree = tmpdir.join('tree')
+    tree.join('sub/file').ensure()
+    with patch('bootstrap.REAP_IN_BACKGROUND', True):
+        reaper = _trash(str(tree))
+    assert not tree.exists()
+    assert reaper.wait() == 0
+    assert [] == tmpdir.join(TRASH_DIR).listdir()
+    shutil.rmtree(str(tmpdir))
+
+def test_prepare_conda_reap_leftovers(tmpdir):
+    """Trees left in trash folders are deleted"""
+    from bootstrap import _prepare_conda, TRASH_DIR
+    conda = tmpdir.join('conda')
+    tmpdir.join(TRASH_DIR, 'conda.1', 'conda', 'file').ensure()
+    conda.join('envs', TRASH_DIR, 'env.1', 'env', 'file').ensure()
+    _prepare_conda(str(conda), False)
+    assert [] == tmpdir.join(TRASH_DIR).listdir()
+    assert [] == conda.join('envs', TRASH_DIR).listdir()
+    shutil.rmtree(str(tmpdir))
+
 def test_prepare_conda_reset_invalid(caplog, tmpdir):
     """If existing conda prefix exists and reset=True, but cannot be deleted,
     an exception is raised."""
@@ -323,8 +515,57 @@ def test_env_exists_no_debug(caplog, tmpdir):
     assert False == _env_exists(str(tmpdir), 'test')
     records = caplog.records
     assert len([i for i in records if i.name == 'stdout']) == 0
-    assert None != re.search('Trigger .* creation', records[0].message)
-    assert None != re.search('error_str', records[0].message)
+    # command output is logged first, as it comes
+    assert 'error_str' == records[0].message
+    assert None != re.search('Trigger .* creation', records[-1].message)
+    assert None != re.search('error_str', records[-1].message)
+    shutil.rmtree(str(tmpdir))
+
+def test_env_exists_fs(caplog, tmpdir):
+    """Env existence is read from prefix layout, conda is not called"""
+    from bootstrap import _env_exists
+    conda = tmpdir.join('bin/conda')
+    _error_script(conda)
+    tmpdir.join('conda-meta').ensure(dir=True)
+    tmpdir.join('envs/test/conda-meta').ensure(dir=True)
+    assert True == _env_exists(str(tmpdir), 'test')
+    assert len(caplog.records) == 0
+    shutil.rmtree(str(tmpdir))
+
+def test_env_exists_fs_unknown(tmpdir, environment):
+    """conda is asked when env is not found or envs dirs are customized"""
+    from bootstrap import _env_exists_fs
+    environment['HOME'] = str(tmpdir.join('home'))
+    for key in ('CONDA_ENVS_PATH', 'CONDA_ENVS_DIRS', 'CONDARC'):
+        if key in os.environ:
+            del environment[key]
+    prefix = tmpdir.join('prefix')
+    prefix.join('conda-meta').ensure(dir=True)
+    assert None == _env_exists_fs(str(prefix), 'test')
+    prefix.join('envs/test/conda-meta').ensure(dir=True)
+    assert True == _env_exists_fs(str(prefix), 'test')
+    # env named 'test' of custom envs dir would be used by conda
+    prefix.join('.condarc').write('envs_dirs:\n  - {0}\n'.format(
+        tmpdir.join('envs')))
+    assert None == _env_exists_fs(str(prefix), 'test')
+    prefix.join('.condarc').remove()
+    tmpdir.join('home/.condarc').write('envs_dirs: [/envs]\n', ensure=True)
+    assert None == _env_exists_fs(str(prefix), 'test')
+    tmpdir.join('home/.condarc').remove()
+    environment['CONDA_ENVS_PATH'] = str(tmpdir.join('envs'))
+    assert None == _env_exists_fs(str(prefix), 'test')
+    shutil.rmtree(str(tmpdir))
+
+def test_env_exists_fs_registry(tmpdir, environment):
+    """Envs in user envs dir are found through conda registry"""
+    from bootstrap import _env_exists_fs
+    environment['HOME'] = str(tmpdir.join('home'))
+    tmpdir.join('prefix/conda-meta').ensure(dir=True)
+    user_env = tmpdir.join('home/.conda/envs/test')
+    user_env.join('conda-meta').ensure(dir=True)
+    assert None == _env_exists_fs(str(tmpdir.join('prefix')), 'test')
+    tmpdir.join('home/.conda/environments.txt').write(str(user_env) + '\n')
+    assert True == _env_exists_fs(str(tmpdir.join('prefix')), 'test')
     shutil.rmtree(str(tmpdir))
 
 def test_env_remove_ok(caplog, tmpdir):
@@ -436,6 +677,61 @@ def test_handle_env_exists(caplog, tmpdir):
     assert None != re.search('installing', records[1].message, flags=re.I)
     shutil.rmtree(str(tmpdir))
 
+def test_handle_env_reset_trash(caplog, tmpdir):
+    """Env folder is moved to trash instead of calling conda env remove"""
+    from bootstrap import _handle_env
+    log = tmpdir.join('conda.log')
+    _recording_conda_script(tmpdir.join('bin/conda'), log)
+    tmpdir.join('conda-meta').ensure(dir=True)
+    tmpdir.join('envs/test/conda-meta').ensure(dir=True)
+    _handle_env(str(tmpdir), 'test', None, True)
+    assert ['create -n test -y'] == log.read().splitlines()
+    assert None != re.search('removing', caplog.records[0].message, flags=re.I)
+    assert not tmpdir.join('envs/test').exists()
+    shutil.rmtree(str(tmpdir))
+
+def test_handle_env_reset_user_envs_dir(tmpdir, environment):
+    """Env of user envs dir is removed with conda"""
+    from bootstrap import _handle_env
+    environment['HOME'] = str(tmpdir.join('home'))
+    user_env = tmpdir.join('home/.conda/envs/test')
+    user_env.join('conda-meta').ensure(dir=True)
+    tmpdir.join('home/.conda/environments.txt').write(str(user_env) + '\n')
+    prefix = tmpdir.join('prefix')
+    log = tmpdir.join('conda.log')
+    _recording_conda_script(prefix.join('bin/conda'), log)
+    prefix.join('conda-meta').ensure(dir=True)
+    _handle_env(str(prefix), 'test', None, True)
+    assert ['env remove -n test -y', 'create -n test -y'] == \
+        log.read().splitlines()
+    shutil.rmtree(str(tmpdir))
+
+def test_handle_env_report(tmpdir):
+    """Phases, skip reasons and commands are written in report"""
+    import json
+    import bootstrap
+    from bootstrap import _handle_env
+    log = tmpdir.join('conda.log')
+    _recording_conda_script(tmpdir.join('bin/conda'), log)
+    tmpdir.join('conda-meta').ensure(dir=True)
+    bootstrap._report_start()
+    _handle_env(str(tmpdir), 'test', None, False)
+    bootstrap._report_write(str(tmpdir.join('report.json')))
+    report = json.loads(tmpdir.join('report.json').read())
+    assert 'ok' == report['status']
+    phases = [(i['name'], i['status'], i['reason']) for i in report['phases']]
+    assert [('env_reset', 'skipped', 'env does not exist'),
+            ('env_create', 'ok', None),
+            ('env_install', 'skipped', 'no environment file')] == phases
+    assert ['env_reset', 'env_create'] == \
+        [i['phase'] for i in report['commands']]
+    assert report['commands'][0]['command'].endswith('conda list -n test')
+    command = report['commands'][1]
+    assert 0 == command['returncode']
+    assert command['command'].endswith('conda create -n test -y')
+    assert None == bootstrap._report
+    shutil.rmtree(str(tmpdir))
+
 def test_handle_env_no_environment_file(caplog, tmpdir):
     from bootstrap import _handle_env
     conda = tmpdir.join('bin/conda')
@@ -449,6 +745,296 @@ def test_handle_env_no_environment_file(caplog, tmpdir):
     assert None == re.search('installing', records[0].message, flags=re.I)
     shutil.rmtree(str(tmpdir))
 
+def test_handle_env_unchanged(caplog, tmpdir):
+    """Install is skipped when env inputs did not change since last install"""
+    from bootstrap import _handle_env
+    conda = tmpdir.join('bin/conda')
+    _fake_conda_script(conda, 0, 0, 0, 0)
+    tmpdir.join('envs/test/conda-meta').ensure(dir=True)
+    environment = tmpdir.join('environment.yml')
+    environment.write('dependencies:\n  - python\n')
+    _handle_env(str(tmpdir), 'test', str(environment), False)
+    assert tmpdir.join('envs/test/conda-meta/bootstrap-fingerprint').isfile()
+    caplog.clear()
+    _handle_env(str(tmpdir), 'test', str(environment), False)
+    records = caplog.records
+    assert None == re.search('installing', records[1].message, flags=re.I)
+    assert None != re.search('up to date', records[1].message, flags=re.I)
+    # environment.yml update triggers install
+    caplog.clear()
+    environment.write('dependencies:\n  - python=3\n')
+    _handle_env(str(tmpdir), 'test', str(environment), False)
+    assert None != re.search('installing', caplog.records[1].message, flags=re.I)
+    # install can be forced
+    caplog.clear()
+    _handle_env(str(tmpdir), 'test', str(environment), False,
+                force_install=True)
+    assert None != re.search('installing', caplog.records[1].message, flags=re.I)
+    shutil.rmtree(str(tmpdir))
+
+def test_parse_environment(tmpdir):
+    from bootstrap import _parse_environment
+    environment = tmpdir.join('environment.yml')
+    environment.write("""name: env-name  # comment
+channels: [conda-forge, defaults]
+dependencies:
+  - python=3.7
+  # comment
+  - pip
+  - pip:
+    - tox
+    - "requests>=2"
+  - virtualenv
+""")
+    assert {'name': 'env-name',
+            'channels': ['conda-forge', 'defaults'],
+            'dependencies': ['python=3.7', 'pip', 'virtualenv'],
+            'pip': ['tox', 'requests>=2']} == _parse_environment(str(environment))
+    shutil.rmtree(str(tmpdir))
+
+def _recording_conda_script(lpath, log):
+    """conda script that appends its args to log and lists a fake explicit
+    environment"""
+    lpath.write("""#! /bin/bash
+echo "$@" >> {0}
+# conda list -n NAME fails for missing envs
+if [ "$1" == "list" ] && [ "$2" == "-n" ] \
+        && [ ! -d "$(dirname "$0")/../envs/$3/conda-meta" ]; then
+    exit 1
+fi
+if [ "$1" == "list" ] && [ "$2" == "--explicit" ]; then
+    echo "# comment"
+    echo "@EXPLICIT"
+    echo "https://conda.anaconda.org/conda-forge/noarch/pkg-1.0-0.tar.bz2#1234"
+fi
+exit 0
+""".format(log), ensure=True)
+    lpath.chmod(stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+
+def test_handle_env_lockfile(tmpdir):
+    """Lockfile is written after a solve, then used instead of solving"""
+    from bootstrap import _handle_env
+    log = tmpdir.join('conda.log')
+    _recording_conda_script(tmpdir.join('bin/conda'), log)
+    tmpdir.join('conda-meta').ensure(dir=True)
+    tmpdir.join('envs/test/conda-meta').ensure(dir=True)
+    environment = tmpdir.join('environment.yml')
+    environment.write('dependencies:\n  - pkg\n')
+    _handle_env(str(tmpdir), 'test', str(environment), False,
+                write_lockfile=True)
+    lockfile = tmpdir.join('environment.lock')
+    assert lockfile.read().startswith(
+        '# environment-sha256: {0}\n@EXPLICIT\n'.format(
+            hashlib.sha256(environment.read_binary()).hexdigest()))
+    assert ['env update -n test --file {0}'.format(environment),
+            'list --explicit --md5 -n test'] == log.read().splitlines()
+    log.remove()
+    # lockfile is unchanged: nothing to do
+    _handle_env(str(tmpdir), 'test', str(environment), False)
+    assert not log.exists()
+    _handle_env(str(tmpdir), 'test', str(environment), False,
+                force_install=True)
+    assert ['install -n test --file {0} -y'.format(lockfile)] == \
+        log.read().splitlines()
+    log.remove()
+    _handle_env(str(tmpdir), 'test', str(environment), False,
+                force_install=True, use_lockfile=False)
+    assert ['env update -n test --file {0}'.format(environment)] == \
+        log.read().splitlines()
+    shutil.rmtree(str(tmpdir))
+
+def test_env_lock_stderr(tmpdir):
+    """Backend warnings (stderr) are not written in lockfile; list output
+    without @EXPLICIT is an error"""
+    from bootstrap import _env_lock
+    conda = tmpdir.join('bin/conda')
+    conda.write("""#! /bin/bash
+echo "# comment"
+echo "@EXPLICIT"
+echo "warning: something" >&2
+echo "https://host/noarch/pkg-1.0-0.tar.bz2#1234"
+""", ensure=True)
+    conda.chmod(stat.S_IRWXU)
+    environment = tmpdir.join('environment.yml')
+    environment.write('dependencies:\n  - pkg\n')
+    lockfile = tmpdir.join('environment.lock')
+    _env_lock(str(tmpdir), 'test', str(environment), str(lockfile))
+    assert lockfile.read().splitlines()[1:] == \
+        ['@EXPLICIT', 'https://host/noarch/pkg-1.0-0.tar.bz2#1234']
+    conda.write('#! /bin/bash\necho "# no package"\n')
+    with pytest.raises(Exception) as e:
+        _env_lock(str(tmpdir), 'test', str(environment), str(lockfile))
+    assert 'no @EXPLICIT line' in str(e.value)
+    shutil.rmtree(str(tmpdir))
+
+def test_handle_env_lockfile_stale(caplog, tmpdir):
+    """Lockfile is ignored, or rejected if required, once environment
+    changed"""
+    from bootstrap import _handle_env
+    log = tmpdir.join('conda.log')
+    _recording_conda_script(tmpdir.join('bin/conda'), log)
+    tmpdir.join('conda-meta').ensure(dir=True)
+    tmpdir.join('envs/test/conda-meta').ensure(dir=True)
+    environment = tmpdir.join('environment.yml')
+    environment.write('dependencies:\n  - pkg\n')
+    _handle_env(str(tmpdir), 'test', str(environment), False,
+                write_lockfile=True)
+    log.remove()
+    environment.write('dependencies:\n  - pkg\n  - other\n')
+    with pytest.raises(Exception) as e:
+        _handle_env(str(tmpdir), 'test', str(environment), False,
+                    require_lockfile=True)
+    assert 'changed since it was locked' in str(e.value)
+    assert not log.exists()
+    _handle_env(str(tmpdir), 'test', str(environment), False)
+    assert ['env update -n test --file {0}'.format(environment)] == \
+        log.read().splitlines()
+    assert None != re.search('environment.lock ignored', '\n'.join(
+        [r.getMessage() for r in caplog.records]))
+    tmpdir.join('environment.lock').remove()
+    with pytest.raises(Exception) as e:
+        _handle_env(str(tmpdir), 'test', str(environment), False,
+                    require_lockfile=True)
+    assert 'required: missing' in str(e.value)
+    shutil.rmtree(str(tmpdir))
+
+def test_handle_env_backend(tmpdir):
+    """Env operations are run with selected backend"""
+    from bootstrap import _handle_env
+    log = tmpdir.join('micromamba.log')
+    _recording_conda_script(tmpdir.join('bin/micromamba'), log)
+    environment = tmpdir.join('environment.yml')
+    environment.write('dependencies:\n  - pkg\n')
+    _handle_env(str(tmpdir), 'test', str(environment), False,
+                backend='micromamba')
+    assert ['list -r {0} -n test'.format(tmpdir),
+            'install -r {0} -n test -f {1} -y'.format(tmpdir, environment)] == \
+        log.read().splitlines()
+    shutil.rmtree(str(tmpdir))
+
+def test_configure_pkgs_dir(caplog, tmpdir):
+    """Shared package cache is set in prefix .condarc"""
+    from bootstrap import _configure_pkgs_dir, _shared_pkgs_dir
+    prefix = tmpdir.join('prefix').mkdir()
+    pkgs = tmpdir.join('pkgs')
+    assert None == _shared_pkgs_dir(str(prefix))
+    prefix.join('.condarc').write('channels:\n  - defaults')
+    _configure_pkgs_dir(str(prefix), str(pkgs))
+    assert pkgs.isdir()
+    assert 'channels:\n  - defaults\npkgs_dirs:\n  - {0}\n'.format(pkgs) == \
+        prefix.join('.condarc').read()
+    assert str(pkgs) == _shared_pkgs_dir(str(prefix))
+    assert '{0}\n'.format(prefix) == pkgs.join('.bootstrap-prefixes').read()
+    # configuration is done once
+    _configure_pkgs_dir(str(prefix), str(pkgs))
+    assert 1 == prefix.join('.condarc').read().count('pkgs_dirs')
+    # user defined pkgs_dirs is kept
+    _configure_pkgs_dir(str(prefix), str(tmpdir.join('other')))
+    assert str(pkgs) == _shared_pkgs_dir(str(prefix))
+    assert None != re.search('already defines pkgs_dirs',
+                             caplog.records[-1].message)
+    # package cache inside prefix is not shared
+    prefix.join('.condarc').write('pkgs_dirs:\n  - {0}\n'.format(
+        prefix.join('pkgs')))
+    assert None == _shared_pkgs_dir(str(prefix))
+    shutil.rmtree(str(tmpdir))
+
+def test_backend_run_pkgs_lock(tmpdir):
+    """Install operations hold shared package cache lock, exclusive only when
+    the cache is used by several conda installations"""
+    from bootstrap import _backend_run, _configure_pkgs_dir
+    prefix = tmpdir.join('prefix').mkdir()
+    pkgs = tmpdir.join('pkgs')
+    _configure_pkgs_dir(str(prefix), str(pkgs))
+    # exit 1 if lock can be acquired, 2 if only a shared lock can be
+    prefix.join('bin/conda').write("""#! /bin/bash
+flock -n {0} -c true && exit 1
+flock -n -s {0} -c true && exit 2
+exit 0
+""".format(pkgs.join('.bootstrap.lock')), ensure=True)
+    prefix.join('bin/conda').chmod(stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+    assert 2 == _backend_run(str(prefix), 'conda', 'install', name='test',
+                             file='environment.yml')[0]
+    assert 1 == _backend_run(str(prefix), 'conda', 'list', name='test')[0]
+    # another conda installation uses the cache
+    _configure_pkgs_dir(str(tmpdir.join('other').mkdir()), str(pkgs))
+    assert 0 == _backend_run(str(prefix), 'conda', 'install', name='test',
+                             file='environment.yml')[0]
+    # removed installations are ignored
+    tmpdir.join('other').remove()
+    assert 2 == _backend_run(str(prefix), 'conda', 'install', name='test',
+                             file='environment.yml')[0]
+    shutil.rmtree(str(tmpdir))
+
+def test_handle_env_templates(tmpdir):
+    """New envs are cloned from the closest template"""
+    from bootstrap import _handle_env, _template_name, _template_spec
+    log = tmpdir.join('conda.log')
+    tmpdir.join('conda-meta').ensure(dir=True)
+    # create and clone make env folder
+    tmpdir.join('bin/conda').write("""#! /bin/bash
+echo "$@" >> {0}
+if [ "$1" == "create" ]; then
+    mkdir -p {1}/envs/$3/conda-meta
+fi
+[ "$1" == "list" ] && [ ! -d {1}/envs/$3/conda-meta ] && exit 1
+exit 0
+""".format(log, tmpdir), ensure=True)
+    tmpdir.join('bin/conda').chmod(stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+    base = tmpdir.join('base.yml')
+    base.write('dependencies:\n  - python\n')
+    larger = tmpdir.join('larger.yml')
+    larger.write('dependencies:\n  - python\n  - pip\n')
+    template = _template_name(_template_spec(str(base)))
+    # no template: env is created, installed then saved as template
+    _handle_env(str(tmpdir), 'first', str(base), False, templates=True)
+    assert ['list -n first', 'create -n first -y',
+            'env update -n first --file {0}'.format(base),
+            'create -n {0} --clone first -y'.format(template)] == \
+        log.read().splitlines()
+    assert tmpdir.join('envs', template, 'conda-meta',
+                       'bootstrap-template.json').isfile()
+    log.remove()
+    # same spec: clone only
+    _handle_env(str(tmpdir), 'second', str(base), False, templates=True)
+    assert ['list -n second',
+            'create -n second --clone {0} -y'.format(template)] == \
+        log.read().splitlines()
+    assert tmpdir.join('envs/second/conda-meta/bootstrap-fingerprint').isfile()
+    log.remove()
+    # larger spec: clone then install delta
+    _handle_env(str(tmpdir), 'third', str(larger), False, templates=True)
+    assert ['list -n third',
+            'create -n third --clone {0} -y'.format(template),
+            'env update -n third --file {0}'.format(larger),
+            'create -n {0} --clone third -y'.format(
+                _template_name(_template_spec(str(larger))))] == \
+        log.read().splitlines()
+    shutil.rmtree(str(tmpdir))
+
+def test_handle_env_lockfile_pip(caplog, tmpdir):
+    """Lockfile is not used if environment has pip dependencies"""
+    from bootstrap import _handle_env
+    log = tmpdir.join('conda.log')
+    _recording_conda_script(tmpdir.join('bin/conda'), log)
+    environment = tmpdir.join('environment.yml')
+    environment.write('dependencies:\n  - pip:\n    - tox\n')
+    tmpdir.join('environment.lock').write('@EXPLICIT\n')
+    _handle_env(str(tmpdir), 'test', str(environment), False)
+    assert 'env update -n test --file {0}'.format(environment) in \
+        log.read().splitlines()
+    assert None != re.search('not locked', '\n'.join(
+        [r.message for r in caplog.records]))
+    shutil.rmtree(str(tmpdir))
+
+def test_conda_version(tmpdir):
+    from bootstrap import _conda_version
+    assert None == _conda_version(str(tmpdir))
+    tmpdir.join('conda-meta/conda-package-handling-2.2.0-py311.json').ensure()
+    tmpdir.join('conda-meta/conda-23.11.0-py311h06a4308_0.json').ensure()
+    assert '23.11.0' == _conda_version(str(tmpdir))
+    shutil.rmtree(str(tmpdir))
+
 def test_handle_bootstrap_command(caplog, tmpdir, environment):
     from bootstrap import _handle_bootstrap_command
     command = 'echo bootstrap'
@@ -462,6 +1048,70 @@ def test_handle_bootstrap_command(caplog, tmpdir, environment):
     assert None != re.search(command, records[0].message, flags=re.I)
     shutil.rmtree(str(tmpdir))
 
+def test_logger_caller_name(caplog):
+    """Records are logged under the name of the calling function"""
+    from bootstrap import logger
+    def some_function():
+        logger.info('message')
+    some_function()
+    some_function()
+    assert ['some_function', 'some_function'] == \
+        [i.name for i in caplog.records]
+
+def test_json_formatter():
+    """Records are formatted as one JSON object"""
+    import json
+    from bootstrap import JsonFormatter
+    record = logging.LogRecord('name', logging.WARNING, 'path', 1,
+                               'hello %s', ('world',), None)
+    data = json.loads(JsonFormatter().format(record))
+    assert {'time': record.created, 'level': 'WARNING', 'logger': 'name',
+            'message': 'hello world'} == data
+
+def test_subprocess_capture_tail(caplog, tmpdir):
+    """Only last lines are kept, whole output goes to log file"""
+    import bootstrap
+    from bootstrap import _subprocess_capture
+    logging.root.setLevel(logging.INFO)
+    log = tmpdir.join('output.log')
+    bootstrap._open_log_file(str(log))
+    try:
+        with patch('bootstrap.OUTPUT_TAIL_LINES', 3):
+            returncode, output = _subprocess_capture(['seq', '10'])
+        assert 0 == returncode
+        assert '[...]\n8\n9\n10\n' == output
+        assert '10\n' == _subprocess_capture(['seq', '10'], tail=None)[1][-3:]
+    finally:
+        bootstrap._open_log_file(None)
+    lines = log.read().splitlines()
+    assert ['$ seq 10'] + [str(i) for i in range(1, 11)] == lines[:11]
+    assert len(lines) == 22
+    assert len(caplog.records) == 0
+    shutil.rmtree(str(tmpdir))
+
+def test_subprocess_capture_debug(caplog, tmpdir):
+    """Output lines are logged as they come in debug mode"""
+    from bootstrap import _subprocess_capture
+    logging.root.setLevel(logging.DEBUG)
+    assert (0, '1\n2\n') == _subprocess_capture(['seq', '2'])
+    assert ['1', '2'] == [i.message for i in caplog.records]
+
+def test_run_log_file(capfd, tmpdir):
+    """With a log file, stderr is merged in stdout and copied to the file"""
+    import bootstrap
+    from bootstrap import _run
+    log = tmpdir.join('output.log')
+    bootstrap._open_log_file(str(log))
+    try:
+        _run('echo out; >&2 echo err', shell=True)
+        pytest.raises(subprocess.CalledProcessError, _run, ['false'])
+    finally:
+        bootstrap._open_log_file(None)
+    assert 'out\nerr\n' == _out(capfd.readouterr())
+    assert ['$ echo out; >&2 echo err', 'out', 'err', '$ false'] == \
+        log.read().splitlines()
+    shutil.rmtree(str(tmpdir))
+
 def test_handle_bootstrap_command_ko(caplog, tmpdir, environment):
     from bootstrap import _handle_bootstrap_command
     command = 'false'
@@ -499,6 +1149,492 @@ def test_miniconda_install(download, run, capfd, caplog, tmpdir, environment):
     assert len(caplog.records) == 0
     shutil.rmtree(str(tmpdir))
 
+def _fake_download(content):
+    """Build a _download replacement that writes content in a temp file"""
+    def download(url, _tmpdir=None, digest=None, stats=None, **kwargs):
+        path = os.path.join(_tmpdir, 'download.sh')
+        with open(path, 'wb') as f:
+            f.write(content)
+        if digest is not None:
+            digest.update(content)
+        if stats is not None:
+            stats.update({'bytes': len(content), 'seconds': 1})
+        return (None, path)
+    return download
+
+@patch('bootstrap._download')
+def test_cached_download(download, caplog, tmpdir):
+    """First call downloads and stores file, second call skips network"""
+    import hashlib
+    from bootstrap import _cached_download
+    download.side_effect = _fake_download(b'installer')
+    cache_dir = tmpdir.join('cache')
+    path = _cached_download('http://host/installer.sh', str(cache_dir), 1024)
+    assert path.endswith('.sh')
+    assert open(path, 'rb').read() == b'installer'
+    assert hashlib.sha256(b'installer').hexdigest() in path
+    assert download.call_count == 1
+    assert path == _cached_download('http://host/installer.sh',
+                                    str(cache_dir), 1024)
+    assert download.call_count == 1
+    assert None != re.search('cached', caplog.records[-1].message)
+    shutil.rmtree(str(tmpdir))
+
+@patch('bootstrap._download')
+def test_cached_download_checksum(download, tmpdir):
+    """Downloaded file not matching expected checksum is rejected"""
+    from bootstrap import _cached_download
+    download.side_effect = _fake_download(b'installer')
+    cache_dir = tmpdir.join('cache')
+    def f():
+        _cached_download('http://host/installer.sh', str(cache_dir), 1024,
+                         sha256='0' * 64)
+    e = pytest.raises(Exception, f)
+    assert None != re.search('checksum mismatch', str(e.value), flags=re.I)
+    assert len(cache_dir.join('objects').listdir()) == 0
+    shutil.rmtree(str(tmpdir))
+
+@patch('bootstrap._download')
+def test_cached_download_eviction(download, tmpdir):
+    """Least recently used files are evicted when cache is full"""
+    from bootstrap import _cached_download
+    cache_dir = tmpdir.join('cache')
+    download.side_effect = _fake_download(b'a' * 10)
+    first = _cached_download('http://host/a.sh', str(cache_dir), 25)
+    download.side_effect = _fake_download(b'b' * 10)
+    second = _cached_download('http://host/b.sh', str(cache_dir), 25)
+    # refresh first file access time
+    _cached_download('http://host/a.sh', str(cache_dir), 25)
+    download.side_effect = _fake_download(b'c' * 10)
+    third = _cached_download('http://host/c.sh', str(cache_dir), 25)
+    assert os.path.exists(first)
+    assert not os.path.exists(second)
+    assert os.path.exists(third)
+    shutil.rmtree(str(tmpdir))
+
+@patch('bootstrap._cached_download')
+@patch('bootstrap._run')
+def test_miniconda_install_cached(run, cached_download, tmpdir):
+    """Cached installer is not flagged for removal"""
+    import bootstrap
+    from bootstrap import _miniconda_install
+    cached_download.return_value = str(tmpdir.join('miniconda.sh'))
+    removals = []
+    _miniconda_install(str(tmpdir), removals=removals,
+                       cache_dir=str(tmpdir.join('cache')), cache_size=1)
+    cached_download.assert_called_with(bootstrap.MINICONDA_INSTALLER_URL,
+                                       str(tmpdir.join('cache')), 1024 * 1024,
+                                       sha256=None)
+    assert removals == []
+    shutil.rmtree(str(tmpdir))
+
+def test_offline_missing(tmpdir, environment):
+    """Offline preflight lists every missing installer, channel and
+    package"""
+    from bootstrap import _offline_missing
+    environment['CONDA_PKGS_DIRS'] = ''
+    prefix = tmpdir.join('prefix')
+    env_yml = tmpdir.join('environment.yml')
+    env_yml.write('channels:\n  - conda-forge\ndependencies:\n'
+                  '  - python\n  - pip:\n    - Some.Tool==1.0\n')
+    missing = _offline_missing(str(prefix), [str(env_yml)],
+                               cache_dir=str(tmpdir.join('cache')))
+    assert 3 == len(missing)
+    assert 'Miniconda installer' in missing[0]
+    assert 'channel conda-forge is remote' in missing[1]
+    assert 'wheel directory' in missing[2]
+    # local installer, file:// channel and wheels
+    installer = tmpdir.join('installer.sh')
+    _success_script(installer)
+    channel = tmpdir.join('channel').ensure(dir=True)
+    env_yml.write('channels:\n  - file://{0}\ndependencies:\n'
+                  '  - python\n  - pip:\n    - Some.Tool==1.0\n'
+                  .format(channel))
+    wheels = tmpdir.join('wheels').ensure(dir=True)
+    kwargs = dict(installer=str(installer), wheel_dir=str(wheels))
+    assert ['{0}: pip package Some.Tool==1.0 not in {1}'
+            .format(env_yml, wheels)] == \
+        _offline_missing(str(prefix), [str(env_yml)], **kwargs)
+    wheels.join('some_tool-1.0-py3-none-any.whl').write('')
+    assert [] == _offline_missing(str(prefix), [str(env_yml)], **kwargs)
+    # lockfile packages must be in package caches
+    prefix.join('conda-meta').ensure(dir=True)
+    env_yml.write('dependencies:\n  - python\n')
+    tmpdir.join('environment.lock').write(
+        '@EXPLICIT\nhttps://host/linux-64/python-3.11-h1.conda#abc\n'
+        'https://host/noarch/six-1.0-py_0.tar.bz2#def\n')
+    prefix.join('pkgs', 'python-3.11-h1').ensure(dir=True)
+    assert ['{0}: package six-1.0-py_0.tar.bz2 '
+            '(https://host/noarch/six-1.0-py_0.tar.bz2)'.format(env_yml)] == \
+        _offline_missing(str(prefix), [str(env_yml)])
+    shutil.rmtree(str(tmpdir))
+
+@patch('bootstrap._run')
+@patch('bootstrap._download')
+def test_bootstrap_offline(download, run, caplog, tmpdir, environment):
+    """Offline bootstrap fails before any change, installs from a local
+    installer otherwise"""
+    import bootstrap
+    prefix = tmpdir.join('prefix')
+    env_yml = tmpdir.join('environment.yml')
+    env_yml.write('channels:\n  - conda-forge\ndependencies:\n  - python\n')
+    # failure is logged, command line exits with an error
+    assert 1 == bootstrap._main(
+        ['--prefix', str(prefix), '--name', 'test', '--environment',
+         str(env_yml), '--cache-dir', str(tmpdir.join('cache')),
+         '--offline'])
+    assert None != re.search('Bootstrap failure: .*Offline bootstrap '
+                             'impossible: 2 missing', caplog.text)
+    assert not prefix.exists()
+    assert 2 == len([i for i in caplog.records
+                     if i.getMessage().startswith('Offline: missing')])
+    installer = tmpdir.join('installer.sh')
+    _success_script(installer)
+    removals = []
+    bootstrap._miniconda_phase(str(prefix), removals, None, 1, None,
+                               installer=str(installer), offline=True)
+    assert not download.called
+    assert str(installer) == run.call_args[0][0][1]
+    assert [] == removals
+    env = bootstrap._offline_environ('~/wheels')
+    assert 'true' == env['CONDA_OFFLINE'] == env['MAMBA_OFFLINE']
+    assert os.path.expanduser('~/wheels') == env['PIP_FIND_LINKS']
+    shutil.rmtree(str(tmpdir))
+
+def test_bootstrap_offline_environ(tmpdir, environment):
+    """Offline settings apply to backend commands, not to BOOTSTRAP_COMMAND
+    and user command"""
+    from bootstrap import _bootstrap
+    environment['CONDA_PKGS_DIRS'] = ''
+    for key in ('CONDA_OFFLINE', 'PIP_NO_INDEX'):
+        if key in os.environ:
+            del environment[key]
+    log = tmpdir.join('offline.log')
+    prefix = tmpdir.join('prefix')
+    prefix.join('conda-meta').ensure(dir=True)
+    for script, line in ((prefix.join('bin/conda'), 'conda $1'),
+                         (prefix.join('envs/test/bin/probe'), 'command')):
+        script.write('#! /bin/bash\necho "{0} $CONDA_OFFLINE $PIP_NO_INDEX" '
+                     '>> {1}\n'
+                     .format(line, log), ensure=True)
+        script.chmod(stat.S_IRWXU)
+    _fake_activate_script(prefix.join('bin/activate'))
+    environment['BOOTSTRAP_COMMAND'] = 'echo "bootstrap $CONDA_OFFLINE" ' \
+        '>> {0}'.format(log)
+    channel = tmpdir.join('channel').ensure(dir=True)
+    env_yml = tmpdir.join('environment.yml')
+    env_yml.write('channels:\n  - file://{0}\ndependencies:\n  - python\n'
+                  .format(channel))
+    _bootstrap(str(prefix), 'test', str(env_yml), ['probe'],
+               profile_dir=str(tmpdir.join('bootstrap.conf')),
+               skip_activate_script=True, offline=True)
+    lines = log.read().splitlines()
+    assert ['conda list true 1',
+            'conda env true 1'] == [i for i in lines if i.startswith('conda')]
+    assert ['bootstrap', 'command'] == \
+        [i.strip() for i in lines if not i.startswith('conda')]
+    assert 'CONDA_OFFLINE' not in os.environ
+    shutil.rmtree(str(tmpdir))
+
+def test_mirror(caplog, tmpdir, environment):
+    """Mirror holds solved packages in indexed channel folders; packages
+    already there are not downloaded again"""
+    import hashlib
+    import json
+    import bootstrap
+    caplog.set_level(logging.INFO)
+    source = tmpdir.join('source')
+    records = []
+    for subdir, fn in (('linux-64', 'python-3.11-h1.conda'),
+                       ('noarch', 'six-1.0-py_0.tar.bz2')):
+        package = source.join('conda-forge', subdir, fn)
+        package.write(fn, ensure=True)
+        records.append({'url': 'file://{0}'.format(package), 'fn': fn,
+                        'subdir': subdir, 'name': fn.split('-')[0],
+                        'version': '1.0', 'build': 'h1', 'build_number': 0,
+                        'depends': [], 'channel': 'conda-forge',
+                        'size': len(fn),
+                        'md5': hashlib.md5(fn.encode('utf-8')).hexdigest()})
+    solution = tmpdir.join('solution.json')
+    solution.write(json.dumps({'actions': {'FETCH': records}}))
+    prefix = tmpdir.join('prefix')
+    prefix.join('bin', 'conda').write(
+        '#! /bin/bash\necho "$@ $CONDA_PKGS_DIRS" > {0}\n'
+        'echo "warning: {{not json}}" >&2\ncat {1}\n'
+        .format(tmpdir.join('args'), solution), ensure=True)
+    prefix.join('bin', 'conda').chmod(stat.S_IRWXU)
+    env_yml = tmpdir.join('environment.yml')
+    env_yml.write('channels:\n  - conda-forge\ndependencies:\n'
+                  '  - python\n  - six\n')
+    mirror = tmpdir.join('mirror')
+    argv = ['mirror', str(mirror), str(env_yml), '--prefix', str(prefix)]
+    assert 0 == bootstrap._main(argv)
+    args = tmpdir.join('args').read()
+    assert '--dry-run --json' in args
+    assert '--override-channels -c conda-forge python six' in args
+    assert 'python-3.11-h1.conda' == \
+        mirror.join('conda-forge/linux-64/python-3.11-h1.conda').read()
+    repodata = json.loads(
+        mirror.join('conda-forge/linux-64/repodata.json').read())
+    assert {} == repodata['packages']
+    assert 'url' not in repodata['packages.conda']['python-3.11-h1.conda']
+    assert records[0]['md5'] == \
+        repodata['packages.conda']['python-3.11-h1.conda']['md5']
+    assert 'six-1.0-py_0.tar.bz2' in json.loads(
+        mirror.join('conda-forge/noarch/repodata.json').read())['packages']
+    assert 'Mirror {0}: 2 packages, 2 downloaded'.format(mirror) in \
+        caplog.text
+    # incremental: only changed package is downloaded again
+    mirror.join('conda-forge/noarch/six-1.0-py_0.tar.bz2').write('corrupt')
+    caplog.clear()
+    assert 0 == bootstrap._main(argv)
+    assert 'Mirror {0}: 2 packages, 1 downloaded'.format(mirror) in \
+        caplog.text
+    assert 'six-1.0-py_0.tar.bz2' == \
+        mirror.join('conda-forge/noarch/six-1.0-py_0.tar.bz2').read()
+    shutil.rmtree(str(tmpdir))
+
+def test_channel_mirror(tmpdir, environment):
+    """Channel mirror is the channel_alias of prefix; offline preflight
+    resolves channel names with it"""
+    from bootstrap import (_configure_channel_mirror, _channel_mirror,
+                           _offline_missing)
+    environment['CONDA_PKGS_DIRS'] = ''
+    prefix = tmpdir.join('prefix').ensure(dir=True)
+    prefix.join('.condarc').write('pkgs_dirs:\n  - /pkgs\n')
+    mirror = tmpdir.join('mirror')
+    _configure_channel_mirror(str(prefix), 'https://host/channels')
+    _configure_channel_mirror(str(prefix), str(mirror))
+    assert 'pkgs_dirs:\n  - /pkgs\nchannel_alias: file://{0}\n' \
+        'default_channels:\n  - file://{0}/pkgs/main\n' \
+        '  - file://{0}/pkgs/r\n'.format(mirror) == \
+        prefix.join('.condarc').read()
+    assert 'file://{0}'.format(mirror) == _channel_mirror(str(prefix))
+    env_yml = tmpdir.join('environment.yml')
+    env_yml.write('channels:\n  - conda-forge\ndependencies:\n  - python\n')
+    assert ['{0}: channel conda-forge not found'.format(env_yml)] == \
+        _offline_missing(str(prefix), [str(env_yml)])
+    mirror.join('conda-forge').ensure(dir=True)
+    assert [] == _offline_missing(str(prefix), [str(env_yml)])
+    # defaults channel resolves to mirrored pkgs/main and pkgs/r
+    env_yml.write('channels:\n  - defaults\ndependencies:\n  - python\n')
+    mirror.join('pkgs/main').ensure(dir=True)
+    assert ['{0}: channel file://{1}/pkgs/r not found'.format(
+        env_yml, mirror)] == _offline_missing(str(prefix), [str(env_yml)])
+    mirror.join('pkgs/r').ensure(dir=True)
+    assert [] == _offline_missing(str(prefix), [str(env_yml)])
+    assert [] == _offline_missing(str(prefix), [str(env_yml)],
+                                  channel_mirror=str(mirror))
+    # without mirror, defaults are anaconda remote channels
+    other = tmpdir.join('other').ensure(dir=True)
+    assert ['{0}: channel https://repo.anaconda.com/pkgs/{1} is remote (use '
+            'a file:// channel or an explicit lockfile)'.format(env_yml, i)
+            for i in ('main', 'r')] == \
+        _offline_missing(str(other), [str(env_yml)])
+    # envs without channels are solved from defaults
+    env_yml.write('dependencies:\n  - python\n')
+    assert 2 == len(_offline_missing(str(other), [str(env_yml)]))
+    assert [] == _offline_missing(str(prefix), [str(env_yml)])
+    shutil.rmtree(str(tmpdir))
+
+def test_read_batch(tmpdir):
+    from bootstrap import _read_batch
+    batch = tmpdir.join('batch.txt')
+    batch.write('# comment\nfirst envs/first.yml\n\nsecond /abs/second.yml\n')
+    assert [('first', str(tmpdir.join('envs/first.yml'))),
+            ('second', '/abs/second.yml')] == _read_batch(str(batch))
+    batch.write('third "envs/#3 env.yml" # comment\n')
+    assert [('third', str(tmpdir.join('envs/#3 env.yml')))] == \
+        _read_batch(str(batch))
+    batch.write('first\n')
+    pytest.raises(Exception, lambda: _read_batch(str(batch)))
+    shutil.rmtree(str(tmpdir))
+
+def test_bootstrap_batch(caplog, tmpdir):
+    """Envs are bootstrapped in parallel, failures are reported per env and
+    logs of an env are not interleaved with other envs logs"""
+    from bootstrap import _bootstrap_batch
+    prefix = tmpdir.join('prefix')
+    conda = prefix.join('bin/conda')
+    # env install fails for env named 'bad'
+    conda.write("""#! /bin/bash
+[ "$1" == "list" ] && exit 1;
+[ "$2" == "update" ] && [ "$4" == "bad" ] && exit 1;
+exit 0
+""", ensure=True)
+    conda.chmod(stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+    envs = []
+    for name in ('env1', 'bad', 'env2', 'env3'):
+        environment = tmpdir.join('{0}.yml'.format(name))
+        environment.write('dependencies: []\n')
+        envs.append((name, str(environment)))
+    results = _bootstrap_batch(str(prefix), envs, jobs=3,
+                               profile_dir=str(tmpdir.join('bootstrap.conf')),
+                               skip_activate_script=True)
+    assert [('env1', None), ('env2', None), ('env3', None)] == \
+        [i for i in results if i[1] is None]
+    assert 'bad' == [i for i in results if i[1] is not None][0][0]
+    messages = [r.message for r in caplog.records]
+    for name in ('env1', 'bad', 'env2', 'env3'):
+        indexes = [i for i, m in enumerate(messages)
+                   if m.startswith('[{0}]'.format(name))]
+        assert len(indexes) > 1
+        assert indexes == list(range(indexes[0], indexes[-1] + 1))
+    assert None != re.search('3 succeeded, 1 failed', '\n'.join(messages))
+    shutil.rmtree(str(tmpdir))
+
+def test_bootstrap_concurrent_prefix(tmpdir):
+    """Concurrent bootstraps of a missing prefix install it once"""
+    import threading
+    import time
+    from bootstrap import _bootstrap
+    prefix = tmpdir.join('prefix')
+    installs = []
+    def install(prefix_path, **kwargs):
+        installs.append(prefix_path)
+        time.sleep(0.2)
+        conda = prefix.join('bin/conda')
+        conda.write('#! /bin/bash\n[ "$1" == "list" ] && exit 1;\nexit 0\n',
+                    ensure=True)
+        conda.chmod(stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+    def bootstrap(name):
+        _bootstrap(str(prefix), name, str(tmpdir.join('missing.yml')), [],
+                   profile_dir=str(tmpdir.join('bootstrap.conf')),
+                   skip_activate_script=True)
+    with patch('bootstrap._miniconda_install', side_effect=install):
+        threads = [threading.Thread(target=bootstrap, args=(name,))
+                   for name in ('env1', 'env2')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert [str(prefix)] == installs
+    assert tmpdir.join('.prefix.bootstrap.lock').check(file=True)
+    shutil.rmtree(str(tmpdir))
+
+def test_bootstrap_batch_shared_pkgs_dir(caplog, tmpdir):
+    """Parallel env installs sharing a package cache with other conda
+    installations are reported as run one at a time"""
+    from bootstrap import _bootstrap_batch
+    caplog.set_level(logging.INFO)
+    prefix = tmpdir.join('prefix')
+    conda = prefix.join('bin/conda')
+    conda.write('#! /bin/bash\n[ "$1" == "list" ] && exit 1;\nexit 0\n',
+                ensure=True)
+    conda.chmod(stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+    envs = [(name, str(tmpdir.join('{0}.yml'.format(name))))
+            for name in ('env1', 'env2')]
+    results = _bootstrap_batch(str(prefix), envs, jobs=2,
+                               profile_dir=str(tmpdir.join('bootstrap.conf')),
+                               skip_activate_script=True,
+                               pkgs_dir=str(tmpdir.join('pkgs')))
+    assert [('env1', None), ('env2', None)] == results
+    assert 'Shared package cache' not in caplog.text
+    tmpdir.join('pkgs/.bootstrap-prefixes').write(
+        '{0}\n'.format(tmpdir.mkdir('other')), mode='a')
+    results = _bootstrap_batch(str(prefix), envs, jobs=2,
+                               profile_dir=str(tmpdir.join('bootstrap.conf')),
+                               skip_activate_script=True,
+                               pkgs_dir=str(tmpdir.join('pkgs')))
+    assert [('env1', None), ('env2', None)] == results
+    assert 'Shared package cache {0} used by other conda installations: ' \
+        'env installs run one at a time'.format(tmpdir.join('pkgs')) \
+        in caplog.text
+    shutil.rmtree(str(tmpdir))
+
+def test_bootstrap_noop(caplog, tmpdir, environment):
+    """Bootstrapping again an unchanged env runs no command and does not
+    rewrite activate scripts"""
+    from bootstrap import _bootstrap
+    for key in ('BOOTSTRAP_ACTIVATE', 'BOOTSTRAP_COMMAND'):
+        if key in os.environ:
+            del environment[key]
+    prefix = tmpdir.join('prefix')
+    prefix.join('conda-meta').ensure(dir=True)
+    conda = prefix.join('bin/conda')
+    conda.write("""#! /bin/bash
+[ "$1" == "create" ] && mkdir -p "$(dirname "$0")/../envs/$3/conda-meta"
+[ "$1" == "list" ] && [ ! -d "$(dirname "$0")/../envs/$3/conda-meta" ] \
+    && exit 1
+exit 0
+""", ensure=True)
+    conda.chmod(stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+    env_yml = tmpdir.join('environment.yml')
+    env_yml.write('dependencies: []\n')
+    profile = tmpdir.join('profile/bootstrap.conf')
+    args = (str(prefix), 'test', str(env_yml), [])
+    with patch('subprocess.check_output', return_value=b'') as probe:
+        _bootstrap(*args, profile_dir=str(profile))
+        _bootstrap(*args, profile_dir=str(profile))
+    # shell startup files are inspected, no login shell is run
+    assert 0 == probe.call_count
+    activate = tmpdir.join('profile/bootstrap.conf.d/activate-test.conf')
+    mtime = activate.mtime()
+    with patch('subprocess.Popen', side_effect=AssertionError('spawned')):
+        _bootstrap(*args, profile_dir=str(profile))
+    assert [] == [r for r in caplog.records if r.levelno >= logging.ERROR]
+    assert mtime == activate.mtime()
+    shutil.rmtree(str(tmpdir))
+
+def test_registry(caplog, tmpdir, environment):
+    """Bootstrapped envs are recorded in registry and listed from it;
+    reconcile picks envs created or removed outside bootstrap"""
+    import json
+    from bootstrap import _bootstrap_env, _main
+    caplog.set_level(logging.INFO)
+    environment['BOOTSTRAP_REGISTRY'] = str(tmpdir.join('registry.json'))
+    prefix = tmpdir.join('prefix')
+    prefix.join('conda-meta').ensure(dir=True)
+    conda = prefix.join('bin/conda')
+    conda.write("""#! /bin/bash
+[ "$1" == "create" ] && mkdir -p "$(dirname "$0")/../envs/$3/conda-meta"
+[ "$1" == "list" ] && [ ! -d "$(dirname "$0")/../envs/$3/conda-meta" ] \
+    && exit 1
+exit 0
+""", ensure=True)
+    conda.chmod(stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+    env_yml = tmpdir.join('environment.yml')
+    env_yml.write('dependencies: []\n')
+    # relative environment path is registered as absolute path
+    with tmpdir.as_cwd():
+        _bootstrap_env(str(prefix), 'test', 'environment.yml', False, False,
+                       str(tmpdir.join('bootstrap.conf')), True)
+    # template envs are not registered envs
+    prefix.join('envs/bootstrap-template-0123456789ab/conda-meta') \
+        .ensure(dir=True)
+
+    def envs(*args):
+        del caplog.records[:]
+        assert 0 == _main(['status', '--json'] + list(args))
+        return json.loads([i for i in caplog.records
+                           if i.name == 'stdout'][-1].getMessage())
+    (env,) = envs()
+    assert ('test', str(prefix), str(env_yml), 'conda', 'ok', None) == \
+        (env['name'], env['prefix'], env['environment'], env['backend'],
+         env['status'], env['phase'])
+    assert env['size'] > 0
+    # unchanged env: registry is not written again
+    inode = os.stat(str(tmpdir.join('registry.json'))).st_ino
+    _bootstrap_env(str(prefix), 'test', str(env_yml), False, False,
+                   str(tmpdir.join('bootstrap.conf')), True)
+    assert inode == os.stat(str(tmpdir.join('registry.json'))).st_ino
+    assert not [i for i in caplog.records
+                if 'changed outside bootstrap' in i.getMessage()]
+    del caplog.records[:]
+    assert 0 == _main(['list'])
+    assert [i for i in caplog.records if i.name == 'stdout'][0] \
+        .getMessage().startswith('test ')
+    assert 1 == _main(['status', 'missing'])
+    # env created outside bootstrap, bootstrapped env removed
+    prefix.join('envs/other/conda-meta').ensure(dir=True)
+    shutil.rmtree(str(prefix.join('envs/test')))
+    envs()
+    assert None != re.search('changed outside bootstrap',
+                             caplog.records[-1].message)
+    assert ['other'] == [i['name'] for i in envs('--reconcile')]
+    assert 'unknown' == envs()[0]['status']
+    shutil.rmtree(str(tmpdir))
+
 def test_bootstrap_activate(capfd, tmpdir):
     """Test bootstrap-activate ENV command by:
     * initialising scripts from BOOTSTRAP_* strings (one common file and
@@ -537,6 +1673,81 @@ def test_bootstrap_activate(capfd, tmpdir):
     assert 0 == p.returncode
     shutil.rmtree(str(tmpdir))
 
+def test_bootstrap_activate_index(capfd, tmpdir, environment):
+    """Activation index defines stubs; env script is only sourced when its
+    activate function is called"""
+    from bootstrap import _print_activate_command
+    environment['BOOTSTRAP_ACTIVATE'] = '1'
+    _fake_activate_script(tmpdir.join('prefix/bin/activate'))
+    bootstrap_conf = tmpdir.join('profile.d/bootstrap.conf')
+    for name in ('env1', 'env2'):
+        _print_activate_command(str(tmpdir.join('prefix')), name,
+                                str(bootstrap_conf), False)
+    index = tmpdir.join('profile.d/bootstrap.conf.d/index.sh')
+    mtime = index.mtime()
+    _print_activate_command(str(tmpdir.join('prefix')), 'env1',
+                            str(bootstrap_conf), False)
+    assert mtime == index.mtime()
+    capfd.readouterr()
+    command = 'source {0}; declare -f activate-env2 | grep -c conda; \
+               bootstrap-activate env2; \
+               echo current env: $BOOTSTRAP_ENV'.format(bootstrap_conf)
+    p = subprocess.Popen(command, shell=True, executable='/bin/bash')
+    p.communicate()
+    out = _out(capfd.readouterr())
+    # stub does not call conda itself
+    assert out.startswith('0\n')
+    assert None != re.search('env env2 activated\n', out)
+    assert None != re.search('current env: env2\n', out)
+    # files added after index was written: every file is sourced
+    tmpdir.join('profile.d/bootstrap.conf.d/extra.conf').write(
+        'echo extra loaded\n')
+    p = subprocess.Popen(command, shell=True, executable='/bin/bash')
+    p.communicate()
+    out = _out(capfd.readouterr())
+    assert out.startswith('extra loaded\n1\n')
+    assert None != re.search('current env: env2\n', out)
+    shutil.rmtree(str(tmpdir))
+
+def test_profile_sources_bootstrap(tmpdir, environment):
+    """Source line (or loop over profile.d) is found in startup files"""
+    from bootstrap import _profile_sources_bootstrap
+    environment['HOME'] = str(tmpdir)
+    bashrc = tmpdir.join('.bashrc')
+    conf = str(tmpdir.join('.profile.d/bootstrap.conf'))
+    with patch('bootstrap.LOGIN_SHELL_FILES', ('~/.bashrc', '~/.missing')):
+        assert False == _profile_sources_bootstrap(conf)
+        bashrc.write('# source ~/.profile.d/bootstrap.conf\n')
+        assert False == _profile_sources_bootstrap(conf)
+        bashrc.write('[ -f ~/.profile.d/bootstrap.conf ] && '
+                     'source ~/.profile.d/bootstrap.conf\n')
+        assert True == _profile_sources_bootstrap(conf)
+        bashrc.write('. "$HOME/.profile.d/bootstrap.conf"\n')
+        assert True == _profile_sources_bootstrap(conf)
+        bashrc.write('for i in ~/.profile.d/*.conf; do\n    . $i\ndone\n')
+        assert True == _profile_sources_bootstrap(conf)
+        # sibling files of the same folder
+        bashrc.write('source ~/.profile.d/git-prompt.sh\n'
+                     '. ~/.profile.d/bootstrap.conf.bak\n'
+                     'for i in ~/.profile.d/*.sh; do\n    . $i\ndone\n')
+        assert False == _profile_sources_bootstrap(conf)
+    shutil.rmtree(str(tmpdir))
+
+def test_bootstrap_conf_sourced_probe(tmpdir):
+    """Login shell is only run on demand; its result is cached"""
+    from bootstrap import _bootstrap_conf_sourced
+    conf = str(tmpdir.join('bootstrap.conf'))
+    cache = str(tmpdir.join('bootstrap.conf.d/probe.json').ensure())
+    with patch('bootstrap.LOGIN_SHELL_FILES', ()), \
+            patch('subprocess.check_output', return_value=b'1') as probe:
+        assert False == _bootstrap_conf_sourced(conf, cache)
+        assert True == _bootstrap_conf_sourced(conf, cache,
+                                               probe_login_shell=True)
+        assert True == _bootstrap_conf_sourced(conf, cache,
+                                               probe_login_shell=True)
+    assert 1 == probe.call_count
+    shutil.rmtree(str(tmpdir))
+
 def test_fix_bootstrap_name():
     """Only a-zA-Z0-9-_ kept for env name; replace all others chars by _"""
     from bootstrap import _fix_bootstrap_name